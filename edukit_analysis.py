@@ -0,0 +1,169 @@
+#!/bin/env python3
+"""Vectorized analysis of logged runs of the Edukit pendulum.
+
+A log (see data_logger in textual_mpy_edukit.py) is an array with one row
+per sample and the columns stepper steps, encoder ticks, control and the
+time of the sample on the board (logs made before the time was logged
+have no time column). All
+metrics work on a single log (N,) or on a batch of logs (R,N) at once, the
+time axis is always the last axis.
+
+Example at the Python prompt:
+    import edukit_analysis as ea
+    logs = ea.load_logs('log_data_*.pickle')
+    runs = ea.stack_logs(logs)
+    metrics = ea.analyze(runs, reference=100)
+"""
+
+import glob
+import pickle
+import time
+
+import numpy as np
+
+SAMPLING_TIME = 0.01
+STEPS, ENCODER, CONTROL, TIME = 0, 1, 2, 3  # columns of a log
+U_MAX = 10000. / 1.5 # above this control value, round(10000/u) of set_period_direction is period 1, the highest step rate
+
+
+def load_log(fname, mmap=True):
+    """Load one log, .npy files are memory-mapped when mmap is True."""
+    if fname.endswith('.npy'):
+        return np.load(fname, mmap_mode='r' if mmap else None)
+    with open(fname, 'rb') as handle:
+        return np.asarray(pickle.load(handle))
+
+
+def load_logs(fnames, mmap=True):
+    """Load several logs, fnames is a list of file names or a glob pattern."""
+    if isinstance(fnames, str):
+        fnames = sorted(glob.glob(fnames))
+    return [load_log(fname, mmap) for fname in fnames]
+
+
+def save_log(fname, log_data):
+    """Save a log as .npy, so it can be memory-mapped by load_log."""
+    np.save(fname, np.asarray(log_data))
+
+
+def stack_logs(logs, length=None):
+    """Stack logs in one (R,N,C) array, truncated to length (default the shortest log)."""
+    if length is None:
+        length = min(len(log) for log in logs)
+    return np.stack([np.asarray(log[:length], dtype=float) for log in logs])
+
+
+def step_info(y, initial=None, final=None, sampling_time=SAMPLING_TIME, rise=(0.1, 0.9), settle=0.02):
+    """Rise time, settling time (s) and overshoot (%) of step responses y (...,N).
+
+    The initial and final values default to the first and last sample. A
+    response that never reaches a level gives nan.
+    """
+    y = np.asarray(y, dtype=float)
+    y0 = y[..., 0] if initial is None else np.broadcast_to(initial, y.shape[:-1])
+    yf = y[..., -1] if final is None else np.broadcast_to(final, y.shape[:-1])
+    span = yf - y0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        z = (y - y0[..., None]) / span[..., None]  # normalized response, 0 -> 1
+    num = y.shape[-1]
+
+    def first_crossing(level):
+        above = z >= level
+        return np.where(above.any(axis=-1), np.argmax(above, axis=-1), np.nan)
+
+    rise_time = (first_crossing(rise[1]) - first_crossing(rise[0])) * sampling_time
+    outside = np.abs(z - 1.) > settle
+    last_outside = num - 1 - np.argmax(outside[..., ::-1], axis=-1)
+    settling_time = np.where(outside.any(axis=-1), last_outside + 1, 0) * sampling_time
+    settling_time = np.where(outside[..., -1], np.nan, settling_time)
+    overshoot = 100. * np.clip(np.max(z, axis=-1) - 1., 0., None)
+    return {'rise_time': rise_time, 'settling_time': settling_time, 'overshoot': overshoot}
+
+
+def error_metrics(y, reference=0.):
+    """RMS and peak of the tracking error reference - y (...,N)."""
+    e = np.asarray(reference, dtype=float) - np.asarray(y, dtype=float)
+    return {'rms_error': np.sqrt(np.mean(e**2, axis=-1)), 'peak_error': np.max(np.abs(e), axis=-1)}
+
+
+def control_effort(u, sampling_time=SAMPLING_TIME, u_max=U_MAX):
+    """Integrated absolute control, RMS control, total variation and saturation time (s) of u (...,N)."""
+    u = np.asarray(u, dtype=float)
+    return {'effort': np.sum(np.abs(u), axis=-1) * sampling_time,
+            'rms_control': np.sqrt(np.mean(u**2, axis=-1)),
+            'total_variation': np.sum(np.abs(np.diff(u, axis=-1)), axis=-1),
+            'saturation_time': np.count_nonzero(np.abs(u) > u_max, axis=-1) * sampling_time}
+
+
+def spectrum(x, sampling_time=SAMPLING_TIME, detrend=True):
+    """One-sided power spectral density of x (...,N) with a Hann window, returns (frequencies, psd)."""
+    x = np.asarray(x, dtype=float)
+    if detrend:
+        x = x - np.mean(x, axis=-1, keepdims=True)
+    num = x.shape[-1]
+    window = np.hanning(num)
+    X = np.fft.rfft(x * window, axis=-1)
+    psd = np.abs(X)**2 * (sampling_time / np.sum(window**2))
+    psd[..., 1:-1] *= 2  # one-sided, except dc and Nyquist
+    return np.fft.rfftfreq(num, sampling_time), psd
+
+
+def timing(t, sampling_time=SAMPLING_TIME, tolerance=0.5):
+    """Mean and maximum sampling interval (s) and number of overruns (interval > (1+tolerance)*sampling_time) of times t (...,N)."""
+    dt = np.diff(np.asarray(t, dtype=float), axis=-1)
+    return {'mean_interval': np.mean(dt, axis=-1), 'max_interval': np.max(dt, axis=-1),
+            'overruns': np.count_nonzero(dt > (1 + tolerance) * sampling_time, axis=-1)}
+
+
+def analyze(runs, reference=None, channel=STEPS, sampling_time=SAMPLING_TIME, u_max=U_MAX):
+    """Metrics of a log (N,C) or runs (R,N,C) as a dict of arrays with one value per run.
+
+    The step response and tracking error are computed for column channel,
+    the error only if the reference (scalar, (R,) or (R,N)) is given.
+    """
+    runs = np.asarray(runs, dtype=float)
+    y = runs[..., channel]
+    metrics = step_info(y, final=None if reference is None else _per_run(reference, y), sampling_time=sampling_time)
+    if reference is not None:
+        metrics.update(error_metrics(y, _per_sample(reference, y)))
+    metrics.update(control_effort(runs[..., CONTROL], sampling_time, u_max))
+    if runs.shape[-1] > TIME:
+        metrics.update(timing(runs[..., TIME], sampling_time))
+    return metrics
+
+
+def _per_run(reference, y):
+    reference = np.asarray(reference, dtype=float)
+    if reference.ndim == y.ndim:  # reference per sample, take final value
+        return reference[..., -1]
+    return reference
+
+
+def _per_sample(reference, y):
+    reference = np.asarray(reference, dtype=float)
+    if reference.ndim == y.ndim:
+        return reference
+    return reference[..., None]
+
+
+def benchmark(num_runs=500, num_samples=3*128, repeat=5):
+    """Print the throughput of analyze and spectrum on synthetic step responses."""
+    rng = np.random.default_rng(0)
+    t = np.arange(num_samples) * SAMPLING_TIME
+    wn = rng.uniform(2., 10., (num_runs, 1))
+    zeta = rng.uniform(0.2, 0.9, (num_runs, 1))
+    wd = wn * np.sqrt(1 - zeta**2)
+    y = 100. * (1 - np.exp(-zeta * wn * t) * (np.cos(wd * t) + zeta * wn / wd * np.sin(wd * t)))
+    runs = np.stack([y, np.zeros_like(y), 50. * np.diff(y, prepend=0., axis=-1)], axis=-1)
+    runs += rng.normal(0., 0.5, runs.shape)
+    best = np.inf
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        analyze(runs, reference=100.)
+        spectrum(runs[..., CONTROL])
+        best = min(best, time.perf_counter() - t0)
+    print(f'{num_runs} runs of {num_samples} samples in {best*1e3:.1f} ms: {num_runs/best:.0f} runs/s')
+
+
+if __name__ == '__main__':
+    benchmark()
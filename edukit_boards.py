@@ -0,0 +1,289 @@
+#!/bin/env python3
+"""Several Edukit boards driven from one host process.
+
+Every board has its own serial port and a Board client with a reader task,
+so commands to different boards run concurrently in one asyncio loop.
+Commands to one board are pipelined: up to max_in_flight commands are
+written ahead of their responses, which come back in order and are matched
+to the waiting commands by the reader task. Commands waiting to be written
+are scheduled on priority (SAFETY, LOGGING, USER, VIEW, see edukit_serial),
+commands that miss their deadline are dropped and identical queued polls
+are coalesced, so live plots cannot delay logging or user commands. Events
+of the board (e.g. alarms) are kept in events and passed to on_event, with
+on_event set the reader keeps reading for them. A Board can be used everywhere a
+serial interface is expected (serial_eval, log_samples, stream_upload,
+run_sweep, ...). When evaluating the responses (e.g. large log buffers)
+saturates a core, they can be decoded in a pool of processes.
+
+Example at the Python prompt of textual_mpy_edukit.py:
+    await boards.eval('pid.get_gains1()')            # on all boards
+    logs = await boards.gather(log_samples, 384)   # log all boards at once
+    await serial_eval(boards['/dev/ttyACM1'], 'pid.run=True')
+"""
+
+import asyncio
+from collections import deque
+import heapq
+import itertools
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from edukit_serial import (END_PATTERN, EVENT, EVENTS_LEN, SAFETY, USER, find_ports, open_board, close_board,
+                           decode_response, serial_eval, handle_event)
+
+MAX_IN_FLIGHT = 2 # commands written to a board ahead of their responses
+
+
+class Board():
+    """Client of one board, with a writer task that sends commands on priority and a reader task that matches responses."""
+    def __init__(self, port, baudrate=115200, decode_pool=None, max_in_flight=MAX_IN_FLIGHT):
+        self.port = port
+        self.baudrate = baudrate
+        self.decode_pool = decode_pool
+        self.max_in_flight = max_in_flight
+        self.ser = None
+        self.reader_task = None
+        self.writer_task = None
+        self.queue = [] # heap of (priority, sequence number, command, future, deadline) to be written
+        self.sequence = itertools.count() # first in, first out within a priority
+        self.coalesced = {} # command: future, of queued commands that can be shared
+        self.pending = deque() # futures of the commands waiting for a response, in order of sending
+        self.has_pending = asyncio.Event()
+        self.wakeup = asyncio.Event() # a command is queued or a response arrived
+        self.num_commands = 0
+        self.num_dropped = 0
+        self.num_coalesced = 0
+        self.events = deque(maxlen=EVENTS_LEN) # events of the board, see handle_event
+        self.on_event = None # function called with every event
+
+    def __repr__(self):
+        return f'Board({self.port!r})'
+
+    def open(self):
+        self.ser = open_board(self.port, self.baudrate)
+        return self
+
+    def close(self):
+        for task in (self.reader_task, self.writer_task):
+            if (task is not None) and not task.done():
+                task.cancel()
+        if self.ser is not None:
+            close_board(self.ser)
+            self.ser = None
+
+    async def request(self, command, priority=USER, deadline=None, coalesce=False):
+        """Send command and return the raw response (without END_PATTERN).
+
+        A command that is not written within deadline seconds raises
+        asyncio.TimeoutError. With coalesce, a command that is still queued
+        is not queued again, but shares the response.
+        """
+        if self.reader_task is None:
+            self.reader_task = asyncio.create_task(self._reader())
+        if self.writer_task is None:
+            self.writer_task = asyncio.create_task(self._writer())
+        if coalesce and (command in self.coalesced):
+            self.num_coalesced += 1
+            return await asyncio.shield(self.coalesced[command])
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        if coalesce:
+            self.coalesced[command] = future
+        heapq.heappush(self.queue, (priority, next(self.sequence), command, future,
+                                    None if deadline is None else loop.time() + deadline))
+        self.wakeup.set()
+        return await future
+
+    async def eval(self, command, priority=USER, deadline=None, coalesce=False):
+        """Send command and return the evaluated response, see serial_eval."""
+        frame = await self.request(command, priority, deadline, coalesce)
+        if self.decode_pool is None:
+            return decode_response(frame)
+        return await asyncio.get_running_loop().run_in_executor(self.decode_pool, decode_response, frame)
+
+    async def _write(self, data):
+        await self.ser.write_async(data)
+
+    async def _read(self):
+        return await self.ser.read_async(max(1, self.ser.in_waiting))
+
+    def _expecting(self):
+        # only read while responses (or events) are expected, so no read blocks the serial port at shutdown
+        return bool(self.pending) or (self.on_event is not None)
+
+    def _frame(self, frame):
+        if frame.startswith(EVENT): # not a response
+            handle_event(self, frame[len(EVENT):])
+            return
+        if self.pending:
+            future = self.pending.popleft()
+            if not future.done(): # the command can be cancelled meanwhile
+                future.set_result(frame)
+            self.wakeup.set()
+
+    async def _writer(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            # a safety command does not wait for a free slot
+            while not self.queue or ((len(self.pending) >= self.max_in_flight) and (self.queue[0][0] > SAFETY)):
+                self.wakeup.clear()
+                await self.wakeup.wait()
+            priority, _, command, future, deadline = heapq.heappop(self.queue)
+            if self.coalesced.get(command) is future:
+                del self.coalesced[command]
+            if future.done(): # cancelled
+                continue
+            if (deadline is not None) and (loop.time() > deadline):
+                self.num_dropped += 1
+                future.set_exception(asyncio.TimeoutError(f'{command} missed its deadline'))
+                continue
+            self.pending.append(future)
+            self.has_pending.set()
+            self.num_commands += 1
+            try:
+                await self._write(command.encode('utf-8') + END_PATTERN)
+            except Exception as e:
+                self.pending.remove(future)
+                future.set_exception(e)
+
+    async def _reader(self):
+        buf = b''
+        try:
+            while True:
+                if not self._expecting():
+                    self.has_pending.clear()
+                    await self.has_pending.wait()
+                buf += await self._read()
+                while END_PATTERN in buf:
+                    frame, buf = buf.split(END_PATTERN, 1)
+                    self._frame(frame)
+        except Exception as e:
+            while self.pending:
+                future = self.pending.popleft()
+                if not future.done():
+                    future.set_exception(e)
+            self.reader_task = None
+            raise
+
+
+class BoardManager():
+    """All boards found by find_ports (or the given ports), with operations on all boards at once.
+
+    With decode_processes > 0 the responses are decoded in a pool of that many processes.
+    Already made clients (e.g. a MuxClient of edukit_mux.py) can be given as boards.
+    """
+    def __init__(self, ports=None, baudrate=115200, decode_processes=0, boards=None):
+        self.decode_pool = ProcessPoolExecutor(decode_processes) if decode_processes else None
+        if boards is not None:
+            self.boards = list(boards)
+            return
+        if ports is None:
+            ports = find_ports()
+        self.boards = [Board(port, baudrate, self.decode_pool) for port in ports]
+
+    def __len__(self):
+        return len(self.boards)
+
+    def __iter__(self):
+        return iter(self.boards)
+
+    def __getitem__(self, key):
+        """Board by index or by port name."""
+        if isinstance(key, str):
+            for board in self.boards:
+                if board.port == key:
+                    return board
+            raise KeyError(key)
+        return self.boards[key]
+
+    def open(self):
+        """Open all boards, in parallel because every board takes half a second to start up."""
+        with ThreadPoolExecutor(max_workers=max(1, len(self.boards))) as pool:
+            list(pool.map(lambda board: board.open(), self.boards))
+        return self
+
+    def close(self):
+        for board in self.boards:
+            board.close()
+        if self.decode_pool is not None:
+            self.decode_pool.shutdown()
+
+    async def gather(self, function, *args, **kwargs):
+        """Run the coroutine function(board, *args, **kwargs) for all boards concurrently, returns a list of results."""
+        return await asyncio.gather(*(function(board, *args, **kwargs) for board in self.boards))
+
+    async def eval(self, command, **kwargs):
+        """Evaluate command on all boards, returns a list of responses (kwargs see serial_eval)."""
+        return await self.gather(serial_eval, command, **kwargs)
+
+
+class SimulatedSerial():
+    """Serial link of baudrate to a board that needs latency seconds per command and answers response, for benchmarks.
+
+    The board evaluates one command at a time, in the order of writing."""
+    def __init__(self, baudrate=115200, latency=0.002, response=b'[0, 0, 0.0]'):
+        self.baudrate = baudrate
+        self.latency = latency
+        self.response = response
+        self.received = bytearray() # responses that arrived and are not read yet
+        self.arrived = asyncio.Event()
+        self.busy_until = 0. # loop time at which the board has evaluated the commands written so far
+
+    @property
+    def in_waiting(self):
+        return len(self.received)
+
+    async def write_async(self, data):
+        loop = asyncio.get_running_loop()
+        await asyncio.sleep(10 * len(data) / self.baudrate) # 10 bits per byte
+        for _ in range(data.count(END_PATTERN)):
+            self.busy_until = max(self.busy_until, loop.time()) + self.latency
+            answered = self.busy_until + 10 * (len(self.response) + len(END_PATTERN)) / self.baudrate
+            loop.call_at(answered, self._arrive, self.response + END_PATTERN)
+
+    def _arrive(self, data):
+        self.received += data
+        self.arrived.set()
+
+    async def read_async(self, size=1):
+        while not self.received:
+            self.arrived.clear()
+            await self.arrived.wait()
+        data = bytes(self.received[:size])
+        del self.received[:size]
+        return data
+
+
+class SimulatedBoard(Board):
+    """Board on a SimulatedSerial, without hardware."""
+    def __init__(self, port='sim', baudrate=115200, latency=0.002):
+        super().__init__(port, baudrate)
+        self.latency = latency
+
+    def open(self):
+        self.ser = SimulatedSerial(self.baudrate, self.latency)
+        return self
+
+    def close(self):
+        self.ser = None # nothing to stop or reset
+        super().close()
+
+
+async def benchmark_gather(max_boards=4, num_commands=200, latency=0.002, command='pid.sample'):
+    """Print the rate of commands of BoardManager.gather on 1 ... max_boards simulated boards, each sends num_commands in turn."""
+    async def run(board):
+        for _ in range(num_commands):
+            await serial_eval(board, command)
+    for num_boards in range(1, max_boards + 1):
+        boards = BoardManager(ports=[])
+        boards.boards = [SimulatedBoard(f'sim{i}', latency=latency).open() for i in range(num_boards)]
+        t0 = time.perf_counter()
+        await boards.gather(run)
+        elapsed = time.perf_counter() - t0
+        boards.close()
+        print(f'{num_boards} boards: {num_boards * num_commands / elapsed:.0f} commands/s '
+              f'({num_commands / elapsed:.0f} per board)')
+
+
+if __name__ == '__main__':
+    asyncio.run(benchmark_gather())
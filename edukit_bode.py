@@ -0,0 +1,138 @@
+#!/bin/env python3
+"""Measurement of the frequency response of the pendulum, from the control to the steps or encoder ticks.
+
+A swept sine (Chirp) or multisine (Multisine) of uexcite.py is added to
+the control on the board (control_add), and the log is processed while it
+streams in: every complete segment of nperseg samples (overlapping by half)
+is detrended, windowed and transformed with the FFT, and the auto and cross
+spectra are averaged (Welch). The H1 estimate Syu / Suu uses the control
+that is actually sent, so it is also valid in closed loop; the coherence
+shows at which frequencies the estimate can be trusted.
+
+Example at the Python prompt:
+    import edukit_bode as eb
+    response = await eb.measure(micropython_serial_interface, 'Chirp(500.,0.1,50.,60.)', channel=1)
+    f, magnitude_db, phase_deg = response.bode()
+    response.save('bode.csv')
+"""
+
+import time
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+from edukit_serial import SAMPLING_TIME, LOG_BUF_LEN, SAFETY, LOGGING, serial_eval, log_samples
+
+
+class FrequencyResponse():
+    """Welch averaged spectra of u and y and the H1 estimate of the response from u to y, updated per block of samples."""
+    def __init__(self, nperseg=1024, overlap=0.5, sampling_time=SAMPLING_TIME):
+        self.nperseg = nperseg
+        self.step = nperseg - int(overlap * nperseg)
+        self.sampling_time = sampling_time
+        self.window = np.hanning(nperseg)
+        self.frequencies = np.fft.rfftfreq(nperseg, sampling_time)
+        self.t = np.arange(nperseg) - (nperseg - 1) / 2 # for the linear detrend
+        self.u = np.empty(0)
+        self.y = np.empty(0)
+        self.Suu = np.zeros(len(self.frequencies))
+        self.Syy = np.zeros(len(self.frequencies))
+        self.Syu = np.zeros(len(self.frequencies), dtype=complex)
+        self.num_segments = 0
+
+    def __repr__(self):
+        return f'FrequencyResponse({len(self.frequencies)} frequencies up to {self.frequencies[-1]:g} Hz, {self.num_segments} segments)'
+
+    def _spectrum(self, x):
+        # all segments at once, without their mean and slope (e.g. of the steps, which integrate the control)
+        x = x - x.mean(axis=1, keepdims=True)
+        x -= np.outer(x @ self.t / (self.t @ self.t), self.t)
+        return np.fft.rfft(x * self.window, axis=1)
+
+    def add(self, u, y):
+        """Add samples of u and y, the complete segments are processed and only the rest is kept."""
+        self.u = np.concatenate([self.u, u])
+        self.y = np.concatenate([self.y, y])
+        if len(self.u) < self.nperseg:
+            return
+        num = (len(self.u) - self.nperseg) // self.step + 1
+        U = self._spectrum(sliding_window_view(self.u, self.nperseg)[::self.step][:num])
+        Y = self._spectrum(sliding_window_view(self.y, self.nperseg)[::self.step][:num])
+        self.Suu += np.sum(np.abs(U)**2, axis=0)
+        self.Syy += np.sum(np.abs(Y)**2, axis=0)
+        self.Syu += np.sum(Y * np.conj(U), axis=0)
+        self.num_segments += num
+        self.u = self.u[num * self.step:]
+        self.y = self.y[num * self.step:]
+
+    def response(self):
+        """H1 estimate of the frequency response, per frequency."""
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return self.Syu / self.Suu
+
+    def coherence(self):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.abs(self.Syu)**2 / (self.Suu * self.Syy)
+
+    def bode(self):
+        """Frequencies (Hz), magnitude (dB) and phase (degrees), without the frequency 0."""
+        H = self.response()[1:]
+        with np.errstate(divide='ignore'):
+            return self.frequencies[1:], 20 * np.log10(np.abs(H)), np.degrees(np.unwrap(np.angle(H)))
+
+    def save(self, fname):
+        """Save the response as csv, with the columns frequency, magnitude, phase, coherence and real and imaginary part."""
+        f, magnitude_db, phase_deg = self.bode()
+        H = self.response()[1:]
+        np.savetxt(fname, np.column_stack([f, magnitude_db, phase_deg, self.coherence()[1:], H.real, H.imag]),
+                   delimiter=',', header='frequency_hz,magnitude_db,phase_deg,coherence,real,imag', comments='')
+
+
+async def measure(serial_interface, excitation='Chirp(500.,0.1,50.,60.)', num_samples=47*LOG_BUF_LEN, channel=1,
+                  nperseg=1024, progress=None, compress=False):
+    """Add excitation (a generator of uexcite.py) to the control and estimate the response from the control to channel
+    (0 steps, 1 encoder ticks) while num_samples are logged, returns the FrequencyResponse.
+
+    progress(num_buffers, response) is called after every received buffer.
+    """
+    response = FrequencyResponse(nperseg)
+    def on_chunk(chunk):
+        response.add(chunk[:, 2], chunk[:, channel])
+    await serial_eval(serial_interface, f"set_control_excitation({excitation},0);supervisory['control_add']=True", priority=LOGGING)
+    try:
+        await log_samples(serial_interface, num_samples, None if progress is None else lambda num: progress(num, response),
+                          compress=compress, on_chunk=on_chunk)
+    finally:
+        # without a running controller the stepper keeps the last rate
+        await serial_eval(serial_interface, "supervisory['control_add']=False;stepper.set_period_direction(0)", priority=SAFETY)
+    return response
+
+
+def benchmark(num_samples=47*LOG_BUF_LEN, f0=0.1, f1=50.):
+    """Estimate the response of a simulated resonance from a chirp in blocks of LOG_BUF_LEN samples, print the time per block and the error."""
+    T = SAMPLING_TIME
+    t = np.arange(num_samples) * T
+    u = 500. * np.sin(2 * np.pi * (f0 * t + 0.5 * (f1 - f0) / t[-1] * t**2))
+    # lightly damped resonance at 1.2 Hz (the hanging pendulum), discretized with the bilinear transform
+    w0, zeta = 2 * np.pi * 1.2, 0.05
+    c = 2 / T
+    a = np.array([c**2 + 2*zeta*w0*c + w0**2, 2*w0**2 - 2*c**2, c**2 - 2*zeta*w0*c + w0**2])
+    b = np.array([w0**2, 2*w0**2, w0**2])
+    y = np.zeros(num_samples)
+    for k in range(num_samples):
+        y[k] = (b[0]*u[k] + b[1]*u[k-1]*(k > 0) + b[2]*u[k-2]*(k > 1) - a[1]*y[k-1]*(k > 0) - a[2]*y[k-2]*(k > 1)) / a[0]
+    response = FrequencyResponse()
+    t0 = time.perf_counter()
+    for i in range(0, num_samples, LOG_BUF_LEN):
+        response.add(u[i:i+LOG_BUF_LEN], y[i:i+LOG_BUF_LEN])
+    elapsed = time.perf_counter() - t0
+    f, magnitude_db, _ = response.bode()
+    z = np.exp(2j * np.pi * f * T)
+    exact = 20 * np.log10(np.abs(np.polyval(b[::-1], 1/z) / np.polyval(a[::-1], 1/z)))
+    band = (f > 0.3) & (f < 45.)
+    print(f'{response}: {elapsed / (num_samples / LOG_BUF_LEN) * 1e3:.2f} ms per block of {LOG_BUF_LEN} samples '
+          f'({LOG_BUF_LEN * T * 1e3:.0f} ms of data), median error {np.median(np.abs(magnitude_db - exact)[band]):.2f} dB')
+
+
+if __name__ == '__main__':
+    benchmark()
@@ -0,0 +1,89 @@
+#!/bin/env python3
+"""Synchronization of the ticks_us clock of the board with time.monotonic of the host.
+
+The board is probed with the endpoint ticks: the host time halfway the
+round trip is taken as the time of the ticks reading. Only the probes with
+the shortest round trips are used, they have the least delay on the serial
+link. A line through these probes gives the offset and the drift of the
+board clock. ticks_us wraps around every TICKS_PERIOD us, which is undone
+relative to the probes.
+
+Example at the Python prompt:
+    clock = await clock_sync(micropython_serial_interface)
+    log_data = await log_samples(micropython_serial_interface,384,clock=clock)  # column 3 in host time
+    clock.device_to_host(await serial_eval(micropython_serial_interface,'ticks_us()'))
+"""
+
+import asyncio
+import struct
+import time
+
+import numpy as np
+
+from edukit_serial import SAFETY, call_endpoint
+
+TICKS_PERIOD = 2**30 # ticks_us wraps around at this value on the stm32 port
+MIN_DRIFT_SPAN = 10. # shortest span of the probes (s) to estimate the drift
+
+
+class ClockSync():
+    """Board time = scale * host time + offset (s), fitted on probes (host time, ticks_us, round trip time)."""
+    def __init__(self, host_times, ticks, rtts, quantile=0.25):
+        self.host_times = np.asarray(host_times, dtype=float)
+        self.ticks = np.unwrap(np.asarray(ticks, dtype=float), period=TICKS_PERIOD)
+        self.rtts = np.asarray(rtts, dtype=float)
+        self.fit(quantile)
+
+    def __repr__(self):
+        return (f'ClockSync(offset={self.offset:.6f} s, drift={self.drift_ppm:.1f} ppm, '
+                f'min_rtt={self.rtts.min()*1e3:.2f} ms, residual={self.residual*1e6:.0f} us)')
+
+    def fit(self, quantile=0.25):
+        """Fit on the probes with a round trip time within the quantile."""
+        used = self.rtts <= np.quantile(self.rtts, quantile)
+        t = self.host_times[used]
+        device = self.ticks[used] * 1e-6
+        if np.ptp(self.host_times) >= MIN_DRIFT_SPAN:
+            self.scale, self.offset = np.polyfit(t, device, 1)
+        else: # too short to see the drift
+            self.scale = 1.
+            self.offset = np.median(device - t)
+        self.residual = np.std(device - (self.scale * t + self.offset))
+        self.drift_ppm = (self.scale - 1.) * 1e6
+
+    def unwrap(self, ticks, host_time=None):
+        """ticks_us values read around host_time (default now) on the unwrapped scale of the probes."""
+        if host_time is None:
+            host_time = time.monotonic()
+        expected = (self.scale * host_time + self.offset) * 1e6
+        ticks = np.asarray(ticks, dtype=float)
+        return ticks + np.round((expected - ticks) / TICKS_PERIOD) * TICKS_PERIOD
+
+    def device_to_host(self, ticks, host_time=None):
+        """Host time (s) of ticks_us values, read around host_time (default now)."""
+        return (self.unwrap(ticks, host_time) * 1e-6 - self.offset) / self.scale
+
+    def host_to_device(self, host_time):
+        """ticks_us (wrapped) at host time (s)."""
+        return np.mod(np.round((self.scale * np.asarray(host_time) + self.offset) * 1e6), TICKS_PERIOD)
+
+
+async def clock_sync(serial_interface, num_probes=40, interval=0.02, previous=None):
+    """Probe the board num_probes times every interval seconds and return the ClockSync.
+
+    The probes of a previous ClockSync are added, so the span grows and the drift gets known.
+    """
+    host_times, ticks, rtts = [], [], []
+    for _ in range(num_probes):
+        t0 = time.monotonic()
+        data = await call_endpoint(serial_interface, 'ticks', priority=SAFETY) # no waiting behind other commands
+        t1 = time.monotonic()
+        host_times.append(0.5 * (t0 + t1))
+        ticks.append(struct.unpack('<I', data)[0])
+        rtts.append(t1 - t0)
+        await asyncio.sleep(interval)
+    if previous is not None:
+        ticks = np.concatenate([previous.ticks, previous.unwrap(ticks, host_times[0])])
+        host_times = np.concatenate([previous.host_times, host_times])
+        rtts = np.concatenate([previous.rtts, rtts])
+    return ClockSync(host_times, ticks, rtts)
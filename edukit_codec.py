@@ -0,0 +1,95 @@
+#!/bin/env python3
+"""Vectorized decoding of the compressed log buffers of mpy_edukit (see ucodec.py).
+
+The endpoint log_chunk_z sends a log buffer as zig-zag varints of the
+differences between samples of the stepper steps, the encoder ticks and the
+us since the previous sample, followed by the control as float16. As the
+integer channels change by small amounts from sample to sample, most
+varints are one byte, about 5 bytes per sample instead of 14 in binary or
+about 30 as text.
+
+Example:
+    log_data = await log_samples(micropython_serial_interface,384,compress=True)
+"""
+
+import time
+
+import numpy as np
+
+
+def zigzag(d):
+    return np.where(d >= 0, 2 * d, -2 * d - 1)
+
+
+def unzigzag(z):
+    return (z >> 1) ^ -(z & 1)
+
+
+def encode_varints(values):
+    """Unsigned varints (7 bits per byte, least significant first) of integer values as bytes."""
+    values = np.asarray(values, dtype=np.int64)
+    num_bytes = 1 + sum((values >= 1 << (7 * k)).astype(int) for k in range(1, 10))
+    ends = np.cumsum(num_bytes)
+    group = np.repeat(np.arange(len(values)), num_bytes)
+    position = np.arange(ends[-1] if len(ends) else 0) - (ends - num_bytes)[group]
+    out = (values[group] >> (7 * position)) & 0x7f
+    out[:-1] |= np.where(group[1:] == group[:-1], 0x80, 0)
+    return out.astype(np.uint8).tobytes()
+
+
+def decode_varints(data, count, offset=0):
+    """First count unsigned varints in data from offset, returns (values, end position)."""
+    b = np.frombuffer(data, np.uint8, offset=offset)
+    last = np.flatnonzero(b < 0x80)[:count] # last byte of every varint
+    if len(last) < count:
+        raise ValueError(f'{len(last)} of {count} varints in data')
+    end = last[-1] + 1
+    start = np.concatenate([[0], last[:-1] + 1])
+    group = np.repeat(np.arange(count), last - start + 1)
+    shifted = (b[:end] & 0x7f).astype(np.int64) << (7 * (np.arange(end) - start[group]))
+    return np.add.reduceat(shifted, start), offset + end
+
+
+def encode_log_chunk_z(chunk):
+    """Compressed log buffer of chunk (columns steps, encoder ticks, control, us since previous sample), as ucodec on the board."""
+    chunk = np.asarray(chunk)
+    ints = chunk[:, [0, 1, 3]].T.astype(np.int64)
+    deltas = np.diff(ints, axis=1, prepend=0)
+    control = np.clip(chunk[:, 2], -65504., 65504.).astype('<f2')
+    return encode_varints(zigzag(deltas).ravel()) + control.tobytes()
+
+
+def decode_log_chunk_z(data, num_samples):
+    """Array with the columns steps, encoder ticks, control and us since the previous sample from endpoint log_chunk_z."""
+    z, end = decode_varints(data, 3 * num_samples)
+    ints = np.cumsum(unzigzag(z).reshape(3, num_samples), axis=1)
+    chunk = np.empty((num_samples, 4))
+    chunk[:, 0] = ints[0]
+    chunk[:, 1] = ints[1]
+    chunk[:, 3] = ints[2]
+    chunk[:, 2] = np.frombuffer(data, '<f2', num_samples, end)
+    return chunk
+
+
+def benchmark(num_samples=128, repeat=2000):
+    """Print the size of a compressed log buffer of a simulated swing and the decoding speed."""
+    rng = np.random.default_rng(0)
+    t = np.arange(num_samples) * 0.01
+    chunk = np.stack([np.round(800 * np.sin(2 * np.pi * 0.5 * t)),
+                      np.round(1200 + 300 * np.sin(2 * np.pi * 1.2 * t)),
+                      rng.normal(0, 500, num_samples),
+                      10000 + rng.integers(-30, 30, num_samples)], axis=-1)
+    data = encode_log_chunk_z(chunk)
+    decoded = decode_log_chunk_z(data, num_samples)
+    assert np.array_equal(decoded[:, [0, 1, 3]], chunk[:, [0, 1, 3]])
+    text = len(repr([list(chunk[:, 0].astype(int)), list(chunk[:, 1].astype(int)), list(chunk[:, 2].astype(np.float32))]))
+    t0 = time.perf_counter()
+    for _ in range(repeat):
+        decode_log_chunk_z(data, num_samples)
+    elapsed = (time.perf_counter() - t0) / repeat
+    print(f'{num_samples} samples: {text} bytes as text, {14*num_samples} bytes binary, {len(data)} bytes compressed '
+          f'({len(data)/num_samples:.1f} bytes/sample), decoded in {elapsed*1e6:.0f} us')
+
+
+if __name__ == '__main__':
+    benchmark()
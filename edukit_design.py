@@ -0,0 +1,210 @@
+#!/bin/env python3
+"""Design of the StateSpace controller of mpy_edukit: LQR state feedback with an observer.
+
+A continuous model (e.g. pendulum_model, the linearization of the model of
+edukit_sim.py) is discretized with a zero-order hold at the sampling time
+of the controller, a discrete model (e.g. identified with edukit_sysid.py)
+is used as is. The state feedback u = -K x and the gain L of the observer
+follow from Riccati iterations. StateSpace updates x <- A x + B (y[1] - r2)
+and then sends u = C x, so the observer is the current estimator
+    x(t) = (I - L H) (Phi - Gamma K) x(t-1) + L y(t),  u(t) = -K x(t)
+which uses the measurement of the same sample. The closed loop of plant
+and controller is checked for stability before the design is uploaded in
+one binary transfer (endpoint load_model of mpy_edukit).
+
+Example at the Python prompt:
+    import edukit_design as ed
+    design = ed.design(*ed.pendulum_model(), Q=[1., 0.01], R=1e-4, y_offset=1200)
+    design                              # gains, closed-loop poles and stability
+    await ed.upload(micropython_serial_interface, design)
+    await serial_eval(micropython_serial_interface, "ss.run=True; select_controller('state_space')")
+"""
+
+import struct
+import time
+
+import numpy as np
+
+from edukit_serial import SAMPLING_TIME, call_endpoint, serial_eval
+from edukit_sim import PendulumModel
+
+
+def expm(M):
+    """Matrix exponential by scaling and squaring of a Taylor series."""
+    M = np.asarray(M, dtype=float)
+    squarings = max(0, int(np.ceil(np.log2(max(np.linalg.norm(M, 1), 1e-300) / 0.5))))
+    M = M / 2**squarings
+    E = np.eye(len(M))
+    term = np.eye(len(M))
+    for k in range(1, 20):
+        term = term @ M / k
+        E = E + term
+    for _ in range(squarings):
+        E = E @ E
+    return E
+
+
+def c2d(A, B, sampling_time=SAMPLING_TIME):
+    """Zero-order hold discretization (Phi, Gamma) of x' = A x + B u."""
+    A = np.atleast_2d(np.asarray(A, dtype=float))
+    B = np.asarray(B, dtype=float).reshape(len(A), -1)
+    n, m = B.shape
+    M = np.zeros((n + m, n + m))
+    M[:n, :n] = A
+    M[:n, n:] = B
+    E = expm(M * sampling_time)
+    return E[:n, :n], E[:n, n:]
+
+
+def dare(A, B, Q, R, iterations=100_000, tolerance=1e-10):
+    """Solution P of the discrete algebraic Riccati equation, by iterating P <- Q + A'PA - A'PB (R + B'PB)^-1 B'PA."""
+    P = Q.copy()
+    for _ in range(iterations):
+        APB = A.T @ P @ B
+        P_next = Q + A.T @ P @ A - APB @ np.linalg.solve(R + B.T @ P @ B, APB.T)
+        if np.max(np.abs(P_next - P)) <= tolerance * max(1., np.max(np.abs(P_next))):
+            return P_next
+        P = P_next
+    raise ValueError('Riccati iteration did not converge, is the model stabilizable and detectable?')
+
+
+def _weight(W, n):
+    W = np.asarray(W, dtype=float)
+    return np.diag(np.broadcast_to(W, (n,))) if W.ndim < 2 else W
+
+
+def dlqr(Phi, Gamma, Q, R):
+    """State feedback u = -K x minimizing sum x'Qx + u'Ru, returns (K, P). Q and R can be the diagonals."""
+    Q = _weight(Q, len(Phi))
+    R = _weight(R, Gamma.shape[1])
+    P = dare(Phi, Gamma, Q, R)
+    K = np.linalg.solve(R + Gamma.T @ P @ Gamma, Gamma.T @ P @ Phi)
+    return K, P
+
+
+def observer_gain(Phi, H, Qn, Rn):
+    """Gain L of the current estimator x = x_pred + L (y - H x_pred), for process noise Qn and measurement noise Rn."""
+    Qn = _weight(Qn, len(Phi))
+    Rn = _weight(Rn, H.shape[0])
+    P = dare(Phi.T, H.T, Qn, Rn) # covariance of the prediction
+    return P @ H.T @ np.linalg.inv(H @ P @ H.T + Rn)
+
+
+def observer_controller(Phi, Gamma, H, K, L):
+    """Matrices (A, B, C) of StateSpace for state feedback K with the current estimator with gain L."""
+    n = len(Phi)
+    A = (np.eye(n) - L @ H) @ (Phi - Gamma @ K)
+    return A, L[:, 0], -K[0]
+
+
+def closed_loop(Phi, Gamma, H, A, B, C):
+    """State matrix of the plant (Phi, Gamma, H) with StateSpace (A, B, C), the state is [x(t), controller x(t-1)]."""
+    B = np.reshape(B, (-1, 1))
+    C = np.reshape(C, (1, -1))
+    return np.block([[Phi + Gamma @ C @ B @ H, Gamma @ C @ A],
+                     [B @ H, A]])
+
+
+class ControllerDesign():
+    """LQR with observer for the discrete plant (Phi, Gamma, H), as StateSpace controller (A, B, C)."""
+    def __init__(self, Phi, Gamma, H, Q, R, Qn, Rn, sampling_time=SAMPLING_TIME, y_offset=0.):
+        self.Phi = Phi
+        self.Gamma = Gamma
+        self.H = H
+        self.sampling_time = sampling_time
+        self.y_offset = y_offset
+        self.K, _ = dlqr(Phi, Gamma, Q, R)
+        self.L = observer_gain(Phi, H, Qn, Rn)
+        self.A, self.B, self.C = observer_controller(Phi, Gamma, H, self.K, self.L)
+        self.poles = np.linalg.eigvals(closed_loop(Phi, Gamma, H, self.A, self.B, self.C))
+        self.spectral_radius = np.max(np.abs(self.poles))
+        self.stable = self.spectral_radius < 1.
+
+    def __repr__(self):
+        return (f'ControllerDesign(K={np.round(self.K[0], 6).tolist()}, L={np.round(self.L[:, 0], 6).tolist()}, '
+                f'spectral_radius={self.spectral_radius:.4f}, stable={self.stable})')
+
+    def command(self, name='ss'):
+        """Micropython command that loads the design in the StateSpace controller name (text instead of upload)."""
+        return (f'{name}.set_model({np.round(self.A, 9).tolist()},{np.round(self.B, 9).tolist()},{np.round(self.C, 9).tolist()});'
+                f'{name}.gain=1.;{name}.r2={float(self.y_offset)}')
+
+
+def design(A, B, C, sampling_time=SAMPLING_TIME, Q=1., R=1., Qn=1., Rn=1., continuous=True, y_offset=0.):
+    """Design for the model x' = A x + B u, y = C x (or x(t+1) = A x(t) + B u(t) with continuous False).
+
+    y is the measurement y[1] - y_offset of StateSpace, Q, R the LQR weights
+    and Qn, Rn the noise covariances for the observer (or their diagonals).
+    """
+    A = np.atleast_2d(np.asarray(A, dtype=float))
+    B = np.asarray(B, dtype=float).reshape(len(A), -1)
+    H = np.atleast_2d(np.asarray(C, dtype=float))
+    if (B.shape[1] != 1) or (H.shape[0] != 1):
+        raise ValueError('StateSpace has one input (u) and one measurement (y[1])')
+    Phi, Gamma = c2d(A, B, sampling_time) if continuous else (A, B)
+    return ControllerDesign(Phi, Gamma, H, Q, R, Qn, Rn, sampling_time, y_offset)
+
+
+def pendulum_model(model=None, alpha0=np.pi, arm=False):
+    """Continuous linearization (A, B, C) of PendulumModel at pendulum angle alpha0 (pi is upright), in device units.
+
+    The input is the control u of set_period_direction, the states are
+    [encoder ticks, W] with W the ticks/s of the pendulum plus the coupling
+    times the arm speed, preceded by the stepper steps with arm. The measured
+    output is the encoder ticks (relative to alpha0). The steps cannot be
+    observed from the ticks, so arm is only useful for simulations; control
+    the arm with the PID of StateSpace (run_pid).
+    """
+    if model is None:
+        model = PendulumModel()
+    g = model.timer_freq / 20000. # microsteps/s per unit of u at small u (period + 1 = 10000/u + 1), see step_rate in edukit_sim.py
+    rho = model.ticks_per_rev / model.steps_per_rev # ticks per microstep of the arm
+    c = model.coupling * np.cos(alpha0)
+    k = model.omega0**2 * np.cos(alpha0)
+    A = np.array([[0., 1.],
+                  [-k, -model.damping]])
+    B = np.array([-c * rho * g, model.damping * c * rho * g])
+    C = np.array([1., 0.])
+    if arm:
+        A = np.block([[np.zeros((1, 3))], [np.zeros((2, 1)), A]])
+        B = np.concatenate([[g], B])
+        C = np.array([[1., 0., 0.], [0., 1., 0.]])
+    return A, B, C
+
+
+def pack_model(A, B, C, name='ss', gain=1., r2=0.):
+    """Arguments of endpoint load_model: name, 0, order n (uint8), float32 gain, r2, A (by rows), B and C."""
+    A = np.atleast_2d(np.asarray(A, dtype='<f4'))
+    return (name.encode('utf-8') + b'\x00' + struct.pack('<B2f', len(A), gain, r2)
+            + A.tobytes() + np.asarray(B, dtype='<f4').tobytes() + np.asarray(C, dtype='<f4').tobytes())
+
+
+async def upload(serial_interface, design, name='ss', check=True):
+    """Load design in the StateSpace controller name on the board, in one binary transfer.
+
+    Raises ValueError if the sampling time of the controller differs from the
+    design or (with check) the closed loop is not stable.
+    """
+    if check and not design.stable:
+        raise ValueError(f'closed loop is not stable (spectral radius {design.spectral_radius:.4f})')
+    sampling_time_ms = await serial_eval(serial_interface, f'{name}.sampling_time_ms')
+    if isinstance(sampling_time_ms, str):
+        raise RuntimeError(sampling_time_ms)
+    if abs(sampling_time_ms * 1e-3 - design.sampling_time) > 1e-9:
+        raise ValueError(f'{name} samples every {sampling_time_ms} ms, the design every {design.sampling_time*1e3:g} ms')
+    await call_endpoint(serial_interface, 'load_model', pack_model(design.A, design.B, design.C, name, 1., design.y_offset))
+
+
+def benchmark(repeat=100):
+    """Print the design for the upright pendulum and the time it takes."""
+    model = PendulumModel()
+    t0 = time.perf_counter()
+    for _ in range(repeat):
+        result = design(*pendulum_model(model), Q=[1., 0.01], R=1e-4, Qn=[1., 1e3], Rn=1., y_offset=model.ticks_per_rev / 2)
+    elapsed = (time.perf_counter() - t0) / repeat
+    print(result)
+    print(f'discretization, LQR, observer and stability check in {elapsed*1e3:.1f} ms')
+
+
+if __name__ == '__main__':
+    benchmark()
@@ -0,0 +1,187 @@
+#!/bin/env python3
+"""Explicit model predictive control for the ExplicitMPC controller of mpy_edukit.
+
+MPC minimizes sum x'Qx + u'Ru over a horizon, with the LQR cost P at its
+end, subject to u_min <= u <= u_max. Solving this quadratic program every
+tick is too heavy for the microcontroller, so it is solved here in advance
+for the states on a grid over a bounded region: at the center of every cell
+and half a cell away along every state, which gives the control and its
+gradient per cell. The microcontroller finds the cell of the state by
+rounding and evaluates the affine law of the cell. The quadratic programs
+of all cells are solved at once, by accelerated projected gradient steps.
+The state is estimated by the observer of edukit_design.py, from the
+encoder only.
+
+Example at the Python prompt:
+    import edukit_design as ed, edukit_mpc as em
+    law = em.explicit_mpc(*ed.pendulum_model(), Q=[1., 0.01], R=1e-4, u_max=2000., y_offset=1200)
+    law                                     # size of the table and the error of the law
+    await em.upload(micropython_serial_interface, law)
+    await serial_eval(micropython_serial_interface, "empc.run=True; select_controller('explicit_mpc')")
+"""
+
+import struct
+import time
+
+import numpy as np
+
+from edukit_design import c2d, dlqr, observer_gain
+from edukit_serial import SAMPLING_TIME, call_endpoint, serial_eval
+
+TABLE_CHUNK = 512 # floats per transfer of the table, within MAX_FRAME of urepl
+
+
+def condensed(Phi, Gamma, Q, R, P, horizon):
+    """Hessian Hq and matrix F of the cost 1/2 U'Hq U + U'F x0 of the inputs U over the horizon from state x0."""
+    n, m = Gamma.shape
+    Sx = np.vstack([np.linalg.matrix_power(Phi, k) for k in range(1, horizon + 1)])
+    Su = np.zeros((horizon * n, horizon * m))
+    for k in range(horizon):
+        for j in range(k + 1):
+            Su[k*n:(k+1)*n, j*m:(j+1)*m] = np.linalg.matrix_power(Phi, k - j) @ Gamma
+    Qbar = np.kron(np.eye(horizon), Q)
+    Qbar[-n:, -n:] = P
+    Rbar = np.kron(np.eye(horizon), R)
+    return 2 * (Su.T @ Qbar @ Su + Rbar), 2 * Su.T @ Qbar @ Sx
+
+
+def solve_qp(Hq, F, x, u_min, u_max, iterations=2000):
+    """Inputs U (B,horizon) minimizing the condensed cost for the states x (B,n) within the bounds."""
+    step = 1. / np.max(np.linalg.eigvalsh(Hq))
+    linear = np.atleast_2d(x) @ F.T
+    U = np.clip(-np.linalg.solve(Hq, linear.T).T, u_min, u_max)
+    V = U.copy()
+    t = 1.
+    for _ in range(iterations):
+        U_next = np.clip(V - step * (V @ Hq + linear), u_min, u_max)
+        t_next = 0.5 * (1. + np.sqrt(1. + 4. * t * t))
+        V = U_next + (t - 1.) / t_next * (U_next - U)
+        U, t = U_next, t_next
+    return U
+
+
+class ExplicitLaw():
+    """Affine law per cell of the grid of num cells from low to high, with the observer (Phi, Gamma, H, L)."""
+    def __init__(self, low, high, num, table, Phi, Gamma, H, L, u_min, u_max, sampling_time=SAMPLING_TIME, y_offset=0.):
+        self.low = np.asarray(low, dtype=float)
+        self.high = np.asarray(high, dtype=float)
+        self.num = np.asarray(num, dtype=int)
+        self.table = table # (cells, 1 + n): control at the center and gradient
+        self.Phi = Phi
+        self.Gamma = Gamma
+        self.H = H
+        self.L = L
+        self.u_min = u_min
+        self.u_max = u_max
+        self.sampling_time = sampling_time
+        self.y_offset = y_offset
+        self.max_error = np.nan
+        self.mean_error = np.nan
+
+    def __repr__(self):
+        return (f'ExplicitLaw(cells={self.num.tolist()}, table={self.table.size * 4} bytes, '
+                f'max_error={self.max_error:.3g}, mean_error={self.mean_error:.3g})')
+
+    def evaluate(self, x):
+        """Control for the states x (B,n), as ExplicitMPC.law on the board."""
+        x = np.atleast_2d(x)
+        width = (self.high - self.low) / self.num
+        k = np.clip(np.floor((x - self.low) / width).astype(int), 0, self.num - 1)
+        index = np.ravel_multi_index(tuple(k.T), self.num)
+        rows = self.table[index]
+        center = self.low + (k + 0.5) * width
+        u = rows[:, 0] + np.sum(rows[:, 1:] * (x - center), axis=1)
+        return np.clip(u, self.u_min, self.u_max)
+
+
+def explicit_mpc(A, B, C, sampling_time=SAMPLING_TIME, Q=1., R=1., horizon=20, u_min=None, u_max=10000.,
+                 low=(-100., -1500.), high=(100., 1500.), num=(24, 24), Qn=(1., 1e3), Rn=1., continuous=True,
+                 y_offset=0., num_checks=2000, seed=0):
+    """Explicit MPC law for the model x' = A x + B u, y = C x (discrete with continuous False), see edukit_design.design.
+
+    The law is checked against the MPC at num_checks random states in the grid.
+    """
+    A = np.atleast_2d(np.asarray(A, dtype=float))
+    B = np.asarray(B, dtype=float).reshape(len(A), -1)
+    H = np.atleast_2d(np.asarray(C, dtype=float))
+    Phi, Gamma = c2d(A, B, sampling_time) if continuous else (A, B)
+    n = len(Phi)
+    if u_min is None:
+        u_min = -u_max
+    Qm = np.diag(np.broadcast_to(np.asarray(Q, dtype=float), (n,)))
+    Rm = np.atleast_2d(R)
+    _, P = dlqr(Phi, Gamma, Qm, Rm)
+    Hq, F = condensed(Phi, Gamma, Qm, Rm, P, horizon)
+
+    low = np.asarray(low, dtype=float)
+    high = np.asarray(high, dtype=float)
+    num = np.asarray(num, dtype=int)
+    if len(low) != n or len(high) != n or len(num) != n:
+        raise ValueError(f'low, high and num should have length {n}')
+    width = (high - low) / num
+    centers = np.stack(np.meshgrid(*(low[i] + (np.arange(num[i]) + 0.5) * width[i] for i in range(n)), indexing='ij'),
+                       axis=-1).reshape(-1, n)
+    # the centers and half a cell to either side along every state, all solved at once
+    offsets = np.concatenate([np.zeros((1, n)), np.diag(width / 2), -np.diag(width / 2)])
+    states = (centers[None, :, :] + offsets[:, None, :]).reshape(-1, n)
+    u = solve_qp(Hq, F, states, u_min, u_max)[:, 0].reshape(len(offsets), len(centers))
+    table = np.empty((len(centers), n + 1))
+    table[:, 0] = u[0]
+    table[:, 1:] = ((u[1:n+1] - u[n+1:]) / width[:, None]).T
+
+    law = ExplicitLaw(low, high, num, table, Phi, Gamma, H, observer_gain(Phi, H, Qn, Rn),
+                      u_min, u_max, sampling_time, y_offset)
+    if num_checks:
+        x = np.random.default_rng(seed).uniform(low, high, (num_checks, n))
+        error = np.abs(law.evaluate(x) - solve_qp(Hq, F, x, u_min, u_max)[:, 0])
+        law.max_error = error.max()
+        law.mean_error = error.mean()
+    return law
+
+
+async def upload(serial_interface, law, name='empc'):
+    """Load law in the ExplicitMPC controller name on the board, the table in binary chunks (endpoint load_table)."""
+    sampling_time_ms = await serial_eval(serial_interface, f'{name}.sampling_time_ms')
+    if isinstance(sampling_time_ms, str):
+        raise RuntimeError(sampling_time_ms)
+    if abs(sampling_time_ms * 1e-3 - law.sampling_time) > 1e-9:
+        raise ValueError(f'{name} samples every {sampling_time_ms} ms, the law every {law.sampling_time*1e3:g} ms')
+    command = (f'{name}.set_observer({law.Phi.tolist()},{law.Gamma[:, 0].tolist()},{law.H[0].tolist()},{law.L[:, 0].tolist()});'
+               f'{name}.set_grid({law.low.tolist()},{law.high.tolist()},{law.num.tolist()});'
+               f'{name}.u_min={float(law.u_min)};{name}.u_max={float(law.u_max)};{name}.r2={float(law.y_offset)}')
+    response = await serial_eval(serial_interface, command)
+    if isinstance(response, str):
+        raise RuntimeError(response)
+    values = law.table.astype('<f4').ravel()
+    for offset in range(0, len(values), TABLE_CHUNK):
+        await call_endpoint(serial_interface, 'load_table',
+                            name.encode('utf-8') + b'\x00' + struct.pack('<I', offset) + values[offset:offset+TABLE_CHUNK].tobytes())
+
+
+def benchmark(repeat=10):
+    """Print the size and error of the law for the upright pendulum, and the time per state of the MPC and of the law."""
+    from edukit_design import pendulum_model
+    t0 = time.perf_counter()
+    law = explicit_mpc(*pendulum_model(), Q=[1., 0.01], R=1e-4, u_max=2000., y_offset=1200)
+    elapsed = time.perf_counter() - t0
+    print(law)
+    print(f'{law.table.shape[0]} cells computed in {elapsed:.2f} s')
+    Phi, Gamma = law.Phi, law.Gamma
+    _, P = dlqr(Phi, Gamma, np.diag([1., 0.01]), np.atleast_2d(1e-4))
+    Hq, F = condensed(Phi, Gamma, np.diag([1., 0.01]), np.atleast_2d(1e-4), P, 20)
+    x = np.random.default_rng(1).uniform(law.low, law.high, (100, 2))
+    t0 = time.perf_counter()
+    for state in x:
+        solve_qp(Hq, F, state, law.u_min, law.u_max)
+    online = (time.perf_counter() - t0) / len(x)
+    t0 = time.perf_counter()
+    for _ in range(repeat):
+        for state in x:
+            law.evaluate(state)
+    lookup = (time.perf_counter() - t0) / (repeat * len(x))
+    print(f'per state on this PC: MPC {online*1e6:.0f} us, explicit law {lookup*1e6:.0f} us; '
+          f'on the board see empc.benchmark() (us per law)')
+
+
+if __name__ == '__main__':
+    benchmark()
@@ -0,0 +1,329 @@
+#!/bin/env python3
+"""Serial multiplexer, so several programs can share the connection with one board.
+
+Only one program can open the serial port of the board. This daemon opens
+it, starts mpy_edukit and listens on a local socket (tcp on localhost, or a
+unix domain socket) for clients, e.g. textual_mpy_edukit.py, a logging
+script, a Jupyter notebook or a benchmark. Clients use the protocol of the
+board: a command terminated by END_PATTERN is answered by the response
+terminated by END_PATTERN. The commands of the clients are forwarded
+round robin, one command per client per turn, so a client sending many
+commands does not hold up the others, and the responses are routed back
+to the client that sent the command.
+
+Telemetry is polled once and sent to all subscribers, however many there
+are. Commands starting with '#mux' are handled by the daemon:
+    #mux subscribe <period> <expression>   response: subscription id
+    #mux unsubscribe <id>
+    #mux history <id>                      response: list of the last values
+    #mux status
+A command with another priority than USER, a deadline or coalesce (see
+edukit_boards.py) is sent as
+    #prio <priority> <deadline or None> <coalesce 0 or 1> <command>
+and forwarded to the board with them, SAFETY commands right away instead
+of in turn with the other clients. Telemetry is sent as '#<id> <response>' terminated by END_PATTERN. The last
+HISTORY_LEN values of every subscription are kept in a ring buffer, so a
+new subscriber (e.g. another browser session of textual_mpy_edukit.py
+served with serve_edukit.py) starts with the same plots as the others.
+Events of the board (e.g. alarms of the L6474) are sent to all clients.
+
+Start the daemon with
+    python edukit_mux.py [--port /dev/ttyACM0] [--address localhost:8765 | --unix /tmp/edukit.sock]
+and connect with a MuxClient, which can be used as a serial interface:
+    mux = MuxClient()
+    await serial_eval(mux, 'pid.get_gains1()')
+    log_data = await log_samples(mux, 384)
+    sub = await mux.subscribe('pid.sample', 0.05)    # latest value in mux.telemetry[sub]
+"""
+
+import argparse
+import asyncio
+from collections import deque
+import sys
+
+from edukit_boards import Board
+from edukit_serial import END_PATTERN, EVENT, SAFETY, USER, VIEW, find_ports, decode_response
+
+MUX_ADDRESS = 'localhost:8765'
+MAX_IN_FLIGHT = 4 # commands sent to the board ahead of their responses
+HISTORY_LEN = 300 # values kept per subscription
+
+
+class _Client():
+    def __init__(self, name, writer):
+        self.name = name
+        self.writer = writer
+        self.inbox = deque()           # (command, future) not yet sent to the board
+        self.outbox = asyncio.Queue()  # futures of the responses, in order of the commands
+        self.num_commands = 0
+
+
+class Multiplexer():
+    """Shares one Board between the clients connected to the socket."""
+    def __init__(self, board, max_in_flight=MAX_IN_FLIGHT):
+        self.board = board
+        self.clients = deque() # round robin order
+        self.has_commands = asyncio.Event()
+        self.in_flight = asyncio.Semaphore(max_in_flight)
+        self.subscriptions = {} # id: [expression, period, set of clients, poll task, ring buffer]
+        self.num_clients = 0
+        self.num_subscriptions = 0
+        board.on_event = self._broadcast_event
+
+    def _broadcast_event(self, event):
+        frame = EVENT + repr(event).encode('utf-8') + END_PATTERN
+        for client in self.clients:
+            client.writer.write(frame)
+
+    async def serve(self, address=MUX_ADDRESS, unix_path=None):
+        scheduler = asyncio.create_task(self._scheduler())
+        if unix_path is not None:
+            server = await asyncio.start_unix_server(self._handle_client, unix_path)
+        else:
+            host, port = address.rsplit(':', 1)
+            server = await asyncio.start_server(self._handle_client, host, int(port))
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            scheduler.cancel()
+
+    async def _handle_client(self, reader, writer):
+        self.num_clients += 1
+        client = _Client(f"{self.num_clients}:{writer.get_extra_info('peername')}", writer)
+        self.clients.append(client)
+        sender = asyncio.create_task(self._sender(client))
+        try:
+            while True:
+                command = (await reader.readuntil(END_PATTERN))[:-len(END_PATTERN)].decode('utf-8')
+                future = asyncio.get_running_loop().create_future()
+                await client.outbox.put(future)
+                if command.startswith('#mux'):
+                    future.set_result(self._control(client, command))
+                    continue
+                options = (USER, None, False)
+                if command.startswith('#prio'):
+                    try:
+                        options, command = self._options(command)
+                    except (IndexError, ValueError) as e:
+                        future.set_result(f'Exception: {command}: {e!r}'.encode('utf-8'))
+                        continue
+                client.num_commands += 1
+                if options[0] == SAFETY: # not in turn, the board sends it without waiting for a free slot
+                    asyncio.create_task(self._forward(command, future, options, False))
+                else:
+                    client.inbox.append((command, future, options))
+                    self.has_commands.set()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass # client disconnected
+        finally:
+            self.clients.remove(client)
+            for sub_id in list(self.subscriptions):
+                self._unsubscribe(client, sub_id)
+            sender.cancel()
+            writer.close()
+
+    async def _sender(self, client):
+        # responses go back in the order of the commands of this client
+        while True:
+            future = await client.outbox.get()
+            client.writer.write(await future + END_PATTERN)
+            await client.writer.drain()
+
+    async def _scheduler(self):
+        while True:
+            await self.has_commands.wait()
+            # one command of every client with commands per turn
+            for client in list(self.clients):
+                if client.inbox:
+                    command, future, options = client.inbox.popleft()
+                    await self.in_flight.acquire()
+                    asyncio.create_task(self._forward(command, future, options))
+            if not any(client.inbox for client in self.clients):
+                self.has_commands.clear()
+
+    @staticmethod
+    def _options(command):
+        # '#prio <priority> <deadline> <coalesce> <command>'
+        words = command.split(maxsplit=4)
+        return (int(words[1]), None if words[2] == 'None' else float(words[2]), words[3] == '1'), words[4]
+
+    async def _forward(self, command, future, options=(USER, None, False), in_turn=True):
+        try:
+            future.set_result(await self.board.request(command, *options))
+        except Exception as e:
+            future.set_result(f'Exception: {e}'.encode('utf-8'))
+        finally:
+            if in_turn:
+                self.in_flight.release()
+
+    def _control(self, client, command):
+        words = command.split(maxsplit=3)
+        try:
+            if words[1] == 'subscribe':
+                return repr(self._subscribe(client, float(words[2]), words[3])).encode('utf-8')
+            elif words[1] == 'unsubscribe':
+                self._unsubscribe(client, int(words[2]))
+                return b'None'
+            elif words[1] == 'history':
+                return b'[' + b','.join(self.subscriptions[int(words[2])][4]) + b']'
+            elif words[1] == 'status':
+                return repr({'clients': [c.name for c in self.clients],
+                             'commands': {c.name: c.num_commands for c in self.clients},
+                             'board_commands': self.board.num_commands,
+                             'subscriptions': {sub_id: (sub[0], sub[1], len(sub[2])) for sub_id, sub in self.subscriptions.items()}
+                             }).encode('utf-8')
+        except (IndexError, ValueError, KeyError) as e:
+            return f'Exception: {command}: {e!r}'.encode('utf-8')
+        return f'Exception: unknown command {command}'.encode('utf-8')
+
+    def _subscribe(self, client, period, expression):
+        # subscribers of the same expression and period share one poll of the board
+        for sub_id, sub in self.subscriptions.items():
+            if (sub[0] == expression) and (sub[1] == period):
+                sub[2].add(client)
+                return sub_id
+        self.num_subscriptions += 1
+        sub_id = self.num_subscriptions
+        self.subscriptions[sub_id] = [expression, period, {client}, None, deque(maxlen=HISTORY_LEN)]
+        self.subscriptions[sub_id][3] = asyncio.create_task(self._poll(sub_id))
+        return sub_id
+
+    def _unsubscribe(self, client, sub_id):
+        sub = self.subscriptions[sub_id]
+        sub[2].discard(client)
+        if not sub[2]:
+            sub[3].cancel()
+            del self.subscriptions[sub_id]
+
+    async def _poll(self, sub_id):
+        expression, period, subscribers, _, history = self.subscriptions[sub_id]
+        loop = asyncio.get_running_loop()
+        next_time = loop.time()
+        while True:
+            try:
+                value = await self.board.request(expression, VIEW, coalesce=True)
+                if not value.startswith(b'Exception: '):
+                    history.append(value)
+                frame = b'#%d ' % sub_id + value + END_PATTERN
+                for client in subscribers:
+                    client.writer.write(frame)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e: # e.g. a lost connection of a subscriber, poll again next period
+                print(f'Poll of subscription {sub_id} ({expression}) failed: {e!r}', file=sys.stderr)
+            next_time = max(next_time + period, loop.time())
+            await asyncio.sleep(next_time - loop.time())
+
+
+class MuxClient(Board):
+    """Client of the multiplexer, can be used as serial interface (see serial_eval)."""
+    def __init__(self, address=MUX_ADDRESS, unix_path=None, decode_pool=None):
+        super().__init__(unix_path or address, decode_pool=decode_pool)
+        self.address = address
+        self.unix_path = unix_path
+        self.reader = None
+        self.writer = None
+        self.telemetry = {}  # subscription id: latest value
+        self.callbacks = {}  # subscription id: function called with every value
+
+    def __repr__(self):
+        return f'MuxClient({self.port!r})'
+
+    def open(self):
+        return self # connects at the first command
+
+    async def connect(self):
+        if self.unix_path is not None:
+            self.reader, self.writer = await asyncio.open_unix_connection(self.unix_path)
+        else:
+            host, port = self.address.rsplit(':', 1)
+            self.reader, self.writer = await asyncio.open_connection(host, int(port))
+        return self
+
+    def close(self):
+        for task in (self.reader_task, self.writer_task):
+            if (task is not None) and not task.done():
+                task.cancel()
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+    async def request(self, command, priority=USER, deadline=None, coalesce=False):
+        """Send command through the multiplexer, which passes priority, deadline and coalesce on to its Board."""
+        if self.writer is None:
+            await self.connect()
+        if (priority != USER) or (deadline is not None) or coalesce:
+            command = f'#prio {priority} {deadline} {int(coalesce)} {command}'
+        response = await super().request(command, priority, deadline, coalesce)
+        if (deadline is not None) and response.startswith(b'Exception: ') and response.endswith(b'missed its deadline'):
+            raise asyncio.TimeoutError(response[len(b'Exception: '):].decode('utf-8'))
+        return response
+
+    async def subscribe(self, expression, period=0.05, callback=None):
+        """Subscribe to the value of expression every period seconds, returns the subscription id."""
+        sub_id = await self.eval(f'#mux subscribe {period} {expression}')
+        if isinstance(sub_id, str):
+            raise RuntimeError(sub_id)
+        self.telemetry.setdefault(sub_id, None)
+        self.has_pending.set() # the reader keeps reading for the telemetry
+        if callback is not None:
+            self.callbacks[sub_id] = callback
+        return sub_id
+
+    async def unsubscribe(self, sub_id):
+        self.callbacks.pop(sub_id, None)
+        self.telemetry.pop(sub_id, None)
+        return await self.eval(f'#mux unsubscribe {sub_id}')
+
+    async def history(self, sub_id):
+        """Last values of a subscription, oldest first."""
+        return await self.eval(f'#mux history {sub_id}')
+
+    async def status(self):
+        return await self.eval('#mux status')
+
+    async def _write(self, data):
+        self.writer.write(data)
+        await self.writer.drain()
+
+    async def _read(self):
+        data = await self.reader.read(4096)
+        if not data:
+            raise ConnectionError('multiplexer closed the connection')
+        return data
+
+    def _expecting(self):
+        return super()._expecting() or bool(self.telemetry) # telemetry holds the subscriptions
+
+    def _frame(self, frame):
+        if not frame.startswith(b'#'): # a response, the repr of a result never starts with #
+            return super()._frame(frame)
+        sub_id, _, value = frame[1:].partition(b' ')
+        sub_id = int(sub_id)
+        if sub_id not in self.telemetry: # unsubscribed meanwhile
+            return
+        self.telemetry[sub_id] = decode_response(value)
+        if sub_id in self.callbacks:
+            self.callbacks[sub_id](self.telemetry[sub_id])
+
+
+async def main(args):
+    board = Board(args.port or find_ports()[0]).open()
+    print(f'Multiplexing {board.port} on {args.unix or args.address}')
+    try:
+        await Multiplexer(board, args.max_in_flight).serve(args.address, args.unix)
+    finally:
+        board.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Share the serial connection with an Edukit board between programs.')
+    parser.add_argument('--port', default=None, help='serial port (default the first STMicroelectronics board)')
+    parser.add_argument('--address', default=MUX_ADDRESS, help='host:port to listen on')
+    parser.add_argument('--unix', default=None, help='listen on this unix domain socket instead')
+    parser.add_argument('--max-in-flight', type=int, default=MAX_IN_FLIGHT, help='commands sent to the board ahead of their responses')
+    try:
+        asyncio.run(main(parser.parse_args()))
+    except KeyboardInterrupt:
+        pass
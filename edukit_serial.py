@@ -0,0 +1,302 @@
+"""Serial communication with the micropython program mpy_edukit on the Edukit board.
+
+Commands are sent as utf-8 text terminated by END_PATTERN and evaluated on
+the board by urepl.repl, which answers with the repr of the result
+terminated by END_PATTERN. Frequent binary transfers (samples, log
+buffers) use endpoints registered in urepl, see call_endpoint. Events
+(e.g. alarms of the L6474) are sent by the board without a command, as
+EVENT + repr + END_PATTERN, see handle_event. These functions are used by the user interface textual_mpy_edukit.py as well as
+by the command line tools.
+"""
+
+from array import array # needed to evaluate responses with arrays
+import asyncio
+import base64
+from collections import deque
+import struct
+import time
+
+import aioserial
+import numpy as np
+import serial.tools.list_ports as list_ports
+
+from edukit_codec import decode_log_chunk_z
+
+END_PATTERN = b'\x04'
+ENDPOINT = '\x05' # first character of an endpoint call, see urepl.py
+EVENT = b'\x06' # first byte of an event of the board, see urepl.send_event
+EVENTS_LEN = 100 # events kept per serial interface
+SAMPLING_TIME = 0.01
+LOG_BUF_LEN = 128
+STATS_CHANNELS = ('e1','e2','u') # of stats in mpy_edukit
+STATS_COUNTERS = ('limit1_sum','limit2_sum') # samples with a saturated integrator
+SAFETY, LOGGING, USER, VIEW = 0, 1, 2, 3 # priorities of commands, see edukit_boards.py
+
+
+def find_ports(manufacturer='STMicroelectronics'):
+    """Serial ports of the connected boards."""
+    return [port.device for port in list_ports.comports() if port.manufacturer == manufacturer]
+
+
+def open_board(serial_port=None, baudrate=115200):
+    """Reset the board, start mpy_edukit and return the serial interface (with a lock)."""
+    if serial_port is None:
+        serial_port = find_ports()[0]
+    ser = aioserial.AioSerial(port=serial_port,baudrate=baudrate)
+    ser.lock = asyncio.Lock() # add a lock to serial port, to prevent multiple processes communicate with serial interface at same time
+    ser.reset_output_buffer()
+    ser.reset_input_buffer()
+    ser.write(b'\x04') # reset micropython board
+    ser.flush()
+    ser.write(b'\x01') # Ctrl-A leave repl mode
+    ser.reset_input_buffer()
+    startup_cmd = 'import mpy_edukit'.encode('utf-8') + b'\r\n' + b'\x04'  # note it is imported, rather than executed by exec, because its a mpy file
+    ser.write(startup_cmd)                   # run edukit program on micropython board
+    ser.flush()
+    time.sleep(0.5) # wait for edukit to start up
+
+    ser.reset_output_buffer()
+    ser.reset_input_buffer()
+    return ser
+
+
+def close_board(ser):
+    """Stop mpy_edukit, reset the board and close the serial interface."""
+    ser.write(b'stop'+END_PATTERN+b'\x04')
+    ser.write(b'\x02') # Ctrl-B back to repl mode
+    ser.write(b'\x04') # after completing tasks, reset micropython board
+    ser.flush()
+    ser.reset_output_buffer()
+    ser.reset_input_buffer()
+    ser.close()
+
+
+def decode_response(resp,END_PATTERN=b'\x04'):
+    """Evaluate the response of the board (without END_PATTERN), exceptions are returned as string."""
+    response = resp.decode('utf-8')
+    if response == '':
+        return None
+    if len(response)>11:
+        if response[0:11] == 'Exception: ':
+            return response
+    try:
+        res = eval(response)
+    except:
+        res = response
+    return res
+
+
+def handle_event(serial_interface,frame):
+    """Keep the event in frame (without EVENT and END_PATTERN) in serial_interface.events and call serial_interface.on_event(event)."""
+    event = decode_response(frame)
+    if not hasattr(serial_interface,'events'):
+        serial_interface.events = deque(maxlen=EVENTS_LEN)
+    serial_interface.events.append(event)
+    on_event = getattr(serial_interface,'on_event',None)
+    if on_event is not None:
+        on_event(event)
+    return event
+
+
+async def serial_eval(serial_interface,command,END_PATTERN=b'\x04',priority=USER,deadline=None,coalesce=False):
+    """Evaluate command on the board, priority, deadline and coalesce are used by Board of edukit_boards.py."""
+    if hasattr(serial_interface,'eval'): # e.g. a Board of edukit_boards.py
+        return await serial_interface.eval(command,priority,deadline,coalesce)
+    ser = serial_interface
+    async with serial_interface.lock:
+        resp = getattr(ser,'rx_rest',b'') # received after the previous response, e.g. (part of) an event
+        #ser.reset_output_buffer()
+        #ser.reset_input_buffer()
+        command_byte = (command).encode('utf-8')+END_PATTERN
+        await ser.write_async(command_byte)
+        ser.flush()
+        resp += await ser.read_async(ser.in_waiting)
+        # split in frames, events can come before and after the response
+        scanned = 0
+        while True:
+            end = resp.find(END_PATTERN,scanned)
+            while end < 0:
+                scanned = max(0,len(resp)-len(END_PATTERN)+1)
+                if ser.in_waiting > 1:
+                    resp += await ser.read_async(ser.in_waiting)
+                else:
+                    resp += await ser.read_async(1)
+                end = resp.find(END_PATTERN,scanned)
+            frame, resp = resp[:end], resp[end+len(END_PATTERN):]
+            scanned = 0
+            if not frame.startswith(EVENT):
+                break
+            handle_event(serial_interface,frame[len(EVENT):])
+        while resp.startswith(EVENT) and (END_PATTERN in resp): # complete events after the response
+            event, _, resp = resp.partition(END_PATTERN)
+            handle_event(serial_interface,event[len(EVENT):])
+        ser.rx_rest = resp
+    return decode_response(frame)
+
+
+async def call_endpoint(serial_interface,name,args=b'',**kwargs):
+    """Call the endpoint name registered with urepl.register with binary args, returns the binary result.
+
+    Endpoints skip the compiler and repr on the board. The ids of the
+    endpoints are asked once and kept in serial_interface.endpoints, kwargs
+    (e.g. priority) go to serial_eval.
+    """
+    if not hasattr(serial_interface,'endpoints'):
+        endpoints = await serial_eval(serial_interface,'endpoint_ids()')
+        if not isinstance(endpoints,dict):
+            raise RuntimeError(f'endpoint_ids() returned {endpoints!r}')
+        serial_interface.endpoints = endpoints
+    command = ENDPOINT + str(serial_interface.endpoints[name]) + ' ' + base64.b64encode(args).decode('ascii')
+    result = await serial_eval(serial_interface,command,**kwargs)
+    if not isinstance(result,str):
+        raise RuntimeError(f'endpoint {name} returned {result!r}')
+    if result.startswith('Exception: '):
+        raise RuntimeError(f'endpoint {name}: {result}')
+    return base64.b64decode(result)
+
+
+def decode_sample(data):
+    """Steps, encoder ticks and control from the result of endpoint sample."""
+    return struct.unpack('<iif',data)
+
+
+def decode_stats(data):
+    """Statistics from the result of endpoint stats, as {'n':..., 'windows':..., 'e1':{'mean':...,...}, ..., 'limit1_sum':count, ...}."""
+    n, num_windows, num_channels, num_counters = struct.unpack_from('<4I',data)
+    values = np.frombuffer(data,'<f4',5*num_channels,16).reshape(num_channels,5)
+    counts = np.frombuffer(data,'<i4',num_counters,16+20*num_channels)
+    stats = {'n':n,'windows':num_windows}
+    for name,row in zip(STATS_CHANNELS,values):
+        stats[name] = dict(zip(('mean','std','min','max','rms'),row.tolist()))
+    stats.update(zip(STATS_COUNTERS,counts.tolist()))
+    return stats
+
+
+async def get_stats(serial_interface,previous=False):
+    """Running statistics of the board (of the previous window), see decode_stats."""
+    return decode_stats(await call_endpoint(serial_interface,'stats',bytes([previous])))
+
+
+def decode_log_chunk(data,num_samples=LOG_BUF_LEN):
+    """Array with the columns steps, encoder ticks, control and us since the previous sample from the result of endpoint log_chunk."""
+    chunk = np.empty((num_samples,4))
+    chunk[:,0] = np.frombuffer(data,'<i4',num_samples,0)
+    chunk[:,1] = np.frombuffer(data,'<i4',num_samples,4*num_samples)
+    chunk[:,2] = np.frombuffer(data,'<f4',num_samples,8*num_samples)
+    chunk[:,3] = np.frombuffer(data,'<u2',num_samples,12*num_samples)
+    return chunk
+
+
+def decode_capture(data):
+    """Array with the columns steps, encoder ticks, control and time (s) relative to the trigger from the result of endpoint capture."""
+    length, pre = struct.unpack_from('<HH',data)
+    capture = decode_log_chunk(data[4:],length)
+    capture[:,3] = np.cumsum(capture[:,3]) * 1e-6
+    capture[:,3] -= capture[pre,3]
+    return capture
+
+
+async def get_alarm(serial_interface):
+    """Last alarm of the L6474 on the board ({'t_us','status','alarms'}) or None, also sent as event when it happens."""
+    return await serial_eval(serial_interface,"supervisory['alarm']",priority=SAFETY)
+
+
+async def get_capture(serial_interface,poll=0.1,timeout=None):
+    """Wait until the capture armed on the board (see Capture.arm in ucapture.py) is ready and return it, see decode_capture."""
+    loop = asyncio.get_running_loop()
+    end = None if timeout is None else loop.time() + timeout
+    while await serial_eval(serial_interface,'capture.state') != 3: # READY
+        if (end is not None) and (loop.time() > end):
+            raise asyncio.TimeoutError('capture did not trigger')
+        await asyncio.sleep(poll)
+    return decode_capture(await call_endpoint(serial_interface,'capture'))
+
+
+async def get_log_chunk(serial_interface,buf,compress=False):
+    """Log buffer buf (0 or 1) of the board as array, see decode_log_chunk."""
+    if compress:
+        return decode_log_chunk_z(await call_endpoint(serial_interface,'log_chunk_z',bytes([buf]),priority=LOGGING),LOG_BUF_LEN)
+    return decode_log_chunk(await call_endpoint(serial_interface,'log_chunk',bytes([buf]),priority=LOGGING))
+
+
+async def log_samples(serial_interface,log_num_samples,progress=None,clock=None,compress=False,on_chunk=None):
+    """Log log_num_samples (a multiple of LOG_BUF_LEN) samples with the double buffers of mpy_edukit.
+
+    Returns an array with the columns stepper steps, encoder ticks, control
+    and time (s) of the sample on the board since the first sample, or in
+    time.monotonic of the host when a ClockSync of edukit_clock.py is given.
+    progress(num_buffers) is called after every received buffer. With
+    compress, the buffers are sent compressed (see edukit_codec.py), with
+    the control as float16. on_chunk(chunk) is called with every buffer as
+    it arrives (the fourth column in us since the previous sample), e.g. to
+    process the log while it streams in.
+    """
+    log = True
+    log0_prev = False
+    log1_prev = False
+    log_ready = False
+    log_buf_counter = 0
+    log_data = np.zeros((log_num_samples,4))
+
+    await serial_eval(serial_interface,f"supervisory['log_num_samples']={log_num_samples}",priority=LOGGING)
+    await serial_eval(serial_interface,f"supervisory['log_ready']={log_ready}",priority=LOGGING)
+    await serial_eval(serial_interface,f"supervisory['log']={log}",priority=LOGGING)
+    log, log0, log1 = await call_endpoint(serial_interface,'log_status',priority=LOGGING)
+    while log:
+        log0_prev = log0
+        log1_prev = log1
+        log, log0, log1 = await call_endpoint(serial_interface,'log_status',priority=LOGGING)
+        # detect True -> False changes:
+        if log0_prev and not log0: # log0 is finished
+            chunk = await get_log_chunk(serial_interface,0,compress)
+        elif log1_prev and not log1: # log1 is finished
+            chunk = await get_log_chunk(serial_interface,1,compress)
+        else:
+            await asyncio.sleep(round(0.1*LOG_BUF_LEN*SAMPLING_TIME))
+            continue
+        log_data[log_buf_counter*LOG_BUF_LEN:(log_buf_counter+1)*LOG_BUF_LEN,:] = chunk
+        log_buf_counter += 1
+        if on_chunk is not None:
+            on_chunk(chunk)
+        if progress is not None:
+            progress(log_buf_counter)
+    # the board logs the us since the previous sample
+    t_us = np.cumsum(log_data[:,3])
+    if clock is None:
+        log_data[:,3] = 1e-6*t_us
+    else:
+        log_t0_us = await serial_eval(serial_interface,"supervisory['log_t0_us']",priority=LOGGING)
+        log_data[:,3] = clock.device_to_host(log_t0_us + t_us)
+    return log_data
+
+
+async def stream_upload(serial_interface,data,target='reference',chunk_len=LOG_BUF_LEN,start=True,half=False):
+    """Stream trajectory data (e.g. a numpy array) to the reference or control excitation of the micropython board.
+
+    The chunks are sent as float32 with endpoint stream_put ahead of the playback, which
+    is started (reference_add or control_add) when both buffers are filled.
+    Returns the status (chunks_in, chunks_out, underruns, free, ended) of the stream.
+    The chunks are sent with LOGGING priority, so live plots cannot cause underruns.
+    With half, the chunks are sent as float16, in half the bytes.
+    """
+    data = np.ascontiguousarray(data,dtype='<f2' if half else '<f4').ravel()
+    stream = f"supervisory['{target}_generator']"
+    await serial_eval(serial_interface,f"set_{target}_excitation(Stream({chunk_len}))",priority=LOGGING)
+    free = 2
+    for i in range(0,len(data),chunk_len):
+        while free == 0:
+            # wait half a chunk before checking whether a buffer is released
+            await asyncio.sleep(0.5*chunk_len*SAMPLING_TIME)
+            free = await serial_eval(serial_interface,f"{stream}.free()",priority=LOGGING)
+        try:
+            free = (await call_endpoint(serial_interface,'stream_put',bytes([target == 'control',half]) + data[i:i+chunk_len].tobytes(),
+                                        priority=LOGGING))[0]
+        except RuntimeError as e: # exception, e.g. out of memory
+            return str(e)
+        if start and (free == 0):
+            await serial_eval(serial_interface,f"supervisory['{target}_add']=True",priority=LOGGING)
+            start = False
+    await serial_eval(serial_interface,f"{stream}.end()",priority=LOGGING)
+    if start: # trajectory fits in one buffer
+        await serial_eval(serial_interface,f"supervisory['{target}_add']=True",priority=LOGGING)
+    return await serial_eval(serial_interface,f"{stream}.status()",priority=LOGGING)
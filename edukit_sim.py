@@ -0,0 +1,168 @@
+#!/bin/env python3
+"""Batch closed-loop simulation of the pendulum with the PID controller, for tuning the gains.
+
+Thousands of gain sets Kp1, Ki1, Kd1, Kp2, Ki2, Kd2 are simulated at once
+along a batch dimension. The controller follows PID.control in ucontrol.py,
+including the anti-windup of limit(), and the control value is converted
+to a step rate as in L6474.set_period_direction. Batches are spread over a
+process pool and the candidates are ranked by a cost, so only the best
+few need to be tried on the hardware.
+
+Example at the Python prompt:
+    import edukit_sim as es
+    candidates = es.random_candidates([0,0,0,0,0,0], [2,0.01,5,20,0.1,50], 20000)
+    best, costs = es.optimize(candidates, r2=1200, alpha0=np.pi)
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+import os
+import time
+
+import numpy as np
+
+SAMPLING_TIME = 0.01
+TIMER_FREQ = 84e6 / (0x1a3 + 1) # clock of the step pulse timer: TIM3 of the F401 (84 MHz) over the prescaler of L6474.tim
+
+
+class PendulumModel():
+    """Pendulum on an arm that is driven by the stepper motor with a commanded step rate.
+
+    The pendulum angle alpha (0 is hanging down) follows
+        alpha'' = -omega0**2 sin(alpha) - damping alpha' - coupling cos(alpha) theta''
+    where theta is the arm angle. The stepper follows the step rate
+    instantaneously, so a change of the rate gives an impulse on alpha'.
+    """
+    def __init__(self, omega0=2*np.pi*1.2, damping=0.05, coupling=0.8,
+                 steps_per_rev=3200, ticks_per_rev=2400, timer_freq=TIMER_FREQ):
+        self.omega0 = omega0              # natural frequency hanging pendulum (rad/s)
+        self.damping = damping            # (1/s)
+        self.coupling = coupling          # arm radius / effective pendulum length
+        self.steps_per_rev = steps_per_rev  # microsteps per revolution of the arm (ABS_POS)
+        self.ticks_per_rev = ticks_per_rev  # encoder ticks per revolution of the pendulum
+        self.timer_freq = timer_freq      # clock of the step pulse timer (Hz)
+
+
+def step_rate(u, timer_freq=TIMER_FREQ):
+    """Microsteps per second for control u, quantized as by L6474.set_period_direction."""
+    u = np.asarray(u, dtype=float)
+    with np.errstate(divide='ignore'):
+        period = np.round(10000. / np.where(u == 0, 1., u))
+    # as on the device, the direction follows the sign of the rounded period,
+    # which is 0 (forward) for |u| > 20000
+    direction = np.where(np.abs(u) < 1, np.sign(u), np.where(period < 0, -1., 1.))
+    period = np.where(np.abs(u) < 1, 10000., np.clip(np.abs(period), 1, 10000))
+    # the timer counts from 0 to period and then toggles its output, so one step pulse takes 2 (period + 1) ticks
+    return np.where(u == 0, 0., direction * timer_freq / (2 * (period + 1)))
+
+
+def simulate(gains, model=None, num_samples=500, r1=0., r2=0., alpha0=0., limit1_sum=2**16, limit2_sum=2**16,
+             sampling_time=SAMPLING_TIME, substeps=10):
+    """Simulate the closed loop for gains (B,6) with columns Kp1, Ki1, Kd1, Kp2, Ki2, Kd2.
+
+    r1 and r2 are the references for the stepper steps and the encoder ticks
+    (scalars or arrays of num_samples), alpha0 the initial pendulum angle
+    (scalar or (B,)). Returns a dict with the arrays steps, ticks and u of
+    shape (B,num_samples), like the columns of a log.
+    """
+    if model is None:
+        model = PendulumModel()
+    gains = np.atleast_2d(np.asarray(gains, dtype=float))
+    batch = gains.shape[0]
+    Kp1, Ki1, Kd1, Kp2, Ki2, Kd2 = gains.T
+    r1 = np.broadcast_to(np.asarray(r1, dtype=float), (num_samples,))
+    r2 = np.broadcast_to(np.asarray(r2, dtype=float), (num_samples,))
+    step_angle = 2 * np.pi / model.steps_per_rev
+    tick_angle = 2 * np.pi / model.ticks_per_rev
+    h = sampling_time / substeps
+
+    position = np.zeros(batch)  # arm position in microsteps (continuous)
+    rate = np.zeros(batch)      # microsteps/s
+    alpha = np.full(batch, 1.) * alpha0
+    alpha_dot = np.zeros(batch)
+    e1_sum = np.zeros(batch)
+    e2_sum = np.zeros(batch)
+    y = np.zeros((2, batch))
+    out = {name: np.zeros((batch, num_samples)) for name in ('steps', 'ticks', 'u')}
+    for k in range(num_samples):
+        # sensors, as stepper.get_abs_pos_efficient() and encoder.value()
+        y_prev = y
+        y = np.stack([np.floor(position), np.floor(alpha / tick_angle)])
+        # PID.control with run, run1 and run2 True
+        e1 = r1[k] - y[0]
+        e2 = r2[k] - y[1]
+        e1_sum = np.clip(e1_sum + e1, -limit1_sum, limit1_sum)
+        e2_sum = np.clip(e2_sum + e2, -limit2_sum, limit2_sum)
+        u = (Kp1 * e1 + Ki1 * e1_sum - Kd1 * (y[0] - y_prev[0])
+             + Kp2 * e2 + Ki2 * e2_sum - Kd2 * (y[1] - y_prev[1]))
+        # set_period_direction: the rate changes at once, an impulse on the pendulum
+        new_rate = step_rate(u, model.timer_freq)
+        alpha_dot -= model.coupling * np.cos(alpha) * (new_rate - rate) * step_angle
+        rate = new_rate
+        for _ in range(substeps):  # semi-implicit Euler
+            alpha_dot += h * (-model.omega0**2 * np.sin(alpha) - model.damping * alpha_dot)
+            alpha += h * alpha_dot
+        position += rate * sampling_time
+        out['steps'][:, k] = y[0]
+        out['ticks'][:, k] = y[1]
+        out['u'][:, k] = u
+    return out
+
+
+def cost(result, r1=0., r2=0., weights=(1., 1., 1e-6), max_ticks_error=400.):
+    """Mean of weighted squared errors of steps and ticks and squared control, inf if the pendulum falls."""
+    e1 = np.asarray(r1) - result['steps']
+    e2 = np.asarray(r2) - result['ticks']
+    J = weights[0] * np.mean(e1**2, axis=-1) + weights[1] * np.mean(e2**2, axis=-1) + weights[2] * np.mean(result['u']**2, axis=-1)
+    fallen = np.any(np.abs(e2) > max_ticks_error, axis=-1)
+    return np.where(fallen | ~np.isfinite(J), np.inf, J)
+
+
+def simulate_cost(gains, model=None, weights=(1., 1., 1e-6), **kwargs):
+    """Cost of every gain set in gains (B,6), see simulate and cost."""
+    result = simulate(gains, model, **kwargs)
+    return cost(result, kwargs.get('r1', 0.), kwargs.get('r2', 0.), weights)
+
+
+def _simulate_cost_chunk(args):
+    gains, model, weights, kwargs = args
+    return simulate_cost(gains, model, weights, **kwargs)
+
+
+def random_candidates(low, high, num, seed=None):
+    """num gain sets drawn uniformly between low and high (6 values each)."""
+    rng = np.random.default_rng(seed)
+    return rng.uniform(low, high, (num, len(low)))
+
+
+def optimize(candidates, model=None, weights=(1., 1., 1e-6), top=10, processes=None, chunk_size=2000, **kwargs):
+    """Rank candidate gain sets (M,6) on their simulated cost, returns the top best gains and their costs.
+
+    The candidates are simulated in chunks of chunk_size in a pool of
+    processes (default the number of CPU cores); kwargs go to simulate.
+    """
+    candidates = np.atleast_2d(np.asarray(candidates, dtype=float))
+    chunks = [(candidates[i:i+chunk_size], model, weights, kwargs) for i in range(0, len(candidates), chunk_size)]
+    if processes == 1 or len(chunks) == 1:
+        costs = [_simulate_cost_chunk(chunk) for chunk in chunks]
+    else:
+        with ProcessPoolExecutor(max_workers=processes) as pool:
+            costs = list(pool.map(_simulate_cost_chunk, chunks))
+    costs = np.concatenate(costs)
+    order = np.argsort(costs)[:top]
+    return candidates[order], costs[order]
+
+
+def benchmark(num_candidates=20000, num_samples=300):
+    """Print the number of simulated closed loops per second, in one process and in the pool."""
+    candidates = random_candidates([0, 0, 0, 0, 0, 0], [2, 0.01, 5, 20, 0.1, 50], num_candidates, seed=0)
+    for processes in (1, None):
+        t0 = time.perf_counter()
+        best, costs = optimize(candidates, processes=processes, num_samples=num_samples, r2=1200., alpha0=np.pi)
+        elapsed = time.perf_counter() - t0
+        print(f'{processes or os.cpu_count()} process(es): {num_candidates} candidates of {num_samples} samples '
+              f'in {elapsed:.2f} s ({num_candidates/elapsed:.0f} /s), best cost {costs[0]:.4g}')
+    print('best gains (Kp1, Ki1, Kd1, Kp2, Ki2, Kd2):', np.round(best[0], 4).tolist())
+
+
+if __name__ == '__main__':
+    benchmark()
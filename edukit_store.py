@@ -0,0 +1,181 @@
+#!/bin/env python3
+"""Content-addressed store of logged experiments with an index for queries.
+
+Every run is saved as a .npy file named by the sha256 hash of its data and
+its parameter snapshot (ctrlparam, gains and settings of the controllers,
+the scalar settings in supervisory and the firmware hash). An sqlite index
+holds the snapshots, flattened to one row per parameter, so runs can be
+found without loading any data. Derived results (e.g. the metrics of
+edukit_analysis) are cached in the index as well.
+
+Example at the Python prompt:
+    from edukit_store import ExperimentStore
+    store = ExperimentStore()
+    hashes = store.find("pid.Kp1 > 2", "ctrlparam.type == 'state_space'")
+    metrics = store.analyze(hashes, reference=0)
+    log = store.load(hashes[0])
+"""
+
+import ast
+import datetime
+import glob
+import hashlib
+import json
+import os
+import re
+import sqlite3
+
+import numpy as np
+
+import edukit_analysis
+
+STORE_DIRECTORY = 'experiments'
+FIRMWARE_FILES = ['mpy_edukit.py', 'u*.py']  # micropython sources running on the board
+
+# evaluated on the board, gives the parameter snapshot of a run
+SNAPSHOT_COMMAND = ("{'ctrlparam':ctrlparam,"
+                    "'pid':{k:getattr(pid,k) for k in ('Kp1','Ki1','Kd1','Kp2','Ki2','Kd2','r1','r2','run','run1','run2','limit1_sum','limit2_sum','sampling_time_ms')},"
+                    "'ss':{k:getattr(ss,k) for k in ('A','B','C','gain','run','run_pid','Kp1','Ki1','Kd1','r1','r2')},"
+                    "'supervisory':{k:v for k,v in supervisory.items() if isinstance(v,(bool,int,float,str))},"
+                    "'generators':{k:type(supervisory[k+'_generator']).__name__ for k in ('reference','control')}}")
+
+_CONDITION = re.compile(r"^\s*([\w.\[\]'\"]+)\s*(<=|>=|==|!=|<|>|=)\s*(.+?)\s*$")
+
+
+def firmware_hash(directory=None):
+    """sha256 of the micropython sources in directory (default the directory of this file)."""
+    if directory is None:
+        directory = os.path.dirname(os.path.abspath(__file__))
+    h = hashlib.sha256()
+    for pattern in FIRMWARE_FILES:
+        for fname in sorted(glob.glob(os.path.join(directory, pattern))):
+            h.update(os.path.basename(fname).encode('utf-8'))
+            with open(fname, 'rb') as handle:
+                h.update(handle.read())
+    return h.hexdigest()
+
+
+async def device_snapshot(serial_interface):
+    """Parameter snapshot of the board, with the firmware hash."""
+    from edukit_serial import serial_eval
+    snapshot = await serial_eval(serial_interface, SNAPSHOT_COMMAND)
+    if not isinstance(snapshot, dict):
+        raise RuntimeError(f'no snapshot: {snapshot}')
+    snapshot['firmware'] = firmware_hash()
+    return snapshot
+
+
+def flatten(snapshot, prefix=''):
+    """Flatten nested dicts to {'pid.Kp1': value, ...}, lists are kept as json text."""
+    flat = {}
+    for key, value in snapshot.items():
+        name = prefix + str(key)
+        if isinstance(value, dict):
+            flat.update(flatten(value, name + '.'))
+        else:
+            flat[name] = value
+    return flat
+
+
+def analysis_key(reference=None, channel=edukit_analysis.STEPS):
+    """Name under which the metrics of edukit_analysis.analyze are cached."""
+    return f'analyze(reference={reference!r},channel={channel})'
+
+
+def content_hash(log_data, snapshot):
+    data = np.ascontiguousarray(log_data, dtype=float)
+    h = hashlib.sha256()
+    h.update(str(data.shape).encode('utf-8'))
+    h.update(data.tobytes())
+    h.update(json.dumps(snapshot, sort_keys=True, default=str).encode('utf-8'))
+    return h.hexdigest()
+
+
+class ExperimentStore():
+    """Logged runs saved as directory/data/<hash>.npy, indexed in directory/index.sqlite."""
+    def __init__(self, directory=STORE_DIRECTORY):
+        self.directory = directory
+        os.makedirs(os.path.join(directory, 'data'), exist_ok=True)
+        self.db = sqlite3.connect(os.path.join(directory, 'index.sqlite'))
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS runs (hash TEXT PRIMARY KEY, time TEXT, num_samples INTEGER, firmware TEXT, snapshot TEXT);
+            CREATE TABLE IF NOT EXISTS params (hash TEXT, name TEXT, value REAL, text TEXT);
+            CREATE INDEX IF NOT EXISTS params_name ON params (name, value);
+            CREATE TABLE IF NOT EXISTS analyses (hash TEXT, name TEXT, result TEXT, PRIMARY KEY (hash, name));
+            """)
+
+    def close(self):
+        self.db.close()
+
+    def path(self, hash_):
+        return os.path.join(self.directory, 'data', hash_ + '.npy')
+
+    def put(self, log_data, snapshot):
+        """Save a run with its parameter snapshot, returns its hash (saving the same run twice is a no-op)."""
+        hash_ = content_hash(log_data, snapshot)
+        if self.db.execute('SELECT 1 FROM runs WHERE hash=?', (hash_,)).fetchone():
+            return hash_
+        np.save(self.path(hash_), np.asarray(log_data, dtype=float))
+        rows = []
+        for name, value in flatten(snapshot).items():
+            if isinstance(value, (bool, int, float)):
+                rows.append((hash_, name, float(value), None))
+            else:
+                rows.append((hash_, name, None, value if isinstance(value, str) else json.dumps(value, default=str)))
+        with self.db:
+            self.db.execute('INSERT INTO runs VALUES (?,?,?,?,?)',
+                            (hash_, datetime.datetime.now().isoformat(timespec='seconds'), len(log_data),
+                             snapshot.get('firmware'), json.dumps(snapshot, default=str)))
+            self.db.executemany('INSERT INTO params VALUES (?,?,?,?)', rows)
+        return hash_
+
+    def load(self, hash_, mmap=True):
+        return edukit_analysis.load_log(self.path(hash_), mmap)
+
+    def snapshot(self, hash_):
+        row = self.db.execute('SELECT snapshot FROM runs WHERE hash=?', (hash_,)).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def find(self, *conditions):
+        """Hashes of the runs meeting all conditions, e.g. "pid.Kp1 > 2" or "ctrlparam.type == 'pid'"."""
+        query = 'SELECT hash FROM runs'
+        clauses, args = [], []
+        for condition in conditions:
+            match = _CONDITION.match(condition)
+            if match is None:
+                raise ValueError(f'condition {condition!r} is not of the form name <op> value')
+            name, op, value = match.groups()
+            op = '=' if op == '==' else op
+            try:
+                value = ast.literal_eval(value)
+            except (ValueError, SyntaxError):
+                pass # unquoted text
+            column = 'value' if isinstance(value, (bool, int, float)) else 'text'
+            clauses.append(f'hash IN (SELECT hash FROM params WHERE name=? AND {column} {op} ?)')
+            args += [name, float(value) if column == 'value' else value]
+        if clauses:
+            query += ' WHERE ' + ' AND '.join(clauses)
+        return [row[0] for row in self.db.execute(query + ' ORDER BY time', args)]
+
+    def cached(self, hash_, name):
+        row = self.db.execute('SELECT result FROM analyses WHERE hash=? AND name=?', (hash_, name)).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def cache(self, hash_, name, result):
+        with self.db:
+            self.db.execute('INSERT OR REPLACE INTO analyses VALUES (?,?,?)', (hash_, name, json.dumps(result)))
+
+    def analyze(self, hashes, reference=None, channel=edukit_analysis.STEPS):
+        """Metrics (edukit_analysis.analyze) of the runs, computed once and then taken from the cache."""
+        name = analysis_key(reference, channel)
+        results = {}
+        missing = []
+        for hash_ in hashes:
+            results[hash_] = self.cached(hash_, name)
+            if results[hash_] is None:
+                missing.append(hash_)
+        for hash_ in missing:
+            metrics = edukit_analysis.analyze(self.load(hash_), reference, channel)
+            results[hash_] = {key: None if np.isnan(value) else float(value) for key, value in metrics.items()}
+            self.cache(hash_, name, results[hash_])
+        return [results[hash_] for hash_ in hashes]
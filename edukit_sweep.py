@@ -0,0 +1,150 @@
+#!/bin/env python3
+"""Unattended parameter sweeps on the Edukit pendulum.
+
+A sweep is specified by a dict (or json file), e.g.
+    {
+        "parameters": {"Kp1": [0.05, 0.1, 0.2], "pid.Kd1": [0.0, 0.5]},
+        "setup": "set_control_excitation(PRBS(50.))",
+        "reset": "pid.reset_state()",
+        "settle": 1.0,
+        "num_samples": 384,
+        "reference": 0,
+        "channel": 0
+    }
+All combinations of the parameter values are run, or the list of dicts in
+"points" instead of "parameters". Names without a dot or bracket are
+attributes of pid. For every point the parameters are assigned and the
+controller state is reset in one command, after settle seconds the point is
+logged and saved. While the next point is logged, the previous one is
+analyzed (see edukit_analysis.py) in a pool of processes. The logs and a
+summary.json with the parameters and metrics of all points are saved in
+"directory" (default sweep_<datetime>). When a store is given (see
+edukit_store.py), every point is also saved there with the parameter
+snapshot of the board and its metrics are cached.
+
+Run from the command line with
+    python edukit_sweep.py spec.json
+or from the Python prompt of textual_mpy_edukit.py with
+    await run_sweep(micropython_serial_interface, spec)
+"""
+
+import argparse
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+import datetime
+import itertools
+import json
+import os
+import pickle
+
+import numpy as np
+
+import edukit_analysis
+from edukit_store import ExperimentStore, STORE_DIRECTORY, device_snapshot, analysis_key
+from edukit_serial import LOG_BUF_LEN, serial_eval, log_samples, open_board, close_board
+
+
+def sweep_points(spec):
+    """List of dicts with the parameter values of every point of the sweep."""
+    if 'points' in spec:
+        return [dict(point) for point in spec['points']]
+    names = list(spec['parameters'])
+    return [dict(zip(names, values)) for values in itertools.product(*spec['parameters'].values())]
+
+
+def point_command(point, reset='pid.reset_state()'):
+    """One micropython command that assigns the parameters of a point and resets the controller."""
+    statements = []
+    for name, value in point.items():
+        target = name if ('.' in name or '[' in name) else 'pid.' + name
+        statements.append(f'{target}={value!r}')
+    if reset:
+        statements.append(reset)
+    return ';'.join(statements)
+
+
+def analyze_point(fname, reference=None, channel=edukit_analysis.STEPS):
+    """Metrics of the log in fname as a dict of floats (None for nan), runs in a worker process."""
+    metrics = edukit_analysis.analyze(edukit_analysis.load_log(fname), reference, channel)
+    return {name: None if np.isnan(value) else float(value) for name, value in metrics.items()}
+
+
+async def run_sweep(serial_interface, spec, progress=None, processes=None, store=None):
+    """Run the sweep of spec (dict or json file name), returns the summary, a list of dicts per point.
+
+    progress(i, num_points) is called when point i is logged.
+    """
+    if isinstance(spec, str):
+        with open(spec) as handle:
+            spec = json.load(handle)
+    points = sweep_points(spec)
+    num_buffers = max(1, -(-spec.get('num_samples', 3*LOG_BUF_LEN) // LOG_BUF_LEN))
+    directory = spec.get('directory', 'sweep_' + datetime.datetime.now().strftime("%Y%m%d-%H%M%S"))
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, 'spec.json'), 'w') as handle:
+        json.dump(spec, handle, indent=2)
+
+    if spec.get('setup'):
+        await _checked_eval(serial_interface, spec['setup'])
+    loop = asyncio.get_running_loop()
+    analyses = []
+    fnames = []
+    hashes = []
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        for i, point in enumerate(points):
+            await _checked_eval(serial_interface, point_command(point, spec.get('reset', 'pid.reset_state()')))
+            if store is not None:
+                snapshot = await device_snapshot(serial_interface)
+            await asyncio.sleep(spec.get('settle', 0.))
+            log_data = await log_samples(serial_interface, num_buffers*LOG_BUF_LEN)
+            fname = os.path.join(directory, f'point_{i:04d}.pickle')
+            with open(fname, 'wb') as handle:
+                pickle.dump(log_data, handle, protocol=pickle.HIGHEST_PROTOCOL)
+            fnames.append(fname)
+            hashes.append(None if store is None else store.put(log_data, snapshot))
+            # analyze in the pool, while the next point is logged
+            analyses.append(loop.run_in_executor(pool, analyze_point, fname, spec.get('reference'),
+                                                 spec.get('channel', edukit_analysis.STEPS)))
+            if progress is not None:
+                progress(i+1, len(points))
+        if spec.get('teardown'):
+            await _checked_eval(serial_interface, spec['teardown'])
+        metrics = await asyncio.gather(*analyses)
+
+    if store is not None:
+        for hash_, point_metrics in zip(hashes, metrics):
+            store.cache(hash_, analysis_key(spec.get('reference'), spec.get('channel', edukit_analysis.STEPS)), point_metrics)
+    summary = [dict(parameters=point, file=fname, hash=hash_, **point_metrics)
+               for point, fname, hash_, point_metrics in zip(points, fnames, hashes, metrics)]
+    with open(os.path.join(directory, 'summary.json'), 'w') as handle:
+        json.dump(summary, handle, indent=2)
+    return summary
+
+
+async def _checked_eval(serial_interface, command):
+    response = await serial_eval(serial_interface, command)
+    if isinstance(response, str) and response.startswith('Exception: '):
+        raise RuntimeError(f'{command}: {response}')
+    return response
+
+
+async def main(args):
+    store = None if args.no_store else ExperimentStore(args.store)
+    ser = open_board(args.port)
+    try:
+        summary = await run_sweep(ser, args.spec, progress=lambda i, num: print(f'point {i}/{num} logged'),
+                                  processes=args.processes, store=store)
+    finally:
+        close_board(ser)
+    for row in summary:
+        print(row['parameters'], {name: value for name, value in row.items() if name not in ('parameters', 'file', 'hash')})
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run a parameter sweep on the Edukit pendulum.')
+    parser.add_argument('spec', help='json file with the sweep specification')
+    parser.add_argument('--port', default=None, help='serial port (default the first STMicroelectronics board)')
+    parser.add_argument('--processes', type=int, default=None, help='number of analysis processes')
+    parser.add_argument('--store', default=STORE_DIRECTORY, help='directory of the experiment store')
+    parser.add_argument('--no-store', action='store_true', help='do not save the points in the experiment store')
+    asyncio.run(main(parser.parse_args()))
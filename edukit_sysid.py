@@ -0,0 +1,176 @@
+#!/bin/env python3
+"""Least-squares identification of ARX and ARMAX models from logged experiments.
+
+The models are
+    A(q) y(t) = B(q) u(t-nk) + C(q) e(t)
+with A(q) = 1 + a1 q^-1 + ... + a_na q^-na, B(q) = b1 + ... + b_nb q^-(nb-1)
+and for ARX C(q) = 1. The regressors are built with strided views of the
+data, and all model orders are solved at once from one Gram matrix.
+
+Example at the Python prompt, for a log of a PRBS experiment on the control:
+    import edukit_sysid as si
+    u, y = log_data[:,2], log_data[:,1]
+    table = si.arx_order_selection(u, y, range(1,6), range(1,6))
+    model = si.arx(u, y, 2, 2)
+    A, B, C = model.state_space()
+    await serial_eval(micropython_serial_interface, si.state_space_command(A, B, C))
+"""
+
+import itertools
+import time
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+SAMPLING_TIME = 0.01
+
+
+class ARXModel():
+    """Identified model A(q) y(t) = B(q) u(t-nk) + C(q) e(t)."""
+    def __init__(self, a, b, nk=1, c=(), sampling_time=SAMPLING_TIME, noise_variance=np.nan):
+        self.a = np.asarray(a, dtype=float)  # a1 ... a_na
+        self.b = np.asarray(b, dtype=float)  # b1 ... b_nb
+        self.c = np.asarray(c, dtype=float)  # c1 ... c_nc (ARMAX only)
+        self.nk = nk
+        self.sampling_time = sampling_time
+        self.noise_variance = noise_variance
+
+    def __repr__(self):
+        return f'ARXModel(a={self.a.tolist()}, b={self.b.tolist()}, nk={self.nk}, c={self.c.tolist()})'
+
+    def predict(self, u, y):
+        """One-step-ahead prediction of y (ignoring the noise model), nan for the first samples."""
+        na, nb = len(self.a), len(self.b)
+        phi, _, start = regressors(u, y, na, nb, self.nk)
+        y_hat = np.full(len(y), np.nan)
+        y_hat[start:] = phi @ np.concatenate([self.a, self.b])
+        return y_hat
+
+    def poles(self):
+        return np.roots(np.concatenate([[1.], self.a]))
+
+    def state_space(self):
+        """Observer canonical form x(t+1) = A x(t) + B u(t), y(t) = C x(t) of the deterministic part."""
+        # B(q) q^-nk / A(q) as a strictly proper transfer function of order n
+        n = max(len(self.a), len(self.b) + self.nk - 1)
+        den = np.zeros(n)
+        den[:len(self.a)] = self.a
+        num = np.zeros(n)
+        num[self.nk-1:self.nk-1+len(self.b)] = self.b
+        A = np.zeros((n, n))
+        A[:, 0] = -den
+        A[:-1, 1:] = np.eye(n-1)
+        C = np.zeros(n)
+        C[0] = 1.
+        return A, num.copy(), C
+
+
+def regressors(u, y, na, nb, nk=1, start=None):
+    """Regressor matrix phi (rows [-y(t-1) ... -y(t-na), u(t-nk) ... u(t-nk-nb+1)]), targets y(t) and first t."""
+    u = np.asarray(u, dtype=float)
+    y = np.asarray(y, dtype=float)
+    if start is None:
+        start = max(na, nb + nk - 1)
+    num = len(y) - start
+    # windows of past values, reversed so the most recent value comes first
+    y_past = sliding_window_view(y[start-na:len(y)-1], na)[:num, ::-1] if na else np.empty((num, 0))
+    u_past = sliding_window_view(u[start-nk-nb+1:len(u)-nk+1], nb)[:num, ::-1] if nb else np.empty((num, 0))
+    return np.hstack([-y_past, u_past]), y[start:], start
+
+
+def arx(u, y, na, nb, nk=1, sampling_time=SAMPLING_TIME):
+    """Least-squares ARX model of orders na, nb and delay nk."""
+    phi, target, _ = regressors(u, y, na, nb, nk)
+    theta, *_ = np.linalg.lstsq(phi, target, rcond=None)
+    residual = target - phi @ theta
+    return ARXModel(theta[:na], theta[na:], nk, sampling_time=sampling_time, noise_variance=np.var(residual))
+
+
+def armax(u, y, na, nb, nc, nk=1, iterations=10, sampling_time=SAMPLING_TIME):
+    """ARMAX model by extended least squares: residuals of the previous iteration are the noise regressors."""
+    u = np.asarray(u, dtype=float)
+    y = np.asarray(y, dtype=float)
+    start = max(na, nb + nk - 1, nc)
+    phi, target, _ = regressors(u, y, na, nb, nk, start)
+    e = np.zeros(len(y))
+    for _ in range(iterations):
+        e_past = sliding_window_view(e[start-nc:len(e)-1], nc)[:, ::-1]
+        theta, *_ = np.linalg.lstsq(np.hstack([phi, e_past]), target, rcond=None)
+        e[start:] = target - np.hstack([phi, e_past]) @ theta
+    return ARXModel(theta[:na], theta[na:na+nb], nk, theta[na+nb:], sampling_time, np.var(e[start:]))
+
+
+def arx_order_selection(u, y, na_range, nb_range, nk=1, folds=5, sampling_time=SAMPLING_TIME):
+    """Cross-validated ARX models for all combinations of orders in na_range and nb_range.
+
+    The data are split in contiguous folds, every model is estimated on all
+    but one fold and validated with the one-step prediction error on that
+    fold. All models and folds are solved as one batch from the Gram matrices
+    of the folds. Returns a list of (cv_mse, na, nb, model) sorted on cv_mse,
+    where model is estimated on all data.
+    """
+    na_range, nb_range = list(na_range), list(nb_range)
+    na_max, nb_max = max(na_range), max(nb_range)
+    phi, target, _ = regressors(u, y, na_max, nb_max, nk)
+    num_par = na_max + nb_max
+    fold_len = len(target) // folds
+    phi_f = phi[:folds*fold_len].reshape(folds, fold_len, num_par)
+    target_f = target[:folds*fold_len].reshape(folds, fold_len)
+    gram_f = np.einsum('fti,ftj->fij', phi_f, phi_f)
+    rhs_f = np.einsum('fti,ft->fi', phi_f, target_f)
+    yy_f = np.einsum('ft,ft->f', target_f, target_f)
+    gram, rhs = gram_f.sum(axis=0), rhs_f.sum(axis=0)
+
+    orders = list(itertools.product(na_range, nb_range))
+    mask = np.zeros((len(orders), num_par), dtype=bool)  # regressors used by each model
+    for m, (na, nb) in enumerate(orders):
+        mask[m, :na] = True
+        mask[m, na_max:na_max+nb] = True
+    used = mask[:, :, None] & mask[:, None, :]
+    eye = np.eye(num_par)
+
+    def solve(G, r):
+        # batch (models, folds): unused regressors get an identity block and
+        # zero right-hand side, so their parameters are zero
+        G = np.where(used[:, None], G[None], eye)
+        r = np.where(mask[:, None], r[None], 0.)
+        return np.linalg.solve(G, r[..., None])[..., 0]
+
+    # trained on the complement of each fold
+    theta = solve(gram - gram_f, rhs - rhs_f)
+    sse = yy_f - 2 * np.einsum('mfi,fi->mf', theta, rhs_f) + np.einsum('mfi,fij,mfj->mf', theta, gram_f, theta)
+    cv_mse = sse.sum(axis=1) / (folds * fold_len)
+    theta_all = solve(gram[None], rhs[None])[:, 0]
+    table = []
+    for m, (na, nb) in enumerate(orders):
+        residual_var = (target @ target - 2 * theta_all[m] @ rhs + theta_all[m] @ gram @ theta_all[m]) / len(target)
+        model = ARXModel(theta_all[m, :na], theta_all[m, na_max:na_max+nb], nk,
+                         sampling_time=sampling_time, noise_variance=residual_var)
+        table.append((cv_mse[m], na, nb, model))
+    table.sort(key=lambda row: row[0])
+    return table
+
+
+def state_space_command(A, B, C, name='ss'):
+    """Micropython command that loads (A,B,C) in the state-space controller name."""
+    A = np.atleast_2d(A)
+    return f'{name}.set_model({np.round(A, 9).tolist()},{np.round(np.ravel(B), 9).tolist()},{np.round(np.ravel(C), 9).tolist()})'
+
+
+def benchmark(num_samples=100_000, orders=range(1, 7)):
+    """Print the time to identify and cross-validate all ARX orders on a simulated PRBS experiment."""
+    rng = np.random.default_rng(0)
+    u = np.repeat(rng.choice([-1., 1.], num_samples // 4 + 1), 4)[:num_samples]
+    e = rng.normal(0., 0.05, num_samples)
+    y = np.zeros(num_samples)
+    for t in range(2, num_samples):  # simulate a lightly damped second order plant
+        y[t] = 1.6 * y[t-1] - 0.8 * y[t-2] + 0.5 * u[t-1] + 0.3 * u[t-2] + e[t]
+    t0 = time.perf_counter()
+    table = arx_order_selection(u, y, orders, orders)
+    elapsed = time.perf_counter() - t0
+    print(f'{len(table)} ARX models, {num_samples} samples, 5-fold cross-validation in {elapsed*1e3:.0f} ms')
+    print(f'best: na={table[0][1]}, nb={table[0][2]}, {table[0][3]}')
+
+
+if __name__ == '__main__':
+    benchmark()
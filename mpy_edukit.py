@@ -3,21 +3,26 @@ import micropython
 from micropython import const
 from machine import Pin
 from pyb import Timer, freq
-from time import sleep_ms, sleep_us, ticks_us, ticks_diff, ticks_ms
-from random import random
+from time import sleep_ms, sleep_us, ticks_us, ticks_diff, ticks_ms, ticks_add
 import gc
 import array
+from struct import pack_into, unpack, unpack_from
 
 import asyncio
 
 from uencoder import Encoder
-from ucontrol import PID, StateSpace
-from uL6474 import L6474
-from urepl import repl
+from ucontrol import PID, StateSpace, MultiRate, PIDStage, ExplicitMPC, RelayTuner
+from uexcite import Square, PRBS, Chirp, Multisine, Sequence, Stream
+from uL6474 import L6474, decode_status
+from urepl import repl, register, endpoint_ids, send_event
+from ucodec import encode_deltas, encode_half
+from ustats import RunningStats
+from ucapture import Capture, LIMIT
 
 MEMORY_THRESHOLD = const(50000) # total is about 61248
 
 gc.threshold(MEMORY_THRESHOLD)
+micropython.alloc_emergency_exception_buf(100) # for errors in the interrupt of FLAG
 
 LOG_BUF_LEN = const(128)
 
@@ -45,7 +50,7 @@ ctrlparam['Kd2'] = 0.
 ctrlparam['A'] = [[0.,0.],[0.,0.]]
 ctrlparam['B'] = [0.,0.]
 ctrlparam['C'] = [0.,0.]
-ctrlparam['type'] = 'pid' # can also be state_space
+ctrlparam['type'] = 'pid' # name of the active controller in controllers, e.g. state_space or multi_rate
 
 supervisory = {}
 s = supervisory # make alias for easier reference in repl
@@ -65,12 +70,12 @@ supervisory['reference_add'] = False
 supervisory['reference_repeat'] = True
 supervisory['reference_counter'] = 0
 supervisory['reference_num_samples'] = supervisory['record_num_samples']
-supervisory['reference_sequence'] = array.array('f',[0. for _ in range(supervisory['reference_num_samples'])])
+supervisory['reference_generator'] = Square()
 supervisory['control_add'] = False
 supervisory['control_repeat'] = True
 supervisory['control_counter'] = 0
 supervisory['control_num_samples'] = supervisory['record_num_samples']
-supervisory['control_sequence'] = array.array('f',[0. for _ in range(supervisory['control_num_samples'])])
+supervisory['control_generator'] = Square()
 supervisory['log'] = False
 supervisory['log_ready'] = True
 supervisory['log_num_samples'] = 0
@@ -81,59 +86,109 @@ supervisory['log0_data'] = [
     array.array('i',[0  for _ in range(LOG_BUF_LEN)]),
     array.array('i',[0  for _ in range(LOG_BUF_LEN)]),
     array.array('f',[0. for _ in range(LOG_BUF_LEN)]),
+    array.array('H',[0  for _ in range(LOG_BUF_LEN)]), # us since previous sample
     ]
 supervisory['log1_data'] = [
     array.array('i',[0  for _ in range(LOG_BUF_LEN)]),
     array.array('i',[0  for _ in range(LOG_BUF_LEN)]),
     array.array('f',[0. for _ in range(LOG_BUF_LEN)]),
+    array.array('H',[0  for _ in range(LOG_BUF_LEN)]),
     ]
+supervisory['log_t0_us'] = 0 # ticks_us of the first sample of the log
+supervisory['log_prev_us'] = 0
 supervisory['log_state'] = ''
+supervisory['stats'] = False # update stats every tick
+supervisory['controller'] = None # active controller, resolved from ctrlparam['type'] when it changes
+supervisory['controller_type'] = ''
+supervisory['alarm'] = None # last alarm of the L6474: {'t_us','status','alarms'}
+supervisory['num_alarms'] = 0
 
 
+def set_control_excitation(generator,num_samples=0):
+    """Add generator to the control, num_samples = 0 runs it endlessly (otherwise see control_repeat)."""
+    generator.reset()
+    supervisory['control_generator'] = generator
+    supervisory['control_num_samples'] = num_samples
+    supervisory['control_counter'] = 0
+
+def set_reference_excitation(generator,num_samples=0):
+    """Add generator to the reference r1, num_samples = 0 runs it endlessly (otherwise see reference_repeat)."""
+    generator.reset()
+    supervisory['reference_generator'] = generator
+    supervisory['reference_num_samples'] = num_samples
+    supervisory['reference_counter'] = 0
+
 def set_control_sequence(std_noise=0.,height1=0.,height2=0.,duration=100):
-    for i in range(supervisory['control_num_samples']):
-        if i < duration:
-            supervisory['control_sequence'][i] = 1.*height1 + std_noise*random()
-        else:
-            supervisory['control_sequence'][i] = 1.*height2 + std_noise*random()
+    num_samples = supervisory['record_num_samples']
+    set_control_excitation(Square(height1,height2,duration,num_samples,std_noise),num_samples)
 
 def set_reference_sequence(std_noise=0.,height1=0.,height2=0.,duration=100):
-    for i in range(supervisory['reference_num_samples']):
-        if i < duration:
-            supervisory['reference_sequence'][i] = 1.*height1 + std_noise*random()
-        else:
-            supervisory['reference_sequence'][i] = 1.*height2 + std_noise*random()
+    num_samples = supervisory['record_num_samples']
+    set_reference_excitation(Square(height1,height2,duration,num_samples,std_noise),num_samples)
+
+
+controllers = {} # name: controller, the choices of ctrlparam['type']
+
+def register_controller(name,controller):
+    controllers[name] = controller
+
+def select_controller(name):
+    """Make controllers[name] the active controller, initialized from the control of the previous one (bumpless)."""
+    controller = controllers[name]
+    previous = supervisory['controller']
+    if (previous is not None) and (controller is not previous):
+        controller.bumpless(previous.y,previous.u * getattr(previous,'gain',1.)) # state_space sends gain * u
+    supervisory['controller'] = controller
+    supervisory['controller_type'] = name
+    ctrlparam['type'] = name
+    return controller
+
+def active_controller():
+    return supervisory['controller']
 
 
 @micropython.native
 def get_both_sensors(stepper,encoder):
     # bind the functions
     steps_fun = stepper.get_abs_pos_efficient #get_param()
+    count_fun = stepper.get_abs_pos_counted # without SPI, after stepper.start_counting()
     enc_fun = encoder.value
     def fun():
-        steps = steps_fun()
+        steps = count_fun() if stepper.count_steps else steps_fun()
         enc_value = enc_fun()
         return [steps, enc_value]
     return fun
 
 
 @micropython.native
-async def control(controller1,controller2):
+async def control():
     ctrlp = ctrlparam
     supervis = supervisory
+    next_us = ticks_us() # deadline of the next sample, in us so 1 ms sampling keeps 1 kHz on average
     while True:
-        t0_ms = ticks_ms()
-        
-        if ctrlp['type'] == 'pid':
-            controller = controller1
-        elif ctrlp['type'] == 'state_space':
-            controller = controller2
-        else:
-            controller = controller1 # default to pid
-            
+        if ctrlp['type'] != supervis['controller_type']: # selection changed
+            if ctrlp['type'] in controllers:
+                select_controller(ctrlp['type'])
+            else:
+                ctrlp['type'] = supervis['controller_type'] # unknown, keep the active controller
+        controller = supervis['controller']
+
+        t_us = ticks_us() # time of the sample
         await controller.control()
         #async with supervis['lock']:
         supervis['counter'] += 1
+        if capture.armed:
+            event = (getattr(controller,'limit1_sum_flag',False) or getattr(controller,'limit2_sum_flag',False)) if capture.mode == LIMIT else controller.log < 0
+            capture.add(controller.sample[0],controller.sample[1],controller.sample[2],t_us,event)
+        if supervis['stats']:
+            stats_values[0] = getattr(controller,'e1',0)
+            stats_values[1] = getattr(controller,'e2',0)
+            stats_values[2] = controller.sample[2]
+            stats.add(stats_values)
+            if getattr(controller,'limit1_sum_flag',False):
+                stats.count(0)
+            if getattr(controller,'limit2_sum_flag',False):
+                stats.count(1)
         if supervis['record']:
             if supervis['record_counter'] >= supervis['record_num_samples']:
                 supervis['record'] = False
@@ -158,6 +213,16 @@ async def control(controller1,controller2):
             else:
                 supervis['log_ready'] = False
 
+                # timestamp, as the time since the previous sample (saturated at 65535 us)
+                if log_counter == 0:
+                    supervis['log_t0_us'] = t_us
+                    dt_us = 0
+                else:
+                    dt_us = ticks_diff(t_us,supervis['log_prev_us'])
+                    if dt_us > 65535:
+                        dt_us = 65535
+                supervis['log_prev_us'] = t_us
+
                 # following 2 if statements guarantee that log0 is active 0 ... LOG_BUF_LEN and log1 from LOG_BUF_LEN + 1 ... 2 * LOG_BUF_LEN
                 if log_counter % LOG_BUF_LEN == 0:
                     if log_counter % (2*LOG_BUF_LEN) == 0:
@@ -171,27 +236,201 @@ async def control(controller1,controller2):
                 if supervis['log0']: # log buffer 0                    
                     supervis['log0_data'][0][counter] = controller.sample[0]
                     supervis['log0_data'][1][counter] = controller.sample[1]
-                    supervis['log0_data'][2][counter] = controller.sample[2]                    
+                    supervis['log0_data'][2][counter] = controller.sample[2]
+                    supervis['log0_data'][3][counter] = dt_us
                 elif supervis['log1']: # log buffer 1
                     supervis['log1_data'][0][counter] = controller.sample[0]
                     supervis['log1_data'][1][counter] = controller.sample[1]
-                    supervis['log1_data'][2][counter] = controller.sample[2]                    
+                    supervis['log1_data'][2][counter] = controller.sample[2]
+                    supervis['log1_data'][3][counter] = dt_us
                 else:
                     supervis['log_state'] = 'error: cannot log0 and log1'
                     
                 supervis['log_counter'] += 1
-        remaining_time = controller.sampling_time_ms - ticks_diff(ticks_ms(),t0_ms)
-        if remaining_time>0:
+        next_us = ticks_add(next_us,1000*controller.sampling_time_ms)
+        remaining_us = ticks_diff(next_us,ticks_us())
+        if remaining_us>=0:
             controller.log = 0
-            await asyncio.sleep_ms(remaining_time)
+            await asyncio.sleep_ms(remaining_us // 1000) # sleep_ms rounds down, yield until the deadline for the rest
+            while ticks_diff(next_us,ticks_us()) > 0:
+                await asyncio.sleep_ms(0)
         else:
-            controller.log = remaining_time
+            controller.log = remaining_us // 1000 # negative, ms too late
+            next_us = ticks_us() # no burst of samples to catch up
+
+
+rate_mark = [0, 0] # counter and ticks_us of the previous call of loop_rate
+
+def loop_rate():
+    """Samples per second of the control loop since the previous call, call it twice (e.g. one second apart) to measure the rate."""
+    counter = supervisory['counter']
+    t_us = ticks_us()
+    rate = 1e6 * (counter - rate_mark[0]) / max(ticks_diff(t_us,rate_mark[1]),1)
+    rate_mark[0] = counter
+    rate_mark[1] = t_us
+    return rate
 
 
 pid = PID(get_both_sensors(stepper,encoder),stepper.set_period_direction,ctrlparam['sampling_time_ms'],ctrlparam['Kp1'],ctrlparam['Ki1'],ctrlparam['Kd1'],ctrlparam['Kp2'],ctrlparam['Ki2'],ctrlparam['Kd2'],0,0,0,0,0,0,2**16,2**16,False,True,True,supervisory)
 
 ss = StateSpace(get_both_sensors(stepper,encoder),stepper.set_period_direction,ctrlparam['sampling_time_ms'],ctrlparam['A'],ctrlparam['B'],ctrlparam['C'],False,supervisory)
 
+# pendulum loop every ms, arm loop every 10 ms, their outputs (slots 0 and 1) are added as the control
+mr = MultiRate(get_both_sensors(stepper,encoder),stepper.set_period_direction,1,4,(0,1),False,supervisory)
+mr.add_stage(PIDStage(1,out_slot=0),1)
+mr.add_stage(PIDStage(0,out_slot=1),10)
+
+# explicit MPC, the law is loaded by edukit_mpc.py
+empc = ExplicitMPC(get_both_sensors(stepper,encoder),stepper.set_period_direction,ctrlparam['sampling_time_ms'],False,supervisory)
+
+# relay auto-tuner of the pid loops, see autotune
+relay = RelayTuner(get_both_sensors(stepper,encoder),stepper.set_period_direction,ctrlparam['sampling_time_ms'],supervisory)
+
+register_controller('pid',pid)
+register_controller('state_space',ss)
+register_controller('multi_rate',mr)
+register_controller('explicit_mpc',empc)
+register_controller('relay',relay)
+select_controller(ctrlparam['type'])
+
+
+def autotune(channel=1,amplitude=200.,hysteresis=5,apply=False,**kwargs):
+    """Tune pid loop channel (0 arm, 1 pendulum) with the relay, then the active controller takes over again.
+
+    The result is in relay.result, with apply the gains are set in pid (set_gains1 or set_gains2).
+    kwargs are passed to relay.start (r, num_periods, skip, rule, sign, max_ticks)."""
+    previous = supervisory['controller_type']
+    if previous == 'relay':
+        previous = 'pid'
+    def done(tuner):
+        if apply and ('Kp' in tuner.result):
+            set_gains = pid.set_gains1 if channel == 0 else pid.set_gains2
+            set_gains(tuner.result['Kp'],tuner.result['Ki'],tuner.result['Kd'])
+        select_controller(previous)
+    relay.on_done = done
+    select_controller('relay')
+    relay.start(channel,amplitude,hysteresis,**kwargs)
+
+
+# statistics of the tracking errors e1 and e2 and the control, and counts of the saturation of the integrators of pid
+stats = RunningStats(3,2)
+stats_values = array.array('f',[0.,0.,0.])
+
+# triggered capture of the samples, see capture.arm
+capture = Capture(256)
+
+
+# endpoints, called by the host with binary arguments and results (see call_endpoint in edukit_serial.py)
+sample_bytes = bytearray(12)
+
+def endpoint_sample(args):
+    """Sample of the active controller as int32 steps, int32 encoder ticks and float32 control."""
+    controller = supervisory['controller']
+    pack_into('<iif',sample_bytes,0,int(controller.sample[0]),int(controller.sample[1]),controller.sample[2])
+    return sample_bytes
+
+def endpoint_log_status(args):
+    return bytes((supervisory['log'],supervisory['log0'],supervisory['log1']))
+
+def endpoint_log_chunk(args):
+    """Log buffer args[0] as LOG_BUF_LEN int32 steps, int32 encoder ticks, float32 control and uint16 us since previous sample."""
+    data = supervisory['log1_data'] if args[0] else supervisory['log0_data']
+    return bytes(data[0]) + bytes(data[1]) + bytes(data[2]) + bytes(data[3])
+
+log_z_bytes = bytearray(LOG_BUF_LEN*(3*5+2)) # longest compressed log buffer
+
+def endpoint_log_chunk_z(args):
+    """Log buffer args[0] compressed: zig-zag delta varints of steps, encoder ticks and us since previous sample, float16 control."""
+    data = supervisory['log1_data'] if args[0] else supervisory['log0_data']
+    pos = encode_deltas(data[0],LOG_BUF_LEN,log_z_bytes,0)
+    pos = encode_deltas(data[1],LOG_BUF_LEN,log_z_bytes,pos)
+    pos = encode_deltas(data[3],LOG_BUF_LEN,log_z_bytes,pos)
+    pos = encode_half(data[2],LOG_BUF_LEN,log_z_bytes,pos)
+    return memoryview(log_z_bytes)[:pos]
+
+ticks_bytes = bytearray(4)
+
+def endpoint_ticks(args):
+    """ticks_us() as uint32, for the clock synchronization of the host."""
+    pack_into('<I',ticks_bytes,0,ticks_us())
+    return ticks_bytes
+
+def endpoint_set_gains(args):
+    """Set the pid gains Kp1, Ki1, Kd1, Kp2, Ki2, Kd2 from 6 float32."""
+    gains = unpack('<6f',args)
+    pid.set_gains1(gains[0],gains[1],gains[2])
+    pid.set_gains2(gains[3],gains[4],gains[5])
+    return b''
+
+def endpoint_load_model(args):
+    """Load name, 0, uint8 order n, float32 gain, r2, A (by rows), B and C in the StateSpace controllers[name], see edukit_design.py."""
+    sep = args.find(b'\x00')
+    controller = controllers[str(args[:sep],'utf-8')]
+    n = args[sep+1]
+    gain, r2 = unpack_from('<2f',args,sep+2)
+    values = unpack_from('<%df' % (n*n+2*n),args,sep+10)
+    controller.set_model([list(values[i*n:(i+1)*n]) for i in range(n)],list(values[n*n:n*n+n]),list(values[n*n+n:]))
+    controller.gain = gain
+    controller.r2 = r2
+    return b''
+
+def endpoint_load_table(args):
+    """Write name, 0, uint32 offset and float32 values in the table of the ExplicitMPC controllers[name] from offset."""
+    sep = args.find(b'\x00')
+    table = controllers[str(args[:sep],'utf-8')].table
+    offset = unpack_from('<I',args,sep+1)[0]
+    values = unpack_from('<%df' % ((len(args)-sep-5)//4),args,sep+5)
+    for i in range(len(values)):
+        table[offset+i] = values[i]
+    return b''
+
+def endpoint_stats(args):
+    """Statistics of stats (args[0] = 1 the previous window), see RunningStats.pack."""
+    return stats.pack(args[0])
+
+def endpoint_capture(args):
+    """Samples of capture, see Capture.pack."""
+    return capture.pack()
+
+def endpoint_stream_put(args):
+    """Chunk for the Stream of the reference (args[0] = 0) or control (1), float16 if args[1] = 1, returns the number of free buffers (uint8)."""
+    generator = supervisory['control_generator' if args[0] else 'reference_generator']
+    return bytes([generator.put_bytes(memoryview(args)[2:],args[1])])
+
+register('sample',endpoint_sample)
+register('log_status',endpoint_log_status)
+register('log_chunk',endpoint_log_chunk)
+register('set_gains',endpoint_set_gains)
+register('ticks',endpoint_ticks)
+register('log_chunk_z',endpoint_log_chunk_z)
+register('load_model',endpoint_load_model)
+register('load_table',endpoint_load_table)
+register('stats',endpoint_stats)
+register('capture',endpoint_capture)
+register('stream_put',endpoint_stream_put)
+
+
+def stop_all():
+    """Stop all controllers and the excitation of the control, and the stepper."""
+    for controller in controllers.values():
+        controller.run = False
+    supervisory['control_add'] = False
+    stepper.set_period_direction(0)
+
+async def alarm_control():
+    """Wait for the interrupt of FLAG of the L6474, then read STATUS once, stop and send an alarm event to the host."""
+    stepper.enable_alarm_irq()
+    while True:
+        await stepper.alarm_flag.wait()
+        status = stepper.get_status() # also releases FLAG
+        alarms = decode_status(status)
+        if alarms: # not for e.g. only a change of DIR
+            stop_all()
+        alarm = {'event':'alarm','t_us':stepper.alarm_us,'status':status,'alarms':alarms}
+        supervisory['alarm'] = alarm
+        supervisory['num_alarms'] = stepper.num_alarms
+        send_event(alarm)
+
 
 @micropython.native
 async def garbage_control(sleep_ms):
@@ -203,11 +442,14 @@ async def garbage_control(sleep_ms):
 
 async def main():
     garbage_task = asyncio.create_task(garbage_control(1000))
-    control_task = asyncio.create_task(control(pid,ss))
+    control_task = asyncio.create_task(control())
+    alarm_task = asyncio.create_task(alarm_control())
     repl_task = asyncio.create_task(repl(globals()))
 
     await repl_task
     # if repl is stopped, also stop the other tasks:
+    alarm_task.cancel()
+    stepper.disable_alarm_irq()
     control_task.cancel()
     garbage_task.cancel()
     #await asyncio.gather(control_task, repl_task)
@@ -0,0 +1,28 @@
+#!/bin/env python3
+"""Serve textual_mpy_edukit.py in the browser, for any number of viewers of one board.
+
+Every browser session runs its own textual_mpy_edukit.py, connected to the
+board through the multiplexer edukit_mux.py. The plots of all sessions are
+fed by one shared telemetry subscription in the multiplexer, so more
+viewers do not add traffic on the serial link. Start the multiplexer first:
+    python edukit_mux.py
+    python serve_edukit.py --host 0.0.0.0 --port 8000
+"""
+
+import argparse
+import sys
+
+from textual_serve.server import Server
+
+from edukit_mux import MUX_ADDRESS
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve the Edukit user interface in the browser.')
+    parser.add_argument('--mux', default=MUX_ADDRESS, help='host:port of edukit_mux.py')
+    parser.add_argument('--host', default='localhost', help='host of the web server')
+    parser.add_argument('--port', type=int, default=8000, help='port of the web server')
+    args = parser.parse_args()
+    server = Server(f'{sys.executable} textual_mpy_edukit.py --mux {args.mux}', host=args.host, port=args.port,
+                    title='Edukit Pendulum Control')
+    server.serve()
@@ -0,0 +1,77 @@
+"""Host test of the controllers of ucontrol.py."""
+
+import asyncio
+import os
+import sys
+import time
+import types
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+micropython = types.ModuleType('micropython')
+micropython.const = lambda value: value
+micropython.native = lambda function: function
+sys.modules.setdefault('micropython', micropython)
+if not hasattr(time, 'ticks_us'): # the time module of micropython
+    time.ticks_us = lambda: time.perf_counter_ns() // 1000
+    time.ticks_diff = lambda new, old: new - old
+
+import ucontrol
+
+
+def supervisory():
+    return {'reference_add': False, 'control_add': False}
+
+
+class Plant():
+    """Integrating loop y[1] += u / 100 with a delay of one sample, the actuator keeps all controls sent."""
+    def __init__(self):
+        self.y = [0, 0]
+        self.pending = 0.
+        self.sent = []
+
+    def get_sensor(self):
+        self.y = [self.y[0], self.y[1] + self.pending / 100]
+        return self.y
+
+    def set_actuator(self, u):
+        self.pending = u
+        self.sent.append(u)
+
+
+def pid(plant, supervis):
+    return ucontrol.PID(plant.get_sensor, plant.set_actuator, 10, 0., 0., 0., 2., 0.5, 1., 0, 0, 0, 0, 0, 0,
+                        10000, 10000, run=True, run1=False, supervisory=supervis)
+
+
+def test_autotune_hands_over_bumpless():
+    plant = Plant()
+    supervis = supervisory()
+    controller = pid(plant, supervis)
+    relay = ucontrol.RelayTuner(plant.get_sensor, plant.set_actuator, 10, supervis)
+
+    def done(tuner): # as select_controller in mpy_edukit
+        controller.bumpless(tuner.y, tuner.u)
+    relay.on_done = done
+    relay.start(channel=1, amplitude=200., hysteresis=1, num_periods=2, max_ticks=1000)
+    while relay.run:
+        asyncio.run(relay.control())
+    assert 'Kp' in relay.result
+    last = plant.sent[-1]
+    plant.pending = 0. # the same sensor value at the first sample of the pid
+    asyncio.run(controller.control())
+    assert plant.sent[-1] == last == relay.u == 0.
+
+
+
+def test_pid_control_excitation_ends_with_one_plain_control():
+    plant = Plant()
+    supervis = supervisory()
+    generator = types.SimpleNamespace(next=lambda: 5., reset=lambda: None)
+    supervis.update(control_add=True, control_num_samples=3, control_counter=0, control_repeat=False,
+                    control_generator=generator)
+    controller = pid(plant, supervis)
+    controller.run = False
+    for _ in range(5):
+        asyncio.run(controller.control())
+    assert plant.sent == [5., 5., 5., 0.]
+    assert not supervis['control_add']
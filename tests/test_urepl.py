@@ -0,0 +1,94 @@
+"""Host test of the receive loop of urepl.py, with a stdin that behaves like the one of micropython."""
+
+import os
+import sys
+import tracemalloc
+import types
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+micropython = types.ModuleType('micropython')
+micropython.const = lambda value: value
+micropython.native = lambda function: function
+micropython.kbd_intr = lambda char: None
+sys.modules.setdefault('micropython', micropython)
+
+import urepl
+
+
+class BlockingStdin():
+    """readinto fills the whole buffer, as the stdin of micropython, and fails where that would block."""
+    def __init__(self, data=b''):
+        self.data = bytearray(data)
+        self.pos = 0
+
+    def readinto(self, buf):
+        if len(self.data) - self.pos < len(buf):
+            raise AssertionError(f'readinto of {len(buf)} bytes would block, {len(self.data) - self.pos} available')
+        for i in range(len(buf)):
+            buf[i] = self.data[self.pos + i]
+        self.pos += len(buf)
+        return len(buf)
+
+
+class Poller():
+    """select.poll of one stream, ipoll gives preallocated results as on micropython."""
+    def __init__(self, stream):
+        self.stream = stream
+        self.ready = [(stream, 1)]
+        self.idle = []
+
+    def ipoll(self, timeout=-1):
+        return self.ready if self.stream.pos < len(self.stream.data) else self.idle
+
+
+def read(data, max_end=4096):
+    stdin = BlockingStdin(data)
+    buf = bytearray(max_end)
+    end = urepl.read_available(stdin, Poller(stdin), bytearray(1), buf, 0, max_end, 4)
+    return stdin, buf, end
+
+
+def test_short_command_does_not_block():
+    stdin, buf, end = read(b'1+1\x04')
+    assert bytes(buf[:end]) == b'1+1\x04'
+
+
+def test_stops_at_terminator_and_keeps_the_rest():
+    stdin, buf, end = read(b'a=1\x04b=2\x04')
+    assert bytes(buf[:end]) == b'a=1\x04'
+    end = urepl.read_available(stdin, Poller(stdin), bytearray(1), buf, end, len(buf), 4)
+    assert bytes(buf[:end]) == b'a=1\x04b=2\x04'
+
+
+def test_incomplete_command_returns_what_is_available():
+    stdin, buf, end = read(b'pid.get_')
+    assert end == 8
+
+
+def test_stops_at_end_of_buffer():
+    stdin, buf, end = read(b'x' * 100, max_end=10)
+    assert end == 10
+    assert stdin.pos == 10
+
+
+def peak_allocation(num_bytes):
+    stdin = BlockingStdin(b'x' * num_bytes + b'\x04')
+    poller = Poller(stdin)
+    buf = bytearray(num_bytes + 1)
+    byte = bytearray(1)
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    start = tracemalloc.get_traced_memory()[0]
+    end = urepl.read_available(stdin, poller, byte, buf, 0, len(buf), 4)
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    assert end == num_bytes + 1
+    return current - start, peak - start
+
+
+def test_no_allocations_per_byte():
+    # above 256 the ints of the index are objects in CPython, so compare from there
+    retained_small, peak_small = peak_allocation(1000)
+    retained_large, peak_large = peak_allocation(20000)
+    assert retained_large <= retained_small
+    assert peak_large <= peak_small
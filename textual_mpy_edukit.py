@@ -1,5 +1,6 @@
 #!/bin/env python3
 
+import argparse
 from array import array
 import asyncio
 from collections import deque
@@ -32,20 +33,31 @@ from textual_plotext import PlotextPlot
 
 from textual_customizations import CustomSuggester, CustomInput
 
-END_PATTERN = b'\x04'
-SAMPLING_TIME = 0.01
-LOG_BUF_LEN = 128
-log_data = np.zeros((3*LOG_BUF_LEN,3))
+from edukit_serial import END_PATTERN, SAMPLING_TIME, LOG_BUF_LEN, SAFETY, LOGGING, USER, VIEW, serial_eval, call_endpoint, decode_sample, log_samples, stream_upload
+from edukit_boards import BoardManager
+from edukit_mux import MuxClient
+from edukit_clock import clock_sync
+from edukit_sweep import run_sweep
+from edukit_store import ExperimentStore, device_snapshot
+from edukit_bode import measure as measure_bode
+
+log_data = np.zeros((3*LOG_BUF_LEN,4))
 
 suggestions = ["micropython_results", "python_results", "micropython_tasks", "python_tasks",
-               "log_data", 
+               "log_data", "await stream_upload(micropython_serial_interface,", "await run_sweep(micropython_serial_interface,", "experiment_store.find(", "experiment_results",
+               "boards", "await boards.eval(", "await boards.gather(log_samples,", "await call_endpoint(micropython_serial_interface,", "await clock_sync(micropython_serial_interface)", 
                ]
 mpy_suggestions = ["micropythonn_results","micropython_tasks",
                    "pid.", "pid.get_gains1()", "pid.get_gains2()", "pid.set_gains1()","pid.pid_set_gains2()",
                    "encoder.", "stepper.","supervisory", "supervisory['reference_add']",
+                   "set_reference_excitation(", "set_control_excitation(", "PRBS(", "Chirp(", "Multisine(",
                ]
 
 
+def new_plot_history(MAXLEN=300):
+    return [deque([0.]*MAXLEN,maxlen=MAXLEN),deque([0.]*MAXLEN,maxlen=MAXLEN),deque([0.]*MAXLEN,maxlen=MAXLEN)]
+
+
 class TimeDisplay(Static):
     """A widget to display elapsed time."""
     time = reactive(0.0)
@@ -53,15 +65,16 @@ class TimeDisplay(Static):
     def __init__(self,*args,**kwargs):
         global app
         self.start_time = time.monotonic()
-        MAXLEN=300
-        self.plot_history = [deque([0.]*MAXLEN,maxlen=MAXLEN),deque([0.]*MAXLEN,maxlen=MAXLEN),deque([0.]*MAXLEN,maxlen=MAXLEN)]
+        self.plot_history = {} # per board port
+        self.subscriptions = {} # per board port of a MuxClient: (command, subscription id)
         super(TimeDisplay,self).__init__(*args,**kwargs)
     
     def on_mount(self) -> None:
         """Event handler called when widget is added to the app."""
         #self.plots = [app.query_one('#plot1'), app.query_one('#plot2')]
-        self.plot_output = [app.query_one('#plot_output')]
-        self.plot_input = [app.query_one('#plot_input')]        
+        # a column with an output and an input plot per board
+        self.plot_output = [app.query_one(f'#plot_output_{i}') for i in range(len(boards))]
+        self.plot_input = [app.query_one(f'#plot_input_{i}') for i in range(len(boards))]
         self.update_timer = self.set_interval(1 / 20, self.update_time)
 
     async def update_time(self) -> None:
@@ -71,25 +84,58 @@ class TimeDisplay(Static):
 
     async def update_plots(self):
         global micropython_serial_interface
-        #ctrl_type = await serial_eval(micropython_serial_interface,'ctrlparam["type"]')
-        ctrl_type = app.query_one("#control_type").pressed_button.id
-        if ctrl_type == 'PID':
-             resp = await serial_eval(micropython_serial_interface,'pid.sample')
+        command = 'active_controller().sample'
+        # all boards side by side, each in its own plots, or only the selected board
+        if app.query_one('#all_boards_switch').value:
+            shown = list(range(len(boards)))
         else:
-            resp = await serial_eval(micropython_serial_interface,'ss.sample')
-        data = resp
-            
-        #for i in range(len(data)): self.plot_history[i].append(data[i])
-        for i in range(3): self.plot_history[i].append(data[i])
-        self.plot_output[0].plt.clear_data()
-        self.plot_output[0].plt.scatter(self.plot_history[0],yside='left',label='stepper steps') #,marker='fhd')
-        self.plot_output[0].plt.scatter(self.plot_history[1],yside='right',label='encoder ticks') #,marker='fhd')
-        self.plot_output[0].refresh()
-        self.plot_input[0].plt.clear_data()
-        self.plot_input[0].plt.scatter(self.plot_history[2],yside='left',label='control') #,marker='fhd')
-        self.plot_input[0].refresh()
+            shown = [app.query_one('#board_select').pressed_index]
+        for i in range(len(boards)):
+            self.plot_output[i].parent.display = i in shown
+        # every board has its own serial link, so they are polled concurrently
+        samples = await asyncio.gather(*(self.sample(boards[i],command) for i in shown))
+
+        for index,data in zip(shown,samples):
+            board = boards[index]
+            if board.port not in self.plot_history:
+                self.plot_history[board.port] = new_plot_history()
+            plot_history = self.plot_history[board.port]
+            #for i in range(len(data)): plot_history[i].append(data[i])
+            if data is not None:
+                for i in range(3): plot_history[i].append(data[i])
+            self.plot_output[index].plt.clear_data()
+            self.plot_input[index].plt.clear_data()
+            self.plot_output[index].plt.scatter(plot_history[0],yside='left',label='stepper steps') #,marker='fhd')
+            self.plot_output[index].plt.scatter(plot_history[1],yside='right',label='encoder ticks') #,marker='fhd')
+            self.plot_input[index].plt.scatter(plot_history[2],yside='left',label='control') #,marker='fhd')
+            self.plot_output[index].refresh()
+            self.plot_input[index].refresh()
         
 
+    async def sample(self,board,command):
+        """Latest sample of board, from the shared telemetry when connected through edukit_mux.py."""
+        if not isinstance(board,MuxClient):
+            # a poll that cannot be sent within one period is dropped, logging and user commands go first
+            try:
+                # endpoint sample gives the sample of the active controller, as command
+                return decode_sample(await call_endpoint(board,'sample',priority=VIEW,deadline=1 / 20,coalesce=True))
+            except asyncio.TimeoutError:
+                return None
+        subscribed_command, sub_id = self.subscriptions.get(board.port,(None,None))
+        if subscribed_command != command:
+            if sub_id is not None:
+                await board.unsubscribe(sub_id)
+            sub_id = await board.subscribe(command,1 / 20) # period of update_timer
+            self.subscriptions[board.port] = (command,sub_id)
+            # start with the plots of the other viewers
+            history = await board.history(sub_id)
+            self.plot_history.pop(board.port,None)
+            if history:
+                self.plot_history[board.port] = new_plot_history()
+                for data in history:
+                    for i in range(3): self.plot_history[board.port][i].append(data[i])
+        return board.telemetry[sub_id]
+
     def watch_time(self, time: float) -> None:
         """Called when the time attribute changes."""
         minutes, seconds = divmod(time, 60)
@@ -125,6 +171,10 @@ class IDE(App):
                 yield Switch(value=True,animate=False,id='datetimeswitch')
                 yield Label(self.logtext,id='loglabel')
                 yield Button('Log Data',id='log_data_button')
+                yield Input(placeholder='sweep.json',id='sweep_spec_input')
+                yield Button('Run Sweep',id='sweep_button')
+                yield Input(placeholder='Chirp(500.,0.1,50.,60.)',id='bode_excitation_input')
+                yield Button('Measure Bode',id='bode_button')
                 yield Rule(line_style="ascii")
                 yield RadioButton('reference_add',value=False,id='reference_add')
                 yield RadioButton('control_add',value=False,id='control_add')
@@ -132,8 +182,11 @@ class IDE(App):
             with Vertical(id='middle_bar'): # middle bar, plots and repl's
                 #yield Label("Press Ctrl+Z tot suspend.")
                 yield TimeDisplay(id='timer_plots')
-                yield PlotextPlot(id='plot_output')
-                yield PlotextPlot(id='plot_input')
+                with Horizontal(id='plots'): # a column of plots per board, shown by TimeDisplay.update_plots
+                    for i,board in enumerate(boards):
+                        with Vertical(classes='board_plots'):
+                            yield PlotextPlot(id=f'plot_output_{i}',classes='plot_output')
+                            yield PlotextPlot(id=f'plot_input_{i}',classes='plot_input')
                 with Horizontal():
                     with Vertical():
                         yield RichLog(highlight=True,markup=True,auto_scroll=True,max_lines=1000,id="python_output")
@@ -143,12 +196,17 @@ class IDE(App):
                         yield RichLog(highlight=True,markup=True,auto_scroll=True,max_lines=1000,id="micropython_output")
                         yield CustomInput(placeholder="MicroPython prompt",id="micropython_input",suggester=CustomSuggester(mpy_suggestions))
             with Vertical(id='right_bar'): # right bar, micropython buttons
-                # RadioSet choice for pid vs state-space
+                yield Label("Select board:")
+                with RadioSet(id='board_select'):
+                    for i,board in enumerate(boards):
+                        yield RadioButton(board.port,value=(i == 0))
+                yield Static("Plot all boards: ")
+                yield Switch(value=False,animate=False,id='all_boards_switch')
+                yield Rule(line_style="ascii")
+                # RadioSet choice of the controllers registered on the board, filled in on_mount
                 # input fields for pid gains (optional)
                 yield Label("Select controller type:")
-                with RadioSet(id='control_type'):
-                    yield RadioButton("PID",id='PID',value=True)
-                    yield RadioButton("State-space")
+                yield RadioSet(id='control_type')
                 yield Rule(line_style="ascii")
                 yield Label("PID:")
                 yield RadioButton('pid.run',value=False,id='pid_run')
@@ -158,7 +216,7 @@ class IDE(App):
                 yield Rule(line_style="ascii")
                 yield RadioButton('ss.run',value=False,id='ss_run')
 
-    def on_mount(self):
+    async def on_mount(self):
         global log_data
         python_output = self.query_one("#python_output")
         python_output.can_focus=False
@@ -181,34 +239,60 @@ class IDE(App):
         Also see [magenta]https://textual.textualize.io/widgets/input/ [/magenta]       
         """)
 
-        plt1 = self.query_one('#plot_output').plt
-        plt1.title("Plot output (stepper steps and encoder ticks)") # to apply a title
-        plt2 = self.query_one('#plot_input').plt
-        plt2.title("Plot input (control)") # to apply a title
+        for i,board in enumerate(boards):
+            port = f' of {board.port}' if len(boards) > 1 else ''
+            plt1 = self.query_one(f'#plot_output_{i}').plt
+            plt1.title("Plot output (stepper steps and encoder ticks)"+port) # to apply a title
+            plt2 = self.query_one(f'#plot_input_{i}').plt
+            plt2.title("Plot input (control)"+port) # to apply a title
+
+        # alarms of the L6474 are sent by the boards as events
+        for board in boards:
+            board.on_event = lambda event, board=board: self.handle_board_event(board, event)
 
+        # a choice for every controller registered on the board
+        names, active = await serial_eval(micropython_serial_interface,'(list(controllers),ctrlparam["type"])')
+        await self.query_one('#control_type').mount_all(
+            RadioButton(name.replace('_',' '),value=(name == active),name=name) for name in sorted(names))
+
+
+    def handle_board_event(self, board, event):
+        if isinstance(event, dict) and (event.get('event') == 'alarm'):
+            message = f"Alarm of the L6474 on {board.port}: {', '.join(event['alarms']) or 'none'} (STATUS {event['status']:#06x}), controllers stopped"
+            self.notify(message, severity='error', timeout=10)
+        else:
+            message = f"Event of {board.port}: {event}"
+        self.query_one("#python_output").write(message)
 
     @on(Button.Pressed,'#log_data_button')
     async def handle_log_data(self, event: Button.Pressed) -> None:
         log_task = asyncio.create_task(self.data_logger())
 
+    @on(Button.Pressed,'#sweep_button')
+    async def handle_sweep(self, event: Button.Pressed) -> None:
+        sweep_task = asyncio.create_task(self.sweep_runner())
+
+    @on(Button.Pressed,'#bode_button')
+    async def handle_bode(self, event: Button.Pressed) -> None:
+        bode_task = asyncio.create_task(self.bode_runner())
+
     @on(Button.Pressed,'#stepper_zero_button')
     async def handle_stepper_zero_button(self, event: Button.Pressed) -> None:
-        await serial_eval(micropython_serial_interface,'stepper.set_period_direction(0)')
+        await serial_eval(micropython_serial_interface,'stepper.set_period_direction(0)',priority=SAFETY)
 
     @on(Button.Pressed,'#reset_pid_button')
     async def handle_reset_pid_button(self, event: Button.Pressed) -> None:
         await serial_eval(micropython_serial_interface,'pid.reset_state()')
         
         
+    @on(RadioSet.Changed,'#board_select')
+    async def handle_radioset_board_select(self, event: RadioSet.Changed) -> None:
+        global micropython_serial_interface
+        micropython_serial_interface = boards[event.radio_set.pressed_index]
+
     @on(RadioSet.Changed,'#control_type')
     async def handle_radioset_control_type(self, event: RadioSet.Changed) -> None:
-        if str(event.pressed.label) == "PID":
-            ctrl_type = 'pid'
-        elif str(event.pressed.label) == "State-space":
-            ctrl_type = 'state_space'
-        else:
-            ctrl_type = 'pid'
-        await serial_eval(micropython_serial_interface, f'ctrlparam["type"]=\"{ctrl_type}\"')
+        await serial_eval(micropython_serial_interface, f'select_controller(\"{event.pressed.name}\")')
         
     @on(RadioButton.Changed)
     async def handle_radiobuttons(self, event: RadioButton.Changed) -> None:
@@ -231,12 +315,14 @@ class IDE(App):
             
         if event.value == True:
             val = "True"
+            priority = USER
         else:
             val = "False"
-        await serial_eval(micropython_serial_interface, button + '='+val)
+            priority = SAFETY # stopping goes before everything else
+        await serial_eval(micropython_serial_interface, button + '='+val, priority=priority)
         # send zero to stepper when control_add is stopped:
         if (button_id == 'control_add') and (event.value == False):
-            await serial_eval(micropython_serial_interface, 'stepper.set_period_direction(0)')
+            await serial_eval(micropython_serial_interface, 'stepper.set_period_direction(0)', priority=SAFETY)
 
         
 
@@ -325,137 +411,102 @@ class IDE(App):
 
     def action_toggle_update_plots(self) -> None:
         """Action to pause and resume the TimeDisplay and thus the plot update."""
-        if self.logtext == 'Not logging':
-            timer = self.query_one('#timer_plots').update_timer
-            if timer._active.is_set():
-                timer.pause()
-            else:
-                timer.resume()
+        timer = self.query_one('#timer_plots').update_timer
+        if timer._active.is_set():
+            timer.pause()
+        else:
+            timer.resume()
 
     async def data_logger(self):
         global log_data
-        log = True
         self.logtext = 'Logging'
-        log0_prev = False
-        log1_prev = False
-        log0 = True
-        log1 = True
-        log_ready = False
         log_num_buf = int(self.query_one('#num_bufs_input').value)
         log_num_samples = log_num_buf * LOG_BUF_LEN
-        log_buf_counter = 0
-        log_data = np.zeros((log_num_samples,3))
 
-        # stop updating plots not to overload serial interface
-        timer = self.query_one('#timer_plots').update_timer
-        timer.pause()
-
-        await serial_eval(micropython_serial_interface,f"supervisory['log_num_samples']={log_num_samples}")
-        await serial_eval(micropython_serial_interface,f"supervisory['log_ready']={log_ready}")
-        await serial_eval(micropython_serial_interface,f"supervisory['log']={log}")
-        log = await serial_eval(micropython_serial_interface,"supervisory['log']")            
-        log0 = await serial_eval(micropython_serial_interface,"supervisory['log0']")
-        log1 = await serial_eval(micropython_serial_interface,"supervisory['log1']")
-        while log:
-            log0_prev = log0
-            log1_prev = log1
-            log = await serial_eval(micropython_serial_interface,"supervisory['log']")            
-            log0 = await serial_eval(micropython_serial_interface,"supervisory['log0']")
-            log1 = await serial_eval(micropython_serial_interface,"supervisory['log1']")
-            # detect True -> False changes:
-            if (log0_prev == True) and (log0 == False): # log0 is finished
-                log0_data = await serial_eval(micropython_serial_interface,f"supervisory['log0_data']")
-                log_data[log_buf_counter*LOG_BUF_LEN:(log_buf_counter+1)*LOG_BUF_LEN,:] = np.array(log0_data).T
-                log_buf_counter += 1                
-            elif  (log1_prev == True) and (log1 == False): # log1 is finished
-                log1_data = await serial_eval(micropython_serial_interface,f"supervisory['log1_data']")
-                log_data[log_buf_counter*LOG_BUF_LEN:(log_buf_counter+1)*LOG_BUF_LEN,:] = np.array(log1_data).T
-                log_buf_counter += 1
-            else:
-                await asyncio.sleep(round(0.1*LOG_BUF_LEN*SAMPLING_TIME))
+        # the logging commands have priority over the plot updates, which keep running
+        try:
+            snapshot = await device_snapshot(micropython_serial_interface)
+        except RuntimeError as e:
+            snapshot = None
+            self.query_one("#python_output").write(f"Log is not saved in the experiment store: {e}")
+        log_data = await log_samples(micropython_serial_interface,log_num_samples)
 
         self.logtext = 'Not logging'
-        # resume updating of plots
-        timer.resume()
         fname="log_data"
         if self.query_one('#datetimeswitch').value == True:
             fname += "_" + datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
         fname += '.pickle'
         with open(fname,'wb') as handle:
             pickle.dump(log_data,handle,protocol=pickle.HIGHEST_PROTOCOL)
+        if snapshot is not None:
+            experiment_results.appendleft(experiment_store.put(log_data,snapshot))
+
+    async def sweep_runner(self):
+        spec = self.query_one('#sweep_spec_input').value
+        self.logtext = 'Sweep'
+        try:
+            summary = await run_sweep(micropython_serial_interface,spec,
+                                      progress=lambda i,num: setattr(self,'logtext',f'Sweep: {i}/{num} logged'),
+                                      store=experiment_store)
+            python_results.appendleft(summary)
+            self.query_one("#python_output").write(f"Sweep {spec} done, summary in python_results[0]")
+        except Exception as e:
+            self.query_one("#python_output").write(e)
+        self.logtext = 'Not logging'
+
+    async def bode_runner(self):
+        excitation = self.query_one('#bode_excitation_input').value or 'Chirp(500.,0.1,50.,60.)'
+        self.logtext = 'Bode'
+        try:
+            response = await measure_bode(micropython_serial_interface,excitation,
+                                          progress=lambda num,response: setattr(self,'logtext',f'Bode: {num} buffers, {response.num_segments} segments'))
+        except Exception as e:
+            self.query_one("#python_output").write(e)
+            self.logtext = 'Not logging'
+            return
+        self.logtext = 'Not logging'
+        fname = "bode"
+        if self.query_one('#datetimeswitch').value == True:
+            fname += "_" + datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
+        fname += '.csv'
+        response.save(fname)
+        python_results.appendleft(response)
+        # the live plots would overwrite the Bode plot
+        self.query_one('#timer_plots').update_timer.pause()
+        f, magnitude_db, phase_deg = response.bode()
+        i = self.query_one('#board_select').pressed_index # in the plots of the selected board
+        for plot_id, values, label in ((f'#plot_output_{i}',magnitude_db,'magnitude (dB)'),(f'#plot_input_{i}',phase_deg,'phase (degrees)')):
+            plot = self.query_one(plot_id).plt
+            plot.clear_data()
+            plot.plot(np.log10(f),values,yside='left',label=label)
+            self.query_one(plot_id).refresh()
+        self.query_one("#python_output").write(f"Bode of {excitation} saved in {fname} and in python_results[0], plotted against log10 of the frequency (Hz); press p to resume the live plots")
+
 
-            
-async def serial_eval(serial_interface,command,END_PATTERN=b'\x04'):
-    response = None
-    async with serial_interface.lock:
-        resp = b''
-        #ser.reset_output_buffer()
-        #ser.reset_input_buffer()
-        command_byte = (command).encode('utf-8')+END_PATTERN
-        await ser.write_async(command_byte)
-        ser.flush()
-        resp += await ser.read_async(ser.in_waiting)
-        if len(resp)>=len(END_PATTERN):
-            pattern = resp[-len(END_PATTERN):]
-        else:
-            pattern = b''
-        while not (pattern == END_PATTERN):
-            if ser.in_waiting > 1:
-                resp += await ser.read_async(ser.in_waiting)
-            else:
-                resp += await ser.read_async(1)
-            if len(resp)>=len(END_PATTERN):
-                pattern = resp[-len(END_PATTERN):]
-        response = resp[:-(len(END_PATTERN))].decode('utf-8')
-        if response == '':
-            response = None
-    if (response is None):
-        return response
-    if len(response)>11:
-        if response[0:11] == 'Exception: ':
-            return response
-    try:
-        res = eval(response)
-    except:
-        res = response
-    return res
-        
 if __name__ == '__main__':
     python_tasks = deque([],maxlen=10)
     python_results = deque([],maxlen=50)
     micropython_tasks = deque([],maxlen=10)
     micropython_results = deque([],maxlen=50)
+    experiment_store = ExperimentStore()
+    experiment_results = deque([],maxlen=50) # hashes of the logs in experiment_store
 
-    ports_avail = list_ports.comports()
-    serial_port = [port.device for port in ports_avail if port.manufacturer=='STMicroelectronics'][0]
-    baudrate    = 115200
-    ser = aioserial.AioSerial(port=serial_port,baudrate=baudrate)
-    micropython_serial_interface = ser
-    ser.lock = asyncio.Lock() # add a lock to serial port, to prevent multiple processes communicate with serial interface at same time
-    ser.reset_output_buffer()
-    ser.reset_input_buffer()
-    ser.write(b'\x04') # reset micropython board
-    ser.flush()
-    ser.write(b'\x01') # Ctrl-A leave repl mode
-    ser.reset_input_buffer()
-    startup_cmd = 'import mpy_edukit'.encode('utf-8') + b'\r\n' + b'\x04'  # note it is imported, rather than executed by exec, because its a mpy file
-    ser.write(startup_cmd)                   # run edukit program on micropython board
-    ser.flush()
-    time.sleep(0.5) # wait for edukit to start up
-    
-    ser.reset_output_buffer()
-    ser.reset_input_buffer()
+    parser = argparse.ArgumentParser(description='Control the Edukit pendulum with micropython and textual.')
+    parser.add_argument('--mux',default=None,help='host:port of edukit_mux.py, to share the board with other programs')
+    args = parser.parse_args()
+
+    if args.mux is None:
+        boards = BoardManager().open() # all connected boards
+    else:
+        boards = BoardManager(boards=[MuxClient(args.mux)])
+    if len(boards) == 0:
+        sys.exit('No Edukit board found')
+    micropython_serial_interface = boards[0] # selected board
 
     app = IDE()
     app.run()
 
-    ser.write(b'stop'+END_PATTERN+b'\x04')
-    ser.write(b'\x02') # Ctrl-B back to repl mode
-    ser.write(b'\x04') # after completing tasks, reset micropython board
-    ser.flush()
-    ser.reset_output_buffer()
-    ser.reset_input_buffer()
-    ser.close()
+    boards.close()
     print('All done')
     
 
@@ -2,7 +2,8 @@ from builtins import int
 from micropython import const
 from machine import SPI, Pin, freq
 from pyb import Timer # this Timer class is more complete than the one in machine
-from time import sleep_ms, sleep_us, ticks_us
+from time import sleep_ms, sleep_us, ticks_us, ticks_diff
+import asyncio
 
 
 def binformat(int_value):
@@ -34,6 +35,20 @@ def binformat(int_value):
 #     }
 
 
+# bits of STATUS, UVLO, TH_WRN, TH_SD and OCD are active low
+STATUS_ALARMS = (
+    (1 << 7, 0, 'NOTPERF_CMD'), # command not performed
+    (1 << 8, 0, 'WRONG_CMD'),
+    (1 << 9, 1, 'UVLO'),        # undervoltage lockout
+    (1 << 10, 1, 'TH_WRN'),     # thermal warning
+    (1 << 11, 1, 'TH_SD'),      # thermal shutdown
+    (1 << 12, 1, 'OCD'),        # overcurrent
+    )
+
+def decode_status(status):
+    """Names of the alarms in the value of STATUS."""
+    return [name for mask, active_low, name in STATUS_ALARMS if bool(status & mask) != bool(active_low)]
+
 
 class L6474():
     """Class for L6474 stepper motor controller."""
@@ -71,12 +86,15 @@ class L6474():
 
         # inputs:
         self.flag      = Pin(self.FLAG_pin, Pin.IN, Pin.PULL_UP)
+        self.alarm_flag = asyncio.ThreadSafeFlag() # set by the interrupt of FLAG
+        self.alarm_us = 0 # ticks_us of the last alarm
+        self.num_alarms = 0
 
         # outputs:
         self.reset     = Pin(self.STBY_RESET_pin, mode=Pin.OUT, value=1)
         self.cs        = Pin(self.SPI_CS_pin, mode=Pin.OUT, value=1)
         self.direction = Pin(self.DIR_pin, mode=Pin.OUT, value=1)     
-        self.tim       = Timer(3,period=200,prescaler=0x1a3) # scales clock to 100 kHz (10 us)
+        self.tim       = Timer(3,period=200,prescaler=0x1a3) # scales the 84 MHz clock of TIM3 to 200 kHz (5 us)
         #pwm_tim = Timer(3,period=200,prescaler=41) # scales clock to 1000 kHz (1 us)
         # if period = 100, then 1 ustep every 100 * 1e-6 s
         # which is 10 usteps / ms
@@ -85,6 +103,22 @@ class L6474():
         self.spi = SPI(1)
         self.spi.init(polarity=1,phase=1,baudrate=self.SPI_FREQ,firstbit=SPI.MSB)
 
+        # position from counting the toggles of the step clock, see get_abs_pos_counted
+        # the clock toggles every period + 1 ticks of tim
+        self.timer_tick_ns = 1000000000 * (self.tim.prescaler() + 1) // self.tim.source_freq()
+        self.count_steps = False
+        self.count_pos = 0       # microsteps, one per rising edge of the step clock
+        self.count_out = 0       # level of the step clock
+        self.count_us = ticks_us()
+        self.count_rem_ns = 0    # time since the last counted toggle
+        self.count_period_ns = 0 # between toggles, 0 when stopped
+        self.count_dir = 1
+        self.count_ticks = 0
+        self.reconcile_ticks = 100 # compare with ABS_POS every reconcile_ticks calls
+        self.count_error = 0     # ABS_POS - counted position at the last reconciliation
+        self.count_max_error = 0
+        self.num_reconcile = 0
+
     @micropython.native
     def bytes2int(self,bytes_,signed=False):
         """Convert bytes to integer.""" 
@@ -114,6 +148,23 @@ class L6474():
         return rxdata[1:]
 
 
+    def enable_alarm_irq(self):
+        """Latch alarms with an interrupt on FLAG (open drain, low on alarm), wait for them with alarm_flag.wait().
+
+        The interrupt only takes the time and sets alarm_flag, so the SPI bus is only
+        used to read STATUS after an alarm (get_status, which also releases FLAG)."""
+        self.get_status() # release FLAG of alarms before, e.g. UVLO at power up
+        self.flag.irq(self.flag_irq,Pin.IRQ_FALLING)
+
+    def disable_alarm_irq(self):
+        self.flag.irq(None)
+
+    def flag_irq(self,pin):
+        # interrupt handler, must not allocate memory
+        self.alarm_us = ticks_us()
+        self.num_alarms += 1
+        self.alarm_flag.set()
+
     def get_status(self):
         txdata = self.GET_STATUS + b'\x00\x00'
         rxdata = self.spi_send_receive(txdata)
@@ -230,6 +281,76 @@ class L6474():
         else:
             return val
 
+    @micropython.native
+    def count_update(self):
+        """Count the toggles of the step clock since the previous update."""
+        now = ticks_us()
+        period_ns = self.count_period_ns
+        if period_ns:
+            dt = 1000 * ticks_diff(now,self.count_us) + self.count_rem_ns
+            if dt < 0: # before the first toggle with a new period
+                self.count_rem_ns = dt
+            else:
+                n = dt // period_ns
+                self.count_rem_ns = dt - n * period_ns
+                out = self.count_out
+                self.count_pos += self.count_dir * ((n + 1 - out) >> 1) # rising edges of n toggles
+                self.count_out = (out + n) & 1
+        self.count_us = now
+
+    @micropython.native
+    def get_abs_pos_counted(self):
+        """Position counted from the commanded step rate and direction, without SPI except every reconcile_ticks calls."""
+        self.count_ticks += 1
+        if self.count_ticks >= self.reconcile_ticks:
+            self.reconcile()
+        else:
+            self.count_update()
+        return self.count_pos
+
+    def reconcile(self):
+        """Compare the counted position with ABS_POS (e.g. missed steps) and continue counting from ABS_POS, returns the difference."""
+        self.count_update()
+        abs_pos = self.get_abs_pos_efficient()
+        error = abs_pos - self.count_pos
+        self.count_error = error
+        if abs(error) > self.count_max_error:
+            self.count_max_error = abs(error)
+        self.count_pos = abs_pos
+        self.count_ticks = 0
+        self.num_reconcile += 1
+        return error
+
+    def start_counting(self,reconcile_ticks=None):
+        """Count the position from ABS_POS on, get_both_sensors of mpy_edukit then uses get_abs_pos_counted."""
+        if reconcile_ticks is not None:
+            self.reconcile_ticks = reconcile_ticks
+        self.count_max_error = 0
+        self.num_reconcile = 0
+        # the state of the step clock, set_period_direction only keeps it while counting
+        period = self.tim.period()
+        self.count_period_ns = 0 if period > 10000 else (period + 1) * self.timer_tick_ns # longer when stopped
+        self.count_rem_ns = 0
+        self.count_dir = 1 if self.direction.value() else -1
+        self.count_us = ticks_us()
+        self.reconcile()
+        self.count_steps = True
+
+    def stop_counting(self):
+        self.count_steps = False
+
+    def benchmark_position(self,num=1000):
+        """us per call of get_abs_pos_efficient (SPI) and of get_abs_pos_counted (with its reconciliations)."""
+        t0 = ticks_us()
+        for _ in range(num):
+            self.get_abs_pos_efficient()
+        spi_us = ticks_diff(ticks_us(),t0) / num
+        t0 = ticks_us()
+        for _ in range(num):
+            self.get_abs_pos_counted()
+        counted_us = ticks_diff(ticks_us(),t0) / num
+        return spi_us, counted_us
+
     def set_param(self,param,value):
         addr_int, num_bytes, signed = self.get_param_address_spec(param)
         byte_values = self.int2bytes(value,num_bytes,signed=signed)
@@ -264,12 +385,18 @@ class L6474():
     def set_period_direction(self,control):
         tim = self.tim
         direction = self.direction
+        counting = self.count_steps
+        if counting:
+            self.count_update()
         if control == 0.:
             tim.period(100000)        
             if direction.value() == 0:
                 direction.value(1)
             else:
                 direction.value(0)
+            if counting:
+                self.count_period_ns = 0 # the toggles in alternating directions cancel
+                self.count_rem_ns = 0
         else:
             if abs(control)<1:
                 tim.period(10000)
@@ -285,10 +412,19 @@ class L6474():
                     tim.period(abs(period))
                 else:
                     tim.period(10000)
+            if counting:
+                period_ns = (tim.period() + 1) * self.timer_tick_ns # the counter runs from 0 to period
+                if self.count_period_ns:
+                    self.count_rem_ns += period_ns - self.count_period_ns # the period is preloaded, the next toggle keeps its time
+                self.count_period_ns = period_ns
             if period<0:
                 direction.value(0)
+                if counting:
+                    self.count_dir = -1
             else:
                 direction.value(1)
+                if counting:
+                    self.count_dir = 1
 
 #@micropython.native
 # def set_default():
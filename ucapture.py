@@ -0,0 +1,122 @@
+from array import array
+from struct import pack_into
+from time import ticks_diff
+from micropython import const
+import micropython
+
+# triggered capture of the samples of the controller, like an oscilloscope:
+# a ring buffer runs continuously while armed, so the samples before the
+# trigger are kept, and is frozen a fixed number of samples after it
+
+IDLE = const(0)
+ARMED = const(1) # waiting for the trigger
+TRIGGERED = const(2) # capturing the samples after the trigger
+READY = const(3) # frozen, for download
+
+LEVEL = const(0) # trigger on a level crossing of a channel
+LIMIT = const(1) # trigger on a saturated integrator
+OVERRUN = const(2) # trigger on a missed sampling time
+
+EVENTS = {None:LEVEL,'limit':LIMIT,'overrun':OVERRUN}
+
+
+class Capture():
+    """Ring buffer of length samples (steps, encoder ticks, control, us since previous sample) with a trigger."""
+    def __init__(self,length=256):
+        self.length = length
+        self.data = [
+            array('i',[0  for _ in range(length)]),
+            array('i',[0  for _ in range(length)]),
+            array('f',[0. for _ in range(length)]),
+            array('H',[0  for _ in range(length)]),
+            ]
+        self.header = bytearray(4)
+        self.state = IDLE
+        self.armed = False
+        self.pos = 0
+        self.count = 0
+        self.remaining = 0
+        self.prev_us = 0
+        self.prev = 0
+        self.channel = 1
+        self.level = 0
+        self.slope = 1
+        self.pre = length // 4
+        self.mode = LEVEL
+
+    def arm(self,channel=1,level=0,slope=1,pre=None,event=None):
+        """Capture around the crossing of level by channel (0 steps, 1 encoder ticks, 2 control) with slope 1 rising, -1 falling, 0 both,
+        or around event 'limit' (saturated integrator) or 'overrun' (missed sampling time). pre samples are kept before the trigger."""
+        if pre is not None:
+            if not 0 <= pre < self.length:
+                raise ValueError('pre should be 0 ... '+str(self.length-1))
+            self.pre = pre
+        self.channel = channel
+        self.level = level
+        self.slope = slope
+        self.mode = EVENTS[event]
+        self.pos = 0
+        self.count = 0
+        self.state = ARMED
+        self.armed = True
+
+    def stop(self):
+        self.state = IDLE
+        self.armed = False
+
+    @micropython.native
+    def add(self,y0,y1,u,t_us,event):
+        """Add a sample at ticks_us t_us, event is True when the event of the trigger (limit or overrun) happened."""
+        if not self.armed: # frozen or stopped
+            return
+        pos = self.pos
+        data = self.data
+        data[0][pos] = y0
+        data[1][pos] = y1
+        data[2][pos] = u
+        dt_us = 0 if self.count == 0 else ticks_diff(t_us,self.prev_us)
+        if dt_us > 65535:
+            dt_us = 65535
+        data[3][pos] = dt_us
+        self.prev_us = t_us
+        self.pos = pos + 1 if pos + 1 < self.length else 0
+        self.count += 1
+        if self.state == ARMED:
+            if self.channel == 0:
+                value = y0
+            elif self.channel == 1:
+                value = y1
+            else:
+                value = u
+            if self.count > self.pre:
+                if self.mode == LEVEL:
+                    level = self.level
+                    rising = (self.prev < level) and (value >= level)
+                    falling = (self.prev > level) and (value <= level)
+                    if (rising and self.slope >= 0) or (falling and self.slope <= 0):
+                        self.trigger()
+                elif event:
+                    self.trigger()
+            self.prev = value
+        else:
+            self.remaining -= 1
+            if self.remaining <= 0:
+                self.state = READY
+                self.armed = False
+
+    def trigger(self):
+        """Trigger now (also by hand), the buffer is frozen after length - pre - 1 more samples."""
+        self.remaining = self.length - self.pre - 1
+        self.state = TRIGGERED
+        if self.remaining <= 0:
+            self.state = READY
+            self.armed = False
+
+    def pack(self):
+        """uint16 length and pre, then the channels as int32, int32, float32 and uint16 arrays, oldest sample first."""
+        pack_into('<HH',self.header,0,self.length,self.pre)
+        pos = self.pos
+        result = bytes(self.header)
+        for channel in self.data:
+            result += bytes(channel[pos:]) + bytes(channel[:pos])
+        return result
@@ -0,0 +1,47 @@
+from struct import pack_into, unpack_from
+import micropython
+
+# compression of log and stream data: integer channels as zig-zag varints
+# of the differences between samples, floats as float16
+
+HALF_MAX = 65504. # largest float16
+
+
+@micropython.native
+def encode_deltas(values,num,out,pos):
+    """Zig-zag varints of the differences of values[0:num] (the first against 0) in out from pos, returns end position."""
+    prev = 0
+    for i in range(num):
+        value = values[i]
+        d = value - prev
+        prev = value
+        if d >= 0:
+            z = d << 1
+        else:
+            z = ((-d) << 1) - 1
+        while z >= 128:
+            out[pos] = (z & 127) | 128
+            z >>= 7
+            pos += 1
+        out[pos] = z
+        pos += 1
+    return pos
+
+@micropython.native
+def encode_half(values,num,out,pos):
+    """values[0:num] as float16 (saturated) in out from pos, returns end position."""
+    for i in range(num):
+        value = values[i]
+        if value > HALF_MAX:
+            value = HALF_MAX
+        elif value < -HALF_MAX:
+            value = -HALF_MAX
+        pack_into('<e',out,pos,value)
+        pos += 2
+    return pos
+
+@micropython.native
+def decode_half(data,values):
+    """Float16 data in values."""
+    for i in range(len(data)//2):
+        values[i] = unpack_from('<e',data,2*i)[0]
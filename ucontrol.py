@@ -1,5 +1,37 @@
 from array import array
 import micropython
+from time import ticks_us, ticks_diff
+
+
+@micropython.native
+def next_reference(supervis):
+    """Next sample of the reference excitation (0. when off), counted and repeated."""
+    if not supervis['reference_add']:
+        return 0.
+    num_samples = supervis['reference_num_samples']
+    if num_samples and (supervis['reference_counter'] >= num_samples):
+        if not supervis['reference_repeat']:
+            supervis['reference_add'] = False
+        supervis['reference_counter'] = 0
+        supervis['reference_generator'].reset()
+    supervis['reference_counter'] += 1
+    return supervis['reference_generator'].next()
+
+@micropython.native
+def next_control(supervis):
+    """Next sample of the control excitation (None when off), counted and repeated."""
+    if not supervis['control_add']:
+        return None
+    num_samples = supervis['control_num_samples']
+    if num_samples and (supervis['control_counter'] >= num_samples):
+        supervis['control_counter'] = 0
+        supervis['control_generator'].reset()
+        if not supervis['control_repeat']:
+            supervis['control_add'] = False
+            return 0. # the control without excitation is sent once more
+    supervis['control_counter'] += 1
+    return supervis['control_generator'].next()
+
 
 class PID():
     def __init__(self,get_sensor,set_actuator,sampling_time_ms,Kp1,Ki1,Kd1,Kp2,Ki2,Kd2,r1,r2,e1_sum,e2_sum,y1_prev,y2_prev,limit1_sum,limit2_sum,run=False,run1=True,run2=True,supervisory={}):
@@ -79,6 +111,28 @@ class PID():
         self.y2_prev = 0
         self.limit2_sum_flag = False
 
+    def bumpless(self,y,u):
+        """Initialize the state at output y, so the control continues from u (of the previous controller).
+
+        The integrator of loop 2 (or else loop 1) takes up the difference
+        with the proportional terms, without integrator u jumps anyway."""
+        self.y = [y[0],y[1]] # no derivative kick
+        e1 = self.r1 - y[0]
+        e2 = self.r2 - y[1]
+        self.e1_sum = 0
+        self.e2_sum = 0
+        rest = u
+        if self.run1:
+            rest -= (self.Kp1 + self.Ki1) * e1
+        if self.run2:
+            rest -= (self.Kp2 + self.Ki2) * e2
+        if self.run2 and self.Ki2:
+            self.e2_sum = rest / self.Ki2
+        elif self.run1 and self.Ki1:
+            self.e1_sum = rest / self.Ki1
+        self.limit()
+        self.u = u
+
     @micropython.native
     async def control(self):
         self.y1_prev = self.y[0]
@@ -87,19 +141,7 @@ class PID():
         self.y1_diff = self.y[0] - self.y1_prev
         self.y2_diff = self.y[1] - self.y2_prev        
         supervis = self.supervisory
-        #async with self.supervisory['lock']:
-        if supervis['reference_add']:
-            if supervis['reference_counter'] >= supervis['reference_num_samples']:
-                if not supervis['reference_repeat']:
-                    supervis['reference_add'] = False
-                supervis['reference_counter'] = 0
-                self.e1 = self.r1 + supervis['reference_sequence'][supervis['reference_counter']] - self.y[0]                
-            else:
-                self.e1 = self.r1 + supervis['reference_sequence'][supervis['reference_counter']] - self.y[0]
-                supervis['reference_counter'] += 1
-        else:
-            self.e1 = self.r1 - self.y[0]
-
+        self.e1 = self.r1 + next_reference(supervis) - self.y[0]
         self.e2 = self.r2 - self.y[1]
         
         self.u = 0.
@@ -116,24 +158,11 @@ class PID():
 
                 self.u += self.Kp2 * self.e2 + self.Ki2 * self.e2_sum - self.Kd2 * self.y2_diff  # do not take feedback of derivative in reference (!)
 
-        #async with supervis['lock']:
-        if supervis['control_add']:
-            if supervis['control_counter'] >= supervis['control_num_samples']:
-                if not supervis['control_repeat']:
-                    supervis['control_add'] = False
-                    supervis['control_counter'] = 0
-                    self.set_actuator(self.u)
-                    self.sample[2] = self.u
-                else:
-                    supervis['control_counter'] = 0
-                    self.set_actuator(self.u + supervis['control_sequence'][supervis['control_counter']])
-                    self.sample[2] = self.u + supervis['control_sequence'][supervis['control_counter']]
-                    supervis['control_counter'] += 1                    
-                    
-            else:
-                self.set_actuator(self.u + supervis['control_sequence'][supervis['control_counter']])
-                self.sample[2] = self.u + supervis['control_sequence'][supervis['control_counter']]
-                supervis['control_counter'] += 1
+        excitation = next_control(supervis)
+        if excitation is not None:
+            u = self.u + excitation
+            self.set_actuator(u)
+            self.sample[2] = u
         else:
             if self.run:
                 self.set_actuator(self.u)
@@ -150,11 +179,8 @@ class StateSpace():
         self.get_sensor = get_sensor
         self.set_actuator = set_actuator
         self.sampling_time_ms = sampling_time_ms
-        self.A = A
-        self.B = B
-        self.C = C
+        self.set_model(A,B,C)
         self.run = run
-        self.x = array('f',[0., 0.]) # only second order for now!
         self.u = 0.
         self.y = [0, 0]
         self.sample = [0, 0, 0.]
@@ -166,6 +192,7 @@ class StateSpace():
         self.e1_sum = 0
         self.y1_prev = 0
         self.r1 = 0
+        self.r2 = 0. # operating point of y[1], the model input is y[1] - r2
         self.run_pid = False
         self.supervisory = supervisory
 
@@ -173,7 +200,43 @@ class StateSpace():
         self.Kp1 = Kp1
         self.Ki1 = Ki1
         self.Kd1 = Kd1
-        
+
+    def set_model(self,A,B,C):
+        """Set the matrices of x <- A x + B (y[1] - r2), u = C x, the order is len(B)."""
+        n = len(B)
+        if len(A) != n or len(C) != n:
+            raise ValueError(f'A should be {n}x{n} and C should have length {n}')
+        self.A = A
+        self.B = B
+        self.C = C
+        self.x = array('f',[0. for _ in range(n)])
+        self.x_next = array('f',[0. for _ in range(n)])
+
+    def reset_state(self):
+        for i in range(len(self.x)):
+            self.x[i] = 0.
+        self.e1_sum = 0
+
+    def bumpless(self,y,u):
+        """Initialize the state at output y, so the control continues from u (of the previous controller).
+
+        x is the smallest state for which the next control C (A x + B y[1]) gives u."""
+        self.reset_state()
+        self.y = [y[0],y[1]]
+        if not self.gain:
+            return
+        target = u / self.gain
+        if self.run_pid:
+            target -= (self.Kp1 + self.Ki1) * (self.r1 - y[0])
+        n = len(self.x)
+        w = [sum(self.C[i] * self.A[i][j] for i in range(n)) for j in range(n)] # C A
+        ww = sum(wj * wj for wj in w)
+        if ww > 0:
+            target -= sum(self.C[i] * self.B[i] for i in range(n)) * (y[1] - self.r2)
+            for j in range(n):
+                self.x[j] = w[j] * target / ww
+        self.u = u / self.gain
+
     @micropython.native
     async def control(self):
         self.y1_prev = self.y[0]
@@ -187,10 +250,20 @@ class StateSpace():
             B = self.B
             C = self.C
             x = self.x
-            y = self.y[1]
-            x[0] = A[0][0]*x[0]+A[0][1]*x[1]+B[0]*y
-            x[1] = A[1][0]*x[0]+A[1][1]*x[1]+B[1]*y
-            self.u = C[0] * x[0] + C[1]*x[1]
+            x_next = self.x_next
+            y = self.y[1] - self.r2
+            n = len(x)
+            for i in range(n):
+                Ai = A[i]
+                value = B[i]*y
+                for j in range(n):
+                    value += Ai[j]*x[j]
+                x_next[i] = value
+            u = 0.
+            for i in range(n):
+                x[i] = x_next[i]
+                u += C[i]*x[i]
+            self.u = u
 
             if self.run_pid:
                 self.e1 = self.r1 - self.y[0]
@@ -205,3 +278,405 @@ class StateSpace():
         self.sample[2] = self.u
         
             
+
+
+class PIDStage():
+    """PID stage of MultiRate: slots[out_slot] = Kp e + Ki sum(e) - Kd diff(y[channel]), with e = r + slots[in_slot] - y[channel].
+
+    in_slot < 0 means no reference from another stage. The derivative and
+    sum are per update of the stage, i.e. per divider ticks of MultiRate."""
+    def __init__(self,channel,Kp=0.,Ki=0.,Kd=0.,r=0.,out_slot=0,in_slot=-1,limit_sum=2**16):
+        self.channel = channel
+        self.Kp = Kp
+        self.Ki = Ki
+        self.Kd = Kd
+        self.r = r
+        self.out_slot = out_slot
+        self.in_slot = in_slot
+        self.limit_sum = limit_sum
+        self.reset_state()
+
+    def set_gains(self,Kp,Ki,Kd):
+        self.Kp = Kp
+        self.Ki = Ki
+        self.Kd = Kd
+
+    def get_gains(self):
+        return (self.Kp,self.Ki,self.Kd)
+
+    def reset_state(self):
+        self.e_sum = 0
+        self.y_prev = None
+
+    def bumpless(self,y,out):
+        """Initialize the state at output y, so the next update gives out (reference of in_slot not included), returns that output."""
+        self.y_prev = y[self.channel]
+        e = self.r - y[self.channel]
+        if not self.Ki:
+            self.e_sum = 0
+            return self.Kp * e
+        self.e_sum = (out - (self.Kp + self.Ki) * e) / self.Ki
+        return out
+
+    @micropython.native
+    def update(self,y,slots,r_add=0.):
+        y = y[self.channel]
+        e = self.r + r_add - y
+        if self.in_slot >= 0:
+            e += slots[self.in_slot]
+        e_sum = self.e_sum + e
+        if e_sum > self.limit_sum:
+            e_sum = self.limit_sum
+        elif e_sum < -self.limit_sum:
+            e_sum = -self.limit_sum
+        self.e_sum = e_sum
+        y_diff = 0 if self.y_prev is None else y - self.y_prev
+        self.y_prev = y
+        slots[self.out_slot] = self.Kp * e + self.Ki * e_sum - self.Kd * y_diff
+
+
+class MultiRate():
+    """Stages that run every divider-th tick of sampling_time_ms, e.g. a fast pendulum loop and a slower arm loop.
+
+    A stage has update(y,slots,r_add) that writes its output in the preallocated
+    slots, where it is held until its next update and can be read by other
+    stages (cascade). The control is the sum of the slots in output_slots.
+    The stages only run with run, the reference excitation is added to the
+    reference of the stages on channel 0 (the arm, as e1 of PID)."""
+    def __init__(self,get_sensor,set_actuator,sampling_time_ms=1,num_slots=4,output_slots=(0,),run=False,supervisory={}):
+        self.get_sensor = get_sensor
+        self.set_actuator = set_actuator
+        self.sampling_time_ms = sampling_time_ms
+        self.slots = array('f',[0. for _ in range(num_slots)])
+        self.output_slots = output_slots
+        self.stages = []
+        self.dividers = array('i')
+        self.countdown = array('i') # ticks until the next update of every stage
+        self.run = run
+        self.u = 0.
+        self.y = [0, 0]
+        self.sample = [0, 0, 0.]
+        self.supervisory = supervisory
+        self.log = 0
+
+    def add_stage(self,stage,divider=1,offset=0):
+        """Run stage every divider ticks, first at tick offset (spreads slow stages over the ticks), returns its index."""
+        self.stages.append(stage)
+        self.dividers.append(divider)
+        self.countdown.append(offset)
+        return len(self.stages) - 1
+
+    def set_divider(self,index,divider):
+        self.dividers[index] = divider
+        self.countdown[index] = 0
+
+    def reset_state(self):
+        for i in range(len(self.slots)):
+            self.slots[i] = 0.
+        for stage in self.stages:
+            stage.reset_state()
+
+    def bumpless(self,y,u):
+        """Initialize the stages at output y, so the control continues from u (of the previous controller).
+
+        All stages run at the next tick, the first stage with an integrator on an
+        output slot takes up the difference with the other output stages."""
+        for i in range(len(self.slots)):
+            self.slots[i] = 0.
+        rest = u
+        integrating = None
+        for i in range(len(self.stages)):
+            self.countdown[i] = 0
+            stage = self.stages[i]
+            out = stage.bumpless(y,0.)
+            if stage.out_slot in self.output_slots:
+                rest -= out
+                if (integrating is None) and stage.Ki:
+                    integrating = stage
+        if integrating is not None:
+            integrating.bumpless(y,rest)
+        self.y = [y[0],y[1]]
+        self.u = u
+
+    @micropython.native
+    async def control(self):
+        self.y = self.get_sensor()
+        supervis = self.supervisory
+        r_add = next_reference(supervis)
+        u = 0.
+        if self.run:
+            slots = self.slots
+            countdown = self.countdown
+            stages = self.stages
+            for i in range(len(stages)):
+                if countdown[i] == 0:
+                    stage = stages[i]
+                    stage.update(self.y,slots,r_add if stage.channel == 0 else 0.)
+                    countdown[i] = self.dividers[i] - 1
+                else:
+                    countdown[i] -= 1
+            for i in self.output_slots:
+                u += slots[i]
+        self.u = u
+
+        excitation = next_control(supervis)
+        if excitation is not None:
+            u += excitation
+            self.set_actuator(u)
+        elif self.run:
+            self.set_actuator(u)
+        self.sample[0] = self.y[0]
+        self.sample[1] = self.y[1]
+        self.sample[2] = u
+
+
+class ExplicitMPC():
+    """Explicit MPC: piecewise-affine law u = table[cell] + gradient (x - center of cell) on a grid over the observer state x.
+
+    The observer is the current estimator x <- x_pred + L (y[1] - r2 - H x_pred)
+    with x_pred = A x + B u_prev. The cell is found by rounding, so the cost
+    per tick does not depend on the number of cells. Outside the grid, the
+    law of the nearest cell is extrapolated. The grid, table and observer are
+    computed and loaded by edukit_mpc.py."""
+    def __init__(self,get_sensor,set_actuator,sampling_time_ms,run=False,supervisory={}):
+        self.get_sensor = get_sensor
+        self.set_actuator = set_actuator
+        self.sampling_time_ms = sampling_time_ms
+        self.set_observer([[0.]],[0.],[0.],[0.])
+        self.set_grid([0.],[1.],[0])
+        self.u_min = -10000.
+        self.u_max = 10000.
+        self.r2 = 0.
+        self.run = run
+        self.u = 0.
+        self.u_prev = 0.
+        self.y = [0, 0]
+        self.sample = [0, 0, 0.]
+        self.supervisory = supervisory
+        self.log = 0
+
+    def set_observer(self,A,B,H,L):
+        """Model x <- A x + B u, y[1] - r2 = H x and observer gain L, the order is len(B)."""
+        n = len(B)
+        self.n = n
+        self.A = array('f',[A[i][j] for i in range(n) for j in range(n)])
+        self.B = array('f',B)
+        self.H = array('f',H)
+        self.L = array('f',L)
+        self.x = array('f',[0. for _ in range(n)])
+        self.x_pred = array('f',[0. for _ in range(n)])
+
+    def set_grid(self,low,high,num):
+        """Grid of num[i] cells from low[i] to high[i] per state, allocates the table of u and the gradient per cell."""
+        self.low = array('f',low)
+        self.inv_width = array('f',[num[i] / (high[i] - low[i]) if num[i] else 0. for i in range(len(num))])
+        self.num = array('i',num)
+        num_cells = 1
+        for k in num:
+            num_cells *= k
+        self.table = array('f',[0. for _ in range(num_cells * (len(num) + 1))])
+
+    def reset_state(self):
+        for i in range(self.n):
+            self.x[i] = 0.
+        self.u_prev = 0.
+
+    def bumpless(self,y,u):
+        """Observer state as small as possible with the measurement y, and u as the previous control."""
+        self.reset_state()
+        hh = 0.
+        for i in range(self.n):
+            hh += self.H[i] * self.H[i]
+        if hh > 0:
+            for i in range(self.n):
+                self.x[i] = self.H[i] * (y[1] - self.r2) / hh
+        self.y = [y[0],y[1]]
+        self.u_prev = u
+        self.u = u
+
+    @micropython.native
+    def law(self,x):
+        """Control for state x, from the table of the cell of x."""
+        n = self.n
+        num = self.num
+        low = self.low
+        inv_width = self.inv_width
+        table = self.table
+        if len(table) == 0:
+            return 0.
+        index = 0
+        for i in range(n):
+            k = int((x[i] - low[i]) * inv_width[i])
+            if k < 0:
+                k = 0
+            elif k >= num[i]:
+                k = num[i] - 1
+            index = index * num[i] + k
+        base = index * (n + 1)
+        u = table[base]
+        # offsets from the center of the cell
+        for i in range(n - 1, -1, -1):
+            k = index % num[i]
+            index //= num[i]
+            u += table[base + 1 + i] * (x[i] - low[i] - (k + 0.5) / inv_width[i])
+        if u > self.u_max:
+            u = self.u_max
+        elif u < self.u_min:
+            u = self.u_min
+        return u
+
+    @micropython.native
+    async def control(self):
+        self.y = self.get_sensor()
+        n = self.n
+        A = self.A
+        B = self.B
+        H = self.H
+        L = self.L
+        x = self.x
+        x_pred = self.x_pred
+        supervis = self.supervisory
+        innovation = self.y[1] - self.r2 - next_reference(supervis) # the reference excitation moves the operating point
+        for i in range(n):
+            value = B[i] * self.u_prev
+            for j in range(n):
+                value += A[i*n+j] * x[j]
+            x_pred[i] = value
+            innovation -= H[i] * value
+        for i in range(n):
+            x[i] = x_pred[i] + L[i] * innovation
+
+        self.u = self.law(x) if self.run else 0.
+        u = self.u
+        excitation = next_control(supervis)
+        if excitation is not None:
+            u += excitation
+            self.set_actuator(u)
+        elif self.run:
+            self.set_actuator(u)
+        self.u_prev = u
+        self.sample[0] = self.y[0]
+        self.sample[1] = self.y[1]
+        self.sample[2] = u
+
+    def benchmark(self,num=1000):
+        """Mean us per evaluation of the law (the observer takes a few us more)."""
+        t0 = ticks_us()
+        for _ in range(num):
+            self.law(self.x)
+        return ticks_diff(ticks_us(),t0) / num
+
+
+class RelayTuner():
+    """Relay feedback tuning of the PID loop on y[channel], u = +-amplitude with hysteresis on e = r - y[channel].
+
+    The limit cycle is measured from the switches of the relay, without
+    allocations: the period from the ticks between rising switches and the
+    amplitude from the extremes of y[channel] in between. After skip +
+    num_periods periods, result holds the ultimate gain Ku and period Tu and
+    the PID gains (per sample, as PID) of rule 'zn' (Ziegler-Nichols) or 'tl'
+    (Tyreus-Luyben), and on_done(self) is called."""
+    def __init__(self,get_sensor,set_actuator,sampling_time_ms,supervisory={}):
+        self.get_sensor = get_sensor
+        self.set_actuator = set_actuator
+        self.sampling_time_ms = sampling_time_ms
+        self.run = False
+        self.result = None
+        self.on_done = None
+        self.u = 0.
+        self.y = [0, 0]
+        self.sample = [0, 0, 0.]
+        self.supervisory = supervisory
+        self.log = 0
+
+    def start(self,channel=1,amplitude=200.,hysteresis=5,r=0,num_periods=4,skip=1,rule='zn',sign=1,max_ticks=3000):
+        """Start the relay, sign -1 for a loop in which a positive control decreases y[channel]."""
+        self.channel = channel
+        self.amplitude = amplitude
+        self.hysteresis = hysteresis
+        self.r = r
+        self.num_periods = num_periods
+        self.skip = skip
+        self.rule = rule
+        self.sign = sign
+        self.max_ticks = max_ticks
+        self.tick = 0
+        self.relay = 1 if r - self.y[channel] >= 0 else -1
+        self.last_rise = -1
+        self.periods = 0
+        self.period_sum = 0
+        self.amplitude_sum = 0
+        self.y_max = self.y[channel]
+        self.y_min = self.y[channel]
+        self.result = None
+        self.run = True
+
+    def reset_state(self):
+        self.run = False
+
+    def bumpless(self,y,u):
+        self.y = [y[0],y[1]] # the relay starts from its own output
+
+    def finish(self):
+        self.run = False
+        n = self.periods - self.skip
+        if n <= 0:
+            self.result = {'error':'no limit cycle within '+str(self.max_ticks)+' ticks'}
+        else:
+            T = self.sampling_time_ms * 1e-3
+            Tu = self.period_sum * T / n
+            a = self.amplitude_sum / (2 * n)
+            h = self.hysteresis
+            Ku = 4 * self.amplitude / (3.14159265 * ((a*a - h*h)**0.5 if a > h else a))
+            if self.rule == 'tl':
+                Kp, Ti, Td = Ku / 2.2, 2.2 * Tu, Tu / 6.3
+            else:
+                Kp, Ti, Td = 0.6 * Ku, Tu / 2, Tu / 8
+            Kp *= self.sign
+            self.result = {'Ku':Ku,'Tu':Tu,'amplitude':a,'rule':self.rule,'Kp':Kp,'Ki':Kp*T/Ti,'Kd':Kp*Td/T}
+        if self.on_done is not None:
+            self.on_done(self)
+
+    @micropython.native
+    async def control(self):
+        self.y = self.get_sensor()
+        supervis = self.supervisory
+        r_add = next_reference(supervis)
+        running = self.run # also on the tick that finishes, which sends 0.
+        u = 0.
+        if running:
+            y = self.y[self.channel]
+            self.tick += 1
+            if y > self.y_max:
+                self.y_max = y
+            elif y < self.y_min:
+                self.y_min = y
+            e = self.r + r_add - y
+            if (self.relay < 0) and (e > self.hysteresis): # rising switch, a period ends
+                self.relay = 1
+                if self.last_rise >= 0:
+                    self.periods += 1
+                    if self.periods > self.skip:
+                        self.period_sum += self.tick - self.last_rise
+                        self.amplitude_sum += self.y_max - self.y_min
+                self.last_rise = self.tick
+                self.y_max = y
+                self.y_min = y
+            elif (self.relay > 0) and (e < -self.hysteresis):
+                self.relay = -1
+            if (self.periods >= self.skip + self.num_periods) or (self.tick >= self.max_ticks):
+                self.u = 0. # on_done hands over to the next controller, which continues from the 0. sent below
+                self.finish()
+            else:
+                u = self.sign * self.relay * self.amplitude
+        self.u = u
+
+        excitation = next_control(supervis)
+        if excitation is not None:
+            u += excitation
+            self.set_actuator(u)
+        elif running:
+            self.set_actuator(u)
+        self.sample[0] = self.y[0]
+        self.sample[1] = self.y[1]
+        self.sample[2] = u
@@ -0,0 +1,270 @@
+from array import array
+from math import sin, pi
+from random import random
+from binascii import a2b_base64
+from micropython import const
+import micropython
+import uctypes
+
+from ucodec import decode_half
+
+# Excitation generators for the reference_add and control_add paths of the
+# controllers. Every generator computes its next sample on demand in O(1),
+# so experiments can run arbitrarily long in constant memory. Periodic
+# signals use integer phase accumulators and a small shared sine table.
+
+SINE_TABLE_LEN = const(256)
+PHASE_BITS     = const(24)             # phase accumulator resolution (one period = 2**24)
+PHASE_MASK     = const(0xFFFFFF)
+PHASE_SHIFT    = const(16)             # PHASE_BITS - log2(SINE_TABLE_LEN)
+CHIRP_FRAC     = const(6)              # extra fractional bits for the chirp increment
+
+sine_table = array('f',[sin(2*pi*i/SINE_TABLE_LEN) for i in range(SINE_TABLE_LEN)])
+
+# Galois LFSR feedback masks giving maximum length sequences (2**order - 1)
+PRBS_TAPS = (0, 0, 0x3, 0x6, 0xC, 0x14, 0x30, 0x60, 0xB8, 0x110, 0x240, 0x500, 0x829, 0x100D, 0x2015, 0x6000, 0xD008)
+
+
+class Excitation():
+    """Base class of excitation generators, next() returns the next sample."""
+    def __init__(self,amplitude=1.,offset=0.):
+        self.amplitude = amplitude
+        self.offset = offset
+
+    def reset(self):
+        pass
+
+    def next(self):
+        return self.offset
+
+
+class Square(Excitation):
+    """Level height1 for the first duration samples of each period, height2 for the rest, plus noise*random()."""
+    def __init__(self,height1=0.,height2=0.,duration=100,period=200,noise=0.):
+        super().__init__(1.,0.)
+        self.height1 = 1.*height1
+        self.height2 = 1.*height2
+        self.duration = duration
+        self.period = period
+        self.noise = noise
+        self.counter = 0
+
+    def reset(self):
+        self.counter = 0
+
+    @micropython.native
+    def next(self):
+        k = self.counter
+        if k + 1 < self.period:
+            self.counter = k + 1
+        else:
+            self.counter = 0
+        if k < self.duration:
+            value = self.height1
+        else:
+            value = self.height2
+        if self.noise:
+            value += self.noise*random()
+        return value
+
+
+class PRBS(Excitation):
+    """Pseudo random binary sequence of +/- amplitude from a Galois LFSR, each bit held for hold samples."""
+    def __init__(self,amplitude=1.,order=9,hold=1,seed=1,offset=0.):
+        super().__init__(amplitude,offset)
+        if order < 2 or order >= len(PRBS_TAPS):
+            raise ValueError(f'order ({order}) must be in 2 ... {len(PRBS_TAPS)-1}')
+        self.order = order
+        self.taps = PRBS_TAPS[order]
+        self.hold = hold
+        self.seed = (seed & ((1 << order) - 1)) or 1 # the all-zero state locks the LFSR
+        self.period = hold * ((1 << order) - 1)
+        self.reset()
+
+    def reset(self):
+        self.state = self.seed
+        self.hold_counter = 0
+        self.bit = self.seed & 1
+
+    @micropython.native
+    def next(self):
+        if self.hold_counter == 0:
+            state = self.state
+            self.bit = state & 1
+            state >>= 1
+            if self.bit:
+                state ^= self.taps
+            self.state = state
+        self.hold_counter += 1
+        if self.hold_counter >= self.hold:
+            self.hold_counter = 0
+        if self.bit:
+            return self.offset + self.amplitude
+        else:
+            return self.offset - self.amplitude
+
+
+class Chirp(Excitation):
+    """Linear swept sine from f0 to f1 (Hz) in duration seconds, then restarting at f0."""
+    def __init__(self,amplitude=1.,f0=0.1,f1=10.,duration=10.,sampling_time_ms=10,offset=0.):
+        super().__init__(amplitude,offset)
+        if f1*sampling_time_ms > 500:
+            raise ValueError(f'f1 ({f1}) above Nyquist frequency ({500/sampling_time_ms})')
+        scale = (1 << (PHASE_BITS + CHIRP_FRAC)) * sampling_time_ms / 1000
+        self.period = max(1,round(1000*duration/sampling_time_ms))
+        self.inc0 = round(f0*scale)
+        self.dinc = round((f1-f0)*scale/self.period)
+        self.reset()
+
+    def reset(self):
+        self.phase = 0
+        self.inc = self.inc0
+        self.counter = 0
+
+    @micropython.native
+    def next(self):
+        value = self.offset + self.amplitude*sine_table[self.phase >> PHASE_SHIFT]
+        self.phase = (self.phase + (self.inc >> CHIRP_FRAC)) & PHASE_MASK
+        self.counter += 1
+        if self.counter >= self.period:
+            self.counter = 0
+            self.inc = self.inc0
+        else:
+            self.inc += self.dinc
+        return value
+
+
+class Multisine(Excitation):
+    """Sum of sines at harmonics k/(period*sampling_time) with Schroeder phases, peak value at most amplitude."""
+    def __init__(self,amplitude=1.,harmonics=(1,2,3),period=256,offset=0.):
+        super().__init__(amplitude,offset)
+        num = len(harmonics)
+        self.period = period
+        self.modulus = SINE_TABLE_LEN * period  # phases are in units of 1/period table entries
+        self.gain = amplitude / num
+        self.inc = array('i',[k * SINE_TABLE_LEN % self.modulus for k in harmonics])
+        # Schroeder phases -pi*k*(k-1)/num give a low crest factor
+        self.phase0 = array('i',[round(-k*(k-1)/num/2*self.modulus) % self.modulus for k in range(1,num+1)])
+        self.phase = array('i',self.phase0)
+
+    def reset(self):
+        phase = self.phase
+        phase0 = self.phase0
+        for i in range(len(phase)):
+            phase[i] = phase0[i]
+
+    @micropython.native
+    def next(self):
+        phase = self.phase
+        inc = self.inc
+        modulus = self.modulus
+        period = self.period
+        total = 0.
+        for i in range(len(phase)):
+            p = phase[i]
+            total += sine_table[p // period]
+            p += inc[i]
+            if p >= modulus:
+                p -= modulus
+            phase[i] = p
+        return self.offset + self.gain*total
+
+
+class Sequence(Excitation):
+    """Replay of a precomputed array('f'), wrapping around at its end."""
+    def __init__(self,data):
+        super().__init__(1.,0.)
+        self.data = data
+        self.period = len(data)
+        self.counter = 0
+
+    def reset(self):
+        self.counter = 0
+
+    @micropython.native
+    def next(self):
+        k = self.counter
+        if k + 1 < self.period:
+            self.counter = k + 1
+        else:
+            self.counter = 0
+        return self.data[k]
+
+
+class Stream(Excitation):
+    """Double buffered playback of a trajectory that is uploaded in chunks of chunk_len float32 samples.
+
+    The host puts chunks with put_bytes() (endpoint stream_put of
+    mpy_edukit) or base64 encoded with put() ahead of the playback, next()
+    swaps buffers at the chunk boundaries. When no chunk is available the
+    output is zero and underruns is incremented, end() marks that no more
+    chunks follow."""
+    def __init__(self,chunk_len=128):
+        super().__init__(1.,0.)
+        self.chunk_len = chunk_len
+        self.buffers = (array('f',[0. for _ in range(chunk_len)]), array('f',[0. for _ in range(chunk_len)]))
+        # byte views on the buffers, so uploaded chunks are copied in place
+        self.views = tuple(uctypes.bytearray_at(uctypes.addressof(buf),4*chunk_len) for buf in self.buffers)
+        self.length = array('i',[0, 0]) # number of valid samples, 0 if buffer is free
+        self.reset()
+
+    def reset(self):
+        self.length[0] = 0
+        self.length[1] = 0
+        self.write_buf = 0
+        self.read_buf = 0
+        self.counter = 0
+        self.chunks_in = 0
+        self.chunks_out = 0
+        self.underruns = 0
+        self.ended = False
+
+    def free(self):
+        return (self.length[0] == 0) + (self.length[1] == 0)
+
+    def put(self,chunk_b64,half=False):
+        """Copy a base64 encoded chunk of float32 (float16 if half) samples in the free buffer, returns number of free buffers."""
+        return self.put_bytes(a2b_base64(chunk_b64),half)
+
+    def put_bytes(self,data,half=False):
+        """Copy a chunk of float32 (float16 if half) samples in the free buffer, returns number of free buffers."""
+        buf = self.write_buf
+        if self.length[buf]:
+            raise ValueError('stream buffers full')
+        num_bytes = len(data)
+        size = 2 if half else 4
+        if (num_bytes % size) or (num_bytes > size*self.chunk_len):
+            raise ValueError(f'chunk of {num_bytes} bytes does not fit in {self.chunk_len} samples')
+        if half:
+            decode_half(data,self.buffers[buf])
+        else:
+            self.views[buf][0:num_bytes] = data
+        self.length[buf] = num_bytes // size
+        self.write_buf = buf ^ 1
+        self.chunks_in += 1
+        return self.free()
+
+    def end(self):
+        self.ended = True
+
+    def status(self):
+        return (self.chunks_in, self.chunks_out, self.underruns, self.free(), self.ended)
+
+    @micropython.native
+    def next(self):
+        buf = self.read_buf
+        length = self.length[buf]
+        if length == 0:
+            if not self.ended:
+                self.underruns += 1
+            return 0.
+        k = self.counter
+        value = self.buffers[buf][k]
+        if k + 1 < length:
+            self.counter = k + 1
+        else: # chunk consumed, release it and swap
+            self.counter = 0
+            self.length[buf] = 0
+            self.read_buf = buf ^ 1
+            self.chunks_out += 1
+        return value
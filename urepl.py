@@ -1,45 +1,181 @@
 import asyncio
+import select
 import sys
 import micropython
-import gc
+from binascii import a2b_base64, b2a_base64
+from micropython import const
+
+CACHE_LEN = const(32) # compiled commands kept in cache
+CACHE_MAX_CMD = const(128) # longer commands (e.g. with data) are compiled every time, not cached
+ENDPOINT = const(5) # first byte of an endpoint call: b'\x05' + id + b' ' + base64 args
+MAX_FRAME = const(4096) # longest command (bytes), longer commands are discarded
+EVENT = b'\x06' # first byte of an event, sent by the board without a command
+
+cache = {} # command: [code, is_expression, last use]
+cache_uses = 0
+registry = [] # functions of the endpoints, indexed by id
+registry_names = {} # name: id
+writer = None # StreamWriter of the responses, also used for the events
+
+
+def register(name,function):
+    """Register function(args) as endpoint name, it gets the binary args and returns bytes (or a bytearray)."""
+    if name in registry_names:
+        registry[registry_names[name]] = function
+    else:
+        registry_names[name] = len(registry)
+        registry.append(function)
+    return registry_names[name]
+
+def endpoint_ids():
+    return dict(registry_names)
+
+def send_event(event):
+    """Send the repr of event to the host between the responses, as EVENT + repr + END_PATTERN.
+
+    The event goes through the writer of the responses, so it cannot interleave
+    with a response that is still being sent (then it follows with its drain)."""
+    frame = EVENT+repr(event).encode('utf-8')+b'\x04'
+    if writer is None:
+        sys.stdout.write(frame)
+    else:
+        writer.write(frame)
+
+
+def compiled(cmd):
+    """Code of cmd and whether it is an expression, from the cache of the least recently used short commands."""
+    global cache_uses
+    cache_uses += 1
+    entry = cache.get(cmd)
+    if entry is None:
+        try:
+            entry = [compile(cmd,'<repl>','eval'),True,0]
+        except SyntaxError:
+            entry = [compile(cmd,'<repl>','exec'),False,0]
+        if len(cmd) > CACHE_MAX_CMD: # the command and its constants would take too much of the heap
+            return entry
+        if len(cache) >= CACHE_LEN:
+            oldest = min(cache,key=lambda key: cache[key][2])
+            del cache[oldest]
+        cache[cmd] = entry
+    entry[2] = cache_uses
+    return entry
+
+
+@micropython.native
+def find_byte(buf,start,end,byte):
+    """Index of byte in buf[start:end], -1 if not found."""
+    for i in range(start,end):
+        if buf[i] == byte:
+            return i
+    return -1
+
+@micropython.native
+def move_to_front(buf,start,end):
+    """Copy buf[start:end] to the front of buf, in place."""
+    for i in range(end-start):
+        buf[i] = buf[start+i]
+
+@micropython.native
+def read_available(stream,poller,byte,buf,end,max_end,end_byte):
+    """Read the bytes that are available on stream into buf[end:max_end], one at a time via byte, up to end_byte, returns the new end.
+
+    readinto of the stdin of micropython waits until the whole buffer is filled,
+    so bytes are only read after poller (ipoll, which allocates nothing) says one is available."""
+    while end < max_end:
+        ready = False
+        for _ in poller.ipoll(0):
+            ready = True
+        if not ready:
+            break
+        stream.readinto(byte)
+        buf[end] = byte[0]
+        end += 1
+        if byte[0] == end_byte:
+            break
+    return end
+
+@micropython.native
+def parse_int(buf,start,end):
+    value = 0
+    for i in range(start,end):
+        value = 10*value + buf[i] - 48
+    return value
 
 
 # simplified version of aiorepl by https://github.com/micropython/micropython-lib/blob/master/micropython/aiorepl/aiorepl.py
-async def repl(namespace=None):
+async def repl(namespace=None,endpoints=None,max_frame=MAX_FRAME):
     END_PATTERN = const(b'\x04') #const(b'$@')
-    END_PATTERN_LEN = len(END_PATTERN)
-    #BUF_SIZE=const(64)
-    
+    END_BYTE = const(4)
+
     if namespace is None:
         namespace = __import__("__main__").__dict__
-        
+    if endpoints is None:
+        endpoints = registry
+
+    global writer
     stream_in = asyncio.StreamReader(sys.stdin)
     stream_out = asyncio.StreamWriter(sys.stdout)
+    writer = stream_out
+    poller = select.poll()
+    poller.register(sys.stdin,select.POLLIN)
+    # commands are received in a preallocated buffer, byte by byte without awaiting per byte, and scanned in place
+    buf = bytearray(max_frame)
+    mv = memoryview(buf)
+    byte = bytearray(1)
+    byte_mv = memoryview(byte)
+    end = 0 # number of bytes in buf
     micropython.kbd_intr(-1) # disable C-c
     while True:
-        gc.collect()
-        resp = b''
-        b = await stream_in.read(END_PATTERN_LEN)
-        resp += b
-        pattern = resp[-END_PATTERN_LEN:]
-        while not (pattern == END_PATTERN):
-            b = await stream_in.read(1)
-            resp += b
-            pattern = resp[-END_PATTERN_LEN:]
-        cmd = resp[:-(END_PATTERN_LEN)].decode('utf-8')
-        if cmd == "stop":
-            break
-        
-        try:
-            stream_out.write(repr(eval(cmd,namespace)).encode('utf-8'))
-            stream_out.write(END_PATTERN)
-        except: # SyntaxError:
+        # wait for a complete frame, the next frames may already be in buf
+        scanned = 0
+        overflow = False
+        i = find_byte(buf,0,end,END_BYTE)
+        while i < 0:
+            if end == max_frame: # frame too long, discard it up to the terminator
+                overflow = True
+                end = 0
+            scanned = end
+            if await stream_in.readinto(byte_mv): # wait for the first byte
+                buf[end] = byte[0]
+                end += 1
+                if byte[0] != END_BYTE:
+                    end = read_available(sys.stdin,poller,byte,buf,end,max_frame,END_BYTE)
+            i = find_byte(buf,scanned,end,END_BYTE)
+        frame = mv[:i]
+
+        if overflow:
+            stream_out.write(("Exception: command longer than "+str(max_frame)+" bytes").encode('utf-8')+END_PATTERN)
+        elif (i > 0) and (buf[0] == ENDPOINT):
+            # fast path: no compiler and no repr, the result is sent as quoted base64
+            try:
+                sep = find_byte(buf,1,i,32)
+                if sep < 0:
+                    raise ValueError('endpoint call without arguments separator')
+                result = endpoints[parse_int(buf,1,sep)](a2b_base64(mv[sep+1:i]))
+                stream_out.write(b"'")
+                stream_out.write(b2a_base64(result)[:-1]) # without newline
+                stream_out.write(b"'")
+                stream_out.write(END_PATTERN)
+            except Exception as e:
+                stream_out.write(("Exception: "+str(e)).encode('utf-8')+END_PATTERN)
+        else:
+            cmd = str(frame,'utf-8')
+            if cmd == "stop":
+                break
             try:
-                exec(cmd,namespace)
-                stream_out.write(END_PATTERN)                
+                code, is_expression, _ = compiled(cmd)
+                if is_expression:
+                    stream_out.write(repr(eval(code,namespace)).encode('utf-8'))
+                else:
+                    exec(code,namespace)
+                stream_out.write(END_PATTERN)
             except Exception as e:
                 stream_out.write(("Exception: "+str(e)).encode('utf-8')+END_PATTERN) # prefix with Exception, so it can be filtered to prevent evaluation
-        await stream_out.drain()        
+        # keep the bytes after the terminator (pipelined commands) for the next frame
+        move_to_front(buf,i+1,end)
+        end -= i+1
+        await stream_out.drain()
 
+    writer = None
     micropython.kbd_intr(3) # enable C-c
-    
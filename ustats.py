@@ -0,0 +1,93 @@
+from array import array
+from struct import pack_into
+import micropython
+
+# running statistics of the controller, updated every tick with the
+# Welford recursions in preallocated arrays, so the host can compare gain
+# sets with one fetch instead of logging all samples
+
+
+class RunningStats():
+    """Mean, standard deviation, min, max and rms of num_channels values and num_counters event counts.
+
+    With window > 0 the statistics restart every window samples, the last
+    complete window is kept as previous."""
+    def __init__(self,num_channels,num_counters=0,window=0):
+        self.num_channels = num_channels
+        self.num_counters = num_counters
+        self.window = window
+        self.num_windows = 0
+        self.n = 0
+        self.mean = array('f',[0. for _ in range(num_channels)])
+        self.m2 = array('f',[0. for _ in range(num_channels)]) # sum of squared deviations from the mean
+        self.min = array('f',[0. for _ in range(num_channels)])
+        self.max = array('f',[0. for _ in range(num_channels)])
+        self.counts = array('i',[0 for _ in range(num_counters)])
+        self.previous_n = 0
+        self.previous = array('f',[0. for _ in range(4*num_channels)]) # mean, m2, min, max
+        self.previous_counts = array('i',[0 for _ in range(num_counters)])
+        self.data = bytearray(16+20*num_channels+4*num_counters)
+
+    def reset(self):
+        self.n = 0
+        for i in range(self.num_channels):
+            self.mean[i] = 0.
+            self.m2[i] = 0.
+        for i in range(self.num_counters):
+            self.counts[i] = 0
+
+    def end_window(self):
+        """Keep the statistics as previous and restart."""
+        num = self.num_channels
+        for i in range(num):
+            self.previous[i] = self.mean[i]
+            self.previous[num+i] = self.m2[i]
+            self.previous[2*num+i] = self.min[i]
+            self.previous[3*num+i] = self.max[i]
+        for i in range(self.num_counters):
+            self.previous_counts[i] = self.counts[i]
+        self.previous_n = self.n
+        self.num_windows += 1
+        self.reset()
+
+    @micropython.native
+    def add(self,values):
+        if self.window and (self.n >= self.window):
+            self.end_window()
+        n = self.n + 1
+        self.n = n
+        mean = self.mean
+        m2 = self.m2
+        for i in range(self.num_channels):
+            x = values[i]
+            d = x - mean[i]
+            mean[i] += d / n
+            m2[i] += d * (x - mean[i])
+            if (n == 1) or (x < self.min[i]):
+                self.min[i] = x
+            if (n == 1) or (x > self.max[i]):
+                self.max[i] = x
+
+    def count(self,i):
+        self.counts[i] += 1
+
+    def pack(self,previous=False):
+        """uint32 n, number of windows, channels and counters, float32 mean, std, min, max and rms per channel, int32 counts."""
+        num = self.num_channels
+        if previous:
+            n = self.previous_n
+            stats = self.previous
+            counts = self.previous_counts
+        else:
+            n = self.n
+            stats = self.mean + self.m2 + self.min + self.max
+            counts = self.counts
+        data = self.data
+        pack_into('<4I',data,0,n,self.num_windows,num,self.num_counters)
+        for i in range(num):
+            mean = stats[i]
+            variance = stats[num+i] / n if n else 0.
+            pack_into('<5f',data,16+20*i,mean,variance**0.5,stats[2*num+i],stats[3*num+i],(variance+mean*mean)**0.5)
+        for i in range(self.num_counters):
+            pack_into('<i',data,16+20*num+4*i,counts[i])
+        return data